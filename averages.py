@@ -0,0 +1,199 @@
+from typing import Dict, List
+
+import array
+import collections
+import heapq
+import math
+
+
+class Histogram:
+    """Compact histogram of positive values, in logarithmic bins that are each growth
+    times wider than the previous one - so that percentiles are within growth of the
+    true value whatever the values' scale. Only bins that hold values are kept"""
+
+    # bin of values that are zero (or negative)
+    _zero_bin = -(2 ** 31)
+
+    def __init__(self, growth: float = 1.05):
+        self._log_growth = math.log(growth)
+        self._counts = collections.Counter()
+        self._count = 0
+
+    def add(self, value: float, count: int = 1) -> None:
+        """Adds (or, with a negative count, removes) a value"""
+        bin_index = self._get_bin_index(value)
+
+        self._counts[bin_index] += count
+        if self._counts[bin_index] == 0:
+            del self._counts[bin_index]
+
+        self._count += count
+
+    def get_percentile(self, percentile: float) -> float:
+        """Returns the upper edge of the bin the percentile (0-100) falls in"""
+        if not self._count:
+            raise ValueError("Histogram is empty")
+
+        rank = percentile / 100 * self._count
+        cumulative_count = 0
+
+        for bin_index in sorted(self._counts):
+            cumulative_count += self._counts[bin_index]
+
+            if cumulative_count >= rank:
+                break
+
+        if bin_index == self._zero_bin:
+            return 0.0
+
+        return math.exp((bin_index + 1) * self._log_growth)
+
+    def _get_bin_index(self, value: float) -> int:
+        if value <= 0:
+            return self._zero_bin
+
+        return math.floor(math.log(value) / self._log_growth)
+
+    def __len__(self) -> int:
+        return self._count
+
+
+class Accumulator:
+    """Sliding window of per-key averages. Values are folded into per-key sum/count
+    accumulators as they arrive and removed once they fall out of the window, so that
+    updating costs time proportional to the number of new/expired values.
+
+    Keys are integers, each given a row in flat arrays on first use. Sums are
+    compensated (Neumaier) so that values can be added and removed for as long as the
+    process runs without accumulating floating point drift"""
+
+    def __init__(self, history_seconds: float):
+        self._history_seconds = history_seconds
+
+        # (end_time, row, value), as a heap on end_time - values may be added in any
+        # order (e.g. a batch of logs older than the previous one)
+        self._values = []
+
+        # key -> row in the arrays below
+        self._rows = {}
+        self._sums = array.array("d")
+        self._sum_compensations = array.array("d")
+        self._squared_sums = array.array("d")
+        self._squared_sum_compensations = array.array("d")
+        self._counts = array.array("q")
+
+        # row -> histogram, of rows that hold values
+        self._histograms = {}
+
+    def add(self, values: List) -> None:
+        """Adds (end_time, key, value) tuples"""
+        for end_time, key, value in values:
+            row = self._get_row(key)
+
+            heapq.heappush(self._values, (end_time, row, value))
+            _add(self._sums, self._sum_compensations, row, value)
+            _add(self._squared_sums, self._squared_sum_compensations, row, value * value)
+            self._histograms.setdefault(row, Histogram()).add(value)
+            self._counts[row] += 1
+
+    def expire(self, now: float) -> None:
+        """Removes all values that ended before the history window"""
+        start_time = now - self._history_seconds
+
+        while self._values and self._values[0][0] < start_time:
+            _, row, value = heapq.heappop(self._values)
+            self._counts[row] -= 1
+
+            # rows are kept for when the key comes back, but start over from zero
+            if self._counts[row] == 0:
+                self._sums[row] = self._sum_compensations[row] = 0.0
+                self._squared_sums[row] = self._squared_sum_compensations[row] = 0.0
+                del self._histograms[row]
+            else:
+                _add(self._sums, self._sum_compensations, row, -value)
+                _add(self._squared_sums, self._squared_sum_compensations, row, -value * value)
+                self._histograms[row].add(value, -1)
+
+    def get_average(self, key: int) -> float:
+        row = self._get_existing_row(key)
+
+        return (self._sums[row] + self._sum_compensations[row]) / self._counts[row]
+
+    def get_variance(self, key: int) -> float:
+        """Sample variance of the key's values"""
+        row = self._get_existing_row(key)
+
+        count = self._counts[row]
+        if count < 2:
+            return 0.0
+
+        sum_value = self._sums[row] + self._sum_compensations[row]
+        squared_sum_value = self._squared_sums[row] + self._squared_sum_compensations[row]
+        variance = (squared_sum_value - sum_value * sum_value / count) / (count - 1)
+
+        # cancellation may leave a tiny negative
+        return max(variance, 0.0)
+
+    def get_histogram(self, key: int) -> Histogram:
+        return self._histograms[self._get_existing_row(key)]
+
+    def get_count(self, key: int) -> int:
+        row = self._rows.get(key)
+        if row is None:
+            return 0
+
+        return self._counts[row]
+
+    def to_dict(self) -> Dict:
+        return {
+            key: {
+                "average": self.get_average(key),
+                "count": self._counts[row],
+            }
+            for key, row in self._rows.items()
+            if self._counts[row]
+        }
+
+    def _get_row(self, key: int) -> int:
+        row = self._rows.get(key)
+
+        if row is None:
+            row = self._rows[key] = len(self._counts)
+
+            for values in (
+                self._sums,
+                self._sum_compensations,
+                self._squared_sums,
+                self._squared_sum_compensations,
+            ):
+                values.append(0.0)
+
+            self._counts.append(0)
+
+        return row
+
+    def _get_existing_row(self, key: int) -> int:
+        row = self._rows.get(key)
+        if row is None or not self._counts[row]:
+            raise KeyError(key)
+
+        return row
+
+    def __contains__(self, key: int) -> bool:
+        return self.get_count(key) > 0
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+
+def _add(sums: array.array, compensations: array.array, row: int, value: float) -> None:
+    """Compensated (Neumaier) addition of value to sums[row]"""
+    sum_value = sums[row]
+    total = sum_value + value
+
+    if abs(sum_value) >= abs(value):
+        compensations[row] += (sum_value - total) + value
+    else:
+        compensations[row] += (value - total) + sum_value
+
+    sums[row] = total
@@ -0,0 +1,343 @@
+from typing import Dict, List, Optional
+
+import abc
+import inspect
+import math
+
+import averages
+import pyopensprinkler
+import station_flow
+
+
+class AnomalyEvent:
+    def __init__(
+        self,
+        station: pyopensprinkler.Station,
+        detector_name: str,
+        measurement: float,
+        statistic: float,
+        threshold: float,
+    ):
+        self.station = station
+        self.detector_name = detector_name
+        self.measurement = measurement
+        self.statistic = statistic
+        self.threshold = threshold
+
+    def __repr__(self):
+        return (
+            f"{self.detector_name} for station {self.station.name} ({self.statistic:.2f}) "
+            f"exceeded its threshold ({self.threshold:.2f}) at measurement {self.measurement}"
+        )
+
+
+class Baseline:
+    """What a station's flow usually looks like, from the flow of its past runs. Note
+    that these are run averages - std is the spread between runs, while single
+    measurements within a run spread much more (see Detector)"""
+
+    def __init__(self, mean: float, variance: float, histogram: averages.Histogram):
+        self.mean = mean
+        self.variance = variance
+        self.std = math.sqrt(variance)
+        self.histogram = histogram
+        self.count = len(histogram)
+
+    @classmethod
+    def from_accumulator(
+        cls, accumulator: averages.Accumulator, key: int
+    ) -> Optional["Baseline"]:
+        if key not in accumulator:
+            return None
+
+        return cls(
+            accumulator.get_average(key),
+            accumulator.get_variance(key),
+            accumulator.get_histogram(key),
+        )
+
+
+class Detector(abc.ABC):
+    """Checks a run's measurements against a station's baseline. Detectors are created
+    per run and hold the run's state, checking a measurement in O(1).
+
+    The baseline only knows how runs' averages spread, so detectors add how much the
+    run's own measurements spread (noise_variance) to it. Detectors only start checking
+    once the monitor's window is full, so that the noise is known"""
+
+    name = None
+
+    def add(
+        self,
+        measurement: float,
+        window: station_flow.MeasurementWindow,
+        noise_variance: float,
+    ) -> Optional[AnomalyEvent]:
+        """Returns an event if the measurement (or the run so far) is anomalous. window
+        holds the monitor's last measurements, including this one"""
+        if not window.full:
+            return None
+
+        return self._add(measurement, window, noise_variance)
+
+    @abc.abstractmethod
+    def _add(
+        self,
+        measurement: float,
+        window: station_flow.MeasurementWindow,
+        noise_variance: float,
+    ) -> Optional[AnomalyEvent]:
+        pass
+
+    def get_state(self) -> Dict:
+        return {}
+
+    def restore_state(self, state: Dict) -> None:
+        pass
+
+
+class EwmaDetector(Detector):
+    """Exponentially weighted moving average of the run's measurements, raised when it
+    drifts more than threshold_sigmas standard deviations above the baseline's mean.
+    Averaging damps the measurements' noise, but not the spread between runs"""
+
+    name = "ewma"
+
+    def __init__(
+        self,
+        station: pyopensprinkler.Station,
+        baseline: Baseline,
+        alpha: float = 0.3,
+        threshold_sigmas: float = 4.5,
+    ):
+        self._station = station
+        self._baseline = baseline
+        self._alpha = alpha
+        self._threshold_sigmas = threshold_sigmas
+        self._ewma = None
+
+    def _add(
+        self,
+        measurement: float,
+        window: station_flow.MeasurementWindow,
+        noise_variance: float,
+    ) -> Optional[AnomalyEvent]:
+        if self._ewma is None:
+            self._ewma = window.mean
+        else:
+            self._ewma += self._alpha * (measurement - self._ewma)
+
+        threshold = self._baseline.mean + self._threshold_sigmas * math.sqrt(
+            self._baseline.variance + noise_variance * self._alpha / (2 - self._alpha)
+        )
+
+        if self._ewma > threshold:
+            return AnomalyEvent(self._station, "EWMA", measurement, self._ewma, threshold)
+
+        return None
+
+    def get_state(self) -> Dict:
+        return {"ewma": self._ewma}
+
+    def restore_state(self, state: Dict) -> None:
+        self._ewma = state["ewma"]
+
+
+class CusumDetector(Detector):
+    """One sided cumulative sum of how far measurements exceed the baseline's mean, so
+    that a small but persistent increase - a drip - adds up until it passes
+    threshold_sigmas. A normal run may sit above the mean for its whole length, so only
+    what exceeds baseline_sigmas of the spread between runs (plus a slack) adds up"""
+
+    name = "cusum"
+
+    def __init__(
+        self,
+        station: pyopensprinkler.Station,
+        baseline: Baseline,
+        baseline_sigmas: float = 2.5,
+        slack_sigmas: float = 0.5,
+        threshold_sigmas: float = 10.0,
+    ):
+        self._station = station
+        self._baseline = baseline
+        self._reference = baseline.mean + baseline_sigmas * baseline.std
+        self._slack_sigmas = slack_sigmas
+        self._threshold_sigmas = threshold_sigmas
+        self._sum = 0.0
+
+    def _add(
+        self,
+        measurement: float,
+        window: station_flow.MeasurementWindow,
+        noise_variance: float,
+    ) -> Optional[AnomalyEvent]:
+        std = math.sqrt(self._baseline.variance + noise_variance)
+
+        self._sum = max(
+            0.0, self._sum + (measurement - self._reference) / std - self._slack_sigmas
+        )
+
+        if self._sum > self._threshold_sigmas:
+            return AnomalyEvent(
+                self._station, "CUSUM", measurement, self._sum, self._threshold_sigmas
+            )
+
+        return None
+
+    def get_state(self) -> Dict:
+        return {"sum": self._sum}
+
+    def restore_state(self, state: Dict) -> None:
+        self._sum = state["sum"]
+
+
+class PercentileBandDetector(Detector):
+    """Raised when the mean of the monitor's window is above the given percentile of
+    the station's past runs (times a margin) num_measurements measurements in a row.
+    Past runs are averages, so they're compared with the window's average, allowing
+    for noise_sigmas of its noise"""
+
+    name = "percentile"
+
+    def __init__(
+        self,
+        station: pyopensprinkler.Station,
+        baseline: Baseline,
+        percentile: float = 99.0,
+        margin: float = 1.1,
+        num_measurements: int = 3,
+        noise_sigmas: float = 3.0,
+    ):
+        self._station = station
+        self._percentile_value = baseline.histogram.get_percentile(percentile) * margin
+        self._num_measurements = num_measurements
+        self._noise_sigmas = noise_sigmas
+        self._num_measurements_above = 0
+
+    def _add(
+        self,
+        measurement: float,
+        window: station_flow.MeasurementWindow,
+        noise_variance: float,
+    ) -> Optional[AnomalyEvent]:
+        threshold = self._percentile_value + self._noise_sigmas * math.sqrt(
+            noise_variance / len(window)
+        )
+
+        if window.mean > threshold:
+            self._num_measurements_above += 1
+        else:
+            self._num_measurements_above = 0
+
+        if self._num_measurements_above >= self._num_measurements:
+            return AnomalyEvent(
+                self._station, "Percentile band", measurement, window.mean, threshold
+            )
+
+        return None
+
+    def get_state(self) -> Dict:
+        return {"num_measurements_above": self._num_measurements_above}
+
+    def restore_state(self, state: Dict) -> None:
+        self._num_measurements_above = state["num_measurements_above"]
+
+
+class ZScoreDetector(Detector):
+    """Raised when the mean of the monitor's window is more than threshold standard
+    deviations above the mean of the station's past runs. The window mean deviates by
+    the spread between runs plus the noise of the window's measurements"""
+
+    name = "zscore"
+
+    def __init__(
+        self,
+        station: pyopensprinkler.Station,
+        baseline: Baseline,
+        threshold: float = 4.5,
+    ):
+        self._station = station
+        self._baseline = baseline
+        self._threshold = threshold
+
+    def _add(
+        self,
+        measurement: float,
+        window: station_flow.MeasurementWindow,
+        noise_variance: float,
+    ) -> Optional[AnomalyEvent]:
+        z_score = (window.mean - self._baseline.mean) / math.sqrt(
+            self._baseline.variance + noise_variance / len(window)
+        )
+
+        if z_score > self._threshold:
+            return AnomalyEvent(self._station, "Z-score", measurement, z_score, self._threshold)
+
+        return None
+
+
+# detector name -> detector class. detectors are configured by name, along with their
+# keyword arguments
+detector_types = {
+    detector_type.name: detector_type
+    for detector_type in (EwmaDetector, CusumDetector, PercentileBandDetector, ZScoreDetector)
+}
+
+
+class Factory:
+    """Creates the configured detectors for each run. A station's detectors are only
+    created once it has min_history past runs with some variance, since a baseline of
+    a few runs flags every run"""
+
+    def __init__(self, detection_config: Optional[Dict]):
+        detection_config = dict(detection_config or {})
+
+        self._min_history = detection_config.pop("min_history", 10)
+        if not isinstance(self._min_history, int) or self._min_history < 2:
+            raise ValueError("detector.detection.min_history must be a whole number of at least 2")
+
+        self._detectors_config = {}
+
+        for detector_name, detector_config in detection_config.items():
+            if detector_name not in detector_types:
+                raise ValueError(
+                    f"detector.detection.{detector_name} is not one of {sorted(detector_types)}"
+                )
+
+            self._detectors_config[detector_name] = self._get_detector_config(
+                detector_name, detector_config or {}
+            )
+
+    def _get_detector_config(self, detector_name: str, detector_config: Dict) -> Dict:
+        if not isinstance(detector_config, dict):
+            raise ValueError(f"detector.detection.{detector_name} must be a mapping")
+
+        # everything but the station and baseline is configurable
+        parameter_names = list(
+            inspect.signature(detector_types[detector_name].__init__).parameters
+        )[3:]
+
+        for field_name, value in detector_config.items():
+            if field_name not in parameter_names:
+                raise ValueError(
+                    f"detector.detection.{detector_name}.{field_name} is not one of {parameter_names}"
+                )
+
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(
+                    f"detector.detection.{detector_name}.{field_name} must be a number, got {value!r}"
+                )
+
+        return detector_config
+
+    def create(
+        self, station: pyopensprinkler.Station, baseline: Optional[Baseline]
+    ) -> List[Detector]:
+        if baseline is None or baseline.count < self._min_history or baseline.std <= 0:
+            return []
+
+        return [
+            detector_types[detector_name](station, baseline, **detector_config)
+            for detector_name, detector_config in self._detectors_config.items()
+        ]
@@ -0,0 +1,110 @@
+from typing import Callable, Dict, Optional
+
+
+class IdleFlowEvent:
+    def __init__(self, measurement: float, baseline: float, allowed_diff: float):
+        self.measurement = measurement
+        self.baseline = baseline
+        self.allowed_diff = allowed_diff
+
+    def __repr__(self):
+        return f"Measurement ({self.measurement}) while no station is running too far from idle flow ({self.baseline:.2f} +{self.allowed_diff})"
+
+
+class Monitor:
+    """Watches the flow while no station is running - a burst main line or an open tap.
+    Idle flow isn't necessarily zero (e.g. a sensor that ticks on its own), so the
+    monitor starts from the mean of the first seed_measurements idle measurements and
+    then learns it as a moving average of the measurements that aren't anomalous"""
+
+    def __init__(
+        self,
+        logger_instance,
+        allowed_diff: float,
+        num_measurements: int,
+        learning_rate: float,
+        grace_seconds: float,
+        seed_measurements: int,
+        on_event: Callable,
+    ):
+        self._logger = logger_instance
+        self._allowed_diff = allowed_diff
+        self._num_measurements = num_measurements
+        self._learning_rate = learning_rate
+        self._grace_seconds = grace_seconds
+        self._on_event = on_event
+        self._seed_measurements = seed_measurements
+        self._num_seed_measurements = 0
+        self._baseline = 0.0
+        self._num_measurements_above = 0
+        self._last_running_time = None
+
+        # only raise one alert until the flow is back to normal
+        self._event_raised = False
+
+    def set_stations_running(self, now: float) -> None:
+        """Marks that stations are running, which ends the idle period"""
+        self._last_running_time = now
+        self._num_measurements_above = 0
+
+    async def add_measurement(self, measurement: float, now: float) -> None:
+
+        # pipes drain for a while after stations stop
+        if (
+            self._last_running_time is not None
+            and now - self._last_running_time < self._grace_seconds
+        ):
+            return
+
+        # nothing is known about the idle flow yet - any steady flow (leak or not) is
+        # taken as the norm, rather than alerting on it forever
+        if self._num_seed_measurements < self._seed_measurements:
+            self._num_seed_measurements += 1
+            self._baseline += (measurement - self._baseline) / self._num_seed_measurements
+
+            if self._num_seed_measurements == self._seed_measurements:
+                self._logger.info_with("Learned idle flow", baseline=self._baseline)
+
+            return
+
+        if measurement > self._baseline + self._allowed_diff:
+            self._num_measurements_above += 1
+
+            if self._num_measurements_above >= self._num_measurements and not self._event_raised:
+                self._event_raised = True
+                await self._on_event(
+                    IdleFlowEvent(measurement, self._baseline, self._allowed_diff)
+                )
+
+            return
+
+        self._num_measurements_above = 0
+        self._event_raised = False
+
+        # learn from normal measurements only, so that a leak doesn't become the norm
+        self._baseline += self._learning_rate * (measurement - self._baseline)
+
+    def get_state(self) -> Dict:
+        return {
+            "baseline": self._baseline,
+            "num_seed_measurements": self._num_seed_measurements,
+            "event_raised": self._event_raised,
+        }
+
+    def restore_state(self, state: Optional[Dict]) -> None:
+        if state is not None:
+            self._baseline = state["baseline"]
+            self._event_raised = state.get("event_raised", False)
+
+            # snapshots that predate seeding hold a learned baseline
+            self._num_seed_measurements = state.get(
+                "num_seed_measurements", self._seed_measurements
+            )
+
+    @property
+    def baseline(self) -> float:
+        return self._baseline
+
+    @property
+    def event_raised(self) -> bool:
+        return self._event_raised
@@ -1,11 +1,44 @@
-from typing import List, Dict, Optional, Union
+from typing import FrozenSet, List, Dict, Optional, Tuple
 
 import asyncio
+import time
 import logger
 import pyopensprinkler
-import aiogram
 
+import averages
+import detection
+import idle_flow
+import log_store
+import metrics
+import notifier
+import poll_scheduler
+import sampler
+import snapshot
 import station_flow
+import thresholds
+
+
+_poll_lag_seconds = metrics.registry.histogram(
+    "leak_poll_lag_seconds",
+    "How much later than scheduled the polling loop woke up",
+    ["site"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+_station_measurements_total = metrics.registry.counter(
+    "leak_station_measurements_total",
+    "Measurements fed to station flow monitors",
+    ["site", "station"],
+)
+
+# program ids run from 1 (0 being none), and stations are indexed from 0 to less than
+# this, so that a (program, station) pair maps to a single integer
+_max_stations = 256
+
+
+def get_baseline_key(station_index: int, program_id: int = 0) -> int:
+    """Key of the averages of a station's runs by a program, or of all its runs if no
+    program is given"""
+    return program_id * _max_stations + station_index
 
 
 class Detector:
@@ -14,193 +47,508 @@ class Detector:
         logger_instance: logger.Logger,
         controller: pyopensprinkler.Controller,
         config: Dict,
+        log_store_instance: log_store.Store,
+        notification_dispatcher: Optional[notifier.Dispatcher] = None,
+        state_path: Optional[str] = None,
     ):
         self._logger = logger_instance
         self._controller = controller
         self._config = config
-        self._station_averages = None
-        self._station_flow_monitor = None
-        self._telegram_bot = self._create_telegram_bot(self._config)
+        self._log_store = log_store_instance
+        self._station_averages = averages.Accumulator(
+            self._config["detector"]["averages_history_days"] * 24 * 60 * 60
+        )
+        self._log_store_cursor = 0
+        self._station_flow_monitors = {}
+
+        # a program's runs of a station are only its baseline once there are enough of
+        # them, until then all the station's runs are
+        self._min_program_runs = self._config["detector"].get("averages_min_program_runs", 5)
+
+        # compile the station thresholds now so that configuration errors are raised
+        # when the detector is created rather than when a station starts running
+        self._thresholds = thresholds.Table(
+            self._logger, self._config["detector"]["stations"]
+        )
+        self._detection_factory = detection.Factory(self._config["detector"].get("detection"))
+        self._poll_scheduler = poll_scheduler.Scheduler(self._config["detector"])
+        self._site_name = self._config["controller"].get("name")
+        self._refresh_counter = poll_scheduler.RefreshCounter(
+            self._logger, self._site_name
+        )
+        self._sampler = sampler.Sampler(
+            self._logger,
+            self._controller,
+            self._config["detector"],
+            self._site_name,
+            self._refresh_counter,
+        )
+        self._notification_dispatcher = notification_dispatcher
+        self._idle_flow_monitor = self._create_idle_flow_monitor(self._config["detector"])
+
+        # the state of running monitors is snapshotted here so that a restart resumes
+        # their runs rather than starting over (e.g. ignoring inrush again). the state
+        # is on an sd card on most installations, so it's written rarely while stations
+        # run - and always when they start/stop or alerts are raised/cleared
+        self._state_path = state_path
+        self._snapshot_interval_seconds = self._config["detector"].get(
+            "snapshot_interval_seconds", 5 * 60
+        )
+        self._next_snapshot_time = 0.0
+        self._snapshot_station_indexes = set()
+        self._snapshot_events_raised = self._get_events_raised()
 
     async def start(self) -> None:
+        self._thresholds.warn_unknown_stations(self._controller)
+
+        # initialize averages from the logs already stored, so that monitoring can resume
+        # without waiting on the controller. only if there are none (e.g. first run) wait
+        # for the controller's logs
+        await self._fold_stored_logs()
+        if not len(self._station_averages):
+            await self._update_station_averages()
 
-        # initialize averages now
-        await self._update_station_averages()
+        # pick up where the previous process left off
+        await self._restore_state()
 
-        # periodically update averages so
+        # periodically update averages, starting now
         asyncio.create_task(self._periodically_update_station_averages())
 
-        await self._monitor_running_station()
+        await self._monitor_running_stations()
+
+    def update_config(self, config: Dict) -> None:
+        """Applies a reloaded configuration without dropping the monitors of running
+        stations. Raises (and keeps the current configuration) if the new configuration
+        is invalid. The averages' history is only read at startup"""
+        thresholds_table = thresholds.Table(self._logger, config["detector"]["stations"])
+        thresholds_table.warn_unknown_stations(self._controller)
+        detection_factory = detection.Factory(config["detector"].get("detection"))
+        scheduler = poll_scheduler.Scheduler(config["detector"])
+        idle_flow_monitor = self._create_idle_flow_monitor(config["detector"])
+
+        # keep what was learned about the idle flow
+        if idle_flow_monitor is not None and self._idle_flow_monitor is not None:
+            idle_flow_monitor.restore_state(self._idle_flow_monitor.get_state())
+
+        self._config = config
+        self._thresholds = thresholds_table
+        self._detection_factory = detection_factory
+        self._idle_flow_monitor = idle_flow_monitor
+        self._poll_scheduler = scheduler
+        self._sampler = sampler.Sampler(
+            self._logger,
+            self._controller,
+            self._config["detector"],
+            self._site_name,
+            self._refresh_counter,
+        )
+
+        # running stations carry on with the new thresholds, and the detectors they
+        # started with
+        for station_flow_monitor in self._station_flow_monitors.values():
+            station_thresholds = self._thresholds.get_thresholds(station_flow_monitor.station)
+
+            station_flow_monitor.update_thresholds(
+                station_thresholds.inrush_measurements,
+                station_thresholds.allowed_max,
+                station_thresholds.allowed_average_diff,
+                station_thresholds.expected_average_history,
+            )
+
+        self._logger.info_with(
+            "Updated detector configuration",
+            site=self._site_name,
+            num_updated_monitors=len(self._station_flow_monitors),
+        )
 
     async def _update_station_averages(self):
 
-        # start by getting the averages immediately so that we can monitor any running stations
-        logs = await self._controller.get_logs(
-            self._config["detector"]["averages_history_days"]
+        # read whatever the controller has that we don't
+        await self._log_store.update()
+        await self._fold_stored_logs()
+
+    async def _fold_stored_logs(self):
+
+        # only logs that were stored since the last update need to be folded in
+        now = time.time()
+        self._log_store_cursor, logs = await self._log_store.get_logs_after(
+            self._log_store_cursor,
+            now - self._config["detector"]["averages_history_days"] * 24 * 60 * 60,
         )
 
-        # get average uses across stations
-        self._station_averages = self._get_station_averages(logs)
+        # update average uses across stations, dropping logs that are now too old
+        self._station_averages.add(self._get_station_measurements(logs))
+        self._station_averages.expire(now)
 
         self._logger.debug_with(
-            "Updated averages", station_averages=self._station_averages
+            "Updated averages",
+            num_new_logs=len(logs),
+            station_averages=logger.Lazy(self._station_averages.to_dict),
         )
 
     async def _periodically_update_station_averages(self):
 
         while True:
 
-            # wait (in seconds)
-            await asyncio.sleep(self._config["detector"]["averages_update_interval_hours"] * 60 * 60)
-            
             # do the update
             await self._update_station_averages()
 
-    def _get_running_station(
+            # wait (in seconds)
+            await asyncio.sleep(self._config["detector"]["averages_update_interval_hours"] * 60 * 60)
+
+    def _get_running_stations(
         self,
         controller: pyopensprinkler.Controller,
-    ) -> Optional[pyopensprinkler.Station]:
-        for station in controller.stations.values():
-            if station.is_running and not station.is_master:
-                return station
+    ) -> List[pyopensprinkler.Station]:
+        return [
+            station
+            for station in controller.stations.values()
+            if station.is_running and not station.is_master
+        ]
 
-        return None
+    async def _monitor_running_stations(self) -> None:
+        next_measurement_time = 0.0
+        poll_lag_seconds = _poll_lag_seconds.labels(self._site_name)
 
-    async def _monitor_running_station(self) -> None:
         while True:
 
-            # read all program/station data
-            await self._controller.refresh()
+            # read the flow and running stations
+            await self._sampler.sample()
+
+            now = asyncio.get_running_loop().time()
+            running_station_indexes = {
+                station.index for station in self._get_running_stations(self._controller)
+            }
+
+            # feed the flow to the monitors of all running stations every measurement
+            # interval, or right away if stations started/stopped. polls in between
+            # measurements only check the absolute maximum (or the inrush peak) so that
+            # the number of measurements per run (e.g. inrush) doesn't depend on the
+            # polling rate
+            if (
+                now >= next_measurement_time
+                or running_station_indexes != set(self._station_flow_monitors)
+            ):
+                await self._update_station_flow_monitors()
+                await self._update_idle_flow_monitor(now)
+                await self._snapshot_state(now)
+                next_measurement_time = (
+                    now + self._config["detector"]["running_station_interval_seconds"]
+                )
+            else:
+                await self._check_station_flow_monitors()
+                await self._snapshot_state(now)
+
+            interval = self._poll_scheduler.get_interval(
+                self._controller,
+                self._station_flow_monitors.values(),
+                next_measurement_time - now,
+            )
 
-            # get the flow monitor for the specific running station
-            self._station_flow_monitor = self._get_station_flow_monitor(
-                self._get_running_station(self._controller)
+            # a late wake up means the event loop is busy with something else
+            sleep_start_time = asyncio.get_running_loop().time()
+            await asyncio.sleep(interval)
+            poll_lag_seconds.observe(
+                max(0.0, asyncio.get_running_loop().time() - sleep_start_time - interval)
             )
 
-            if self._station_flow_monitor is not None:
-                ticks_per_minute = (
-                    self._controller.flow_rate
-                    / self._config["controller"]["liters_per_tick"]
-                )
+    async def _update_station_flow_monitors(self) -> None:
+        running_stations = self._get_running_stations(self._controller)
+        running_station_indexes = {station.index for station in running_stations}
+
+        # retire the monitors of stations that are no longer running
+        for station_index in list(self._station_flow_monitors):
+            if station_index not in running_station_indexes:
+                self._logger.debug_with("Retiring flow monitor", station_index=station_index)
+                del self._station_flow_monitors[station_index]
+
+        for station, measurement in self._get_station_measurements_from_flow(
+            running_stations
+        ):
+            station_flow_monitor = self._get_station_flow_monitor(station)
+
+            await station_flow_monitor.add_measurement(measurement)
+            _station_measurements_total.labels(self._site_name, station.name).inc()
+
+    async def _update_idle_flow_monitor(self, now: float) -> None:
+        if self._idle_flow_monitor is None:
+            return
+
+        # the master station may be run on its own (e.g. manually), which isn't idle
+        # either
+        if any(station.is_running for station in self._controller.stations.values()):
+            self._idle_flow_monitor.set_stations_running(now)
+            return
+
+        flow_rate = self._controller.flow_rate
+        if flow_rate is None:
+            return
+
+        await self._idle_flow_monitor.add_measurement(
+            flow_rate / self._config["controller"]["liters_per_tick"], now
+        )
+
+    def _create_idle_flow_monitor(self, detector_config: Dict) -> Optional[idle_flow.Monitor]:
+        idle_config = detector_config.get("idle")
+        if idle_config is None:
+            return None
 
-                await self._station_flow_monitor.add_measurement(ticks_per_minute)
+        return idle_flow.Monitor(
+            self._logger,
+            float(idle_config["allowed_flow_rate_diff"]),
+            int(idle_config.get("num_measurements", 2)),
+            float(idle_config.get("learning_rate", 0.05)),
+            float(idle_config.get("grace_seconds", 120)),
+            int(idle_config.get("seed_measurements", 10)),
+            self._on_station_flow_monitor_event,
+        )
 
-            await asyncio.sleep(
-                self._config["detector"]["running_station_interval_seconds"]
+    async def _check_station_flow_monitors(self) -> None:
+        for station, measurement in self._get_station_measurements_from_flow(
+            self._get_running_stations(self._controller)
+        ):
+            station_flow_monitor = self._station_flow_monitors.get(station.index)
+
+            if station_flow_monitor is not None:
+                await station_flow_monitor.check_measurement(measurement)
+
+    def _get_station_measurements_from_flow(
+        self, running_stations: List[pyopensprinkler.Station]
+    ) -> List:
+        if not running_stations:
+            return []
+
+        # the controller may not report a flow (e.g. no flow sensor)
+        flow_rate = self._controller.flow_rate
+        if flow_rate is None:
+            return []
+
+        ticks_per_minute = flow_rate / self._config["controller"]["liters_per_tick"]
+
+        # the flow sensor measures the total flow of all running stations, so split it
+        # between the stations
+        return [
+            (station, ticks_per_minute * flow_share)
+            for station, flow_share in zip(
+                running_stations, self._get_station_flow_shares(running_stations)
             )
+        ]
+
+    def _get_station_flow_shares(
+        self, stations: List[pyopensprinkler.Station]
+    ) -> List[float]:
+        baseline_keys = [self._get_baseline_key(station) for station in stations]
+        equal_shares = [1.0 / len(stations)] * len(stations)
 
-    def _get_station_averages(self, logs: List) -> Dict:
-        station_averages = {}
+        if not all(baseline_key in self._station_averages for baseline_key in baseline_keys):
+            return equal_shares
 
-        # iterate over logs and group the measurements into (program_id, station_id)
-        # averaging them along the way
+        station_averages = [
+            self._station_averages.get_average(baseline_key)
+            for baseline_key in baseline_keys
+        ]
+
+        # split by the average flow of each station so that when all stations flow as
+        # usual, each of them measures its own average
+        total_station_averages = sum(station_averages)
+        if total_station_averages <= 0:
+            return equal_shares
+
+        return [
+            station_average / total_station_averages
+            for station_average in station_averages
+        ]
+
+    def _get_station_measurements(self, logs: List) -> List:
+        station_measurements = []
+
+        # group the measurements by (program_id, station_id), and by station
         for log in logs:
 
             # get items from log record
             (
-                _,
+                program_id,
                 station_index,
                 _,
-                _,
+                end_time,
                 flow_sensor_ticks_per_minute,
             ) = log
 
-            # get program/station average by program/station ids
-            station_average = station_averages.setdefault(
-                self._get_station_key(self._controller.stations[station_index]),
-                {"average_flow_sensor_ticks_per_minute": 0.0, "num_measurements": 0},
-            )
+            # skip rain delay
+            if station_index == "rd":
+                continue
 
-            # update the moving average
-            station_average["average_flow_sensor_ticks_per_minute"] = (
+            station_measurements.append(
                 (
-                    station_average["average_flow_sensor_ticks_per_minute"]
-                    * station_average["num_measurements"]
+                    end_time,
+                    get_baseline_key(station_index, program_id),
+                    flow_sensor_ticks_per_minute,
                 )
-                + flow_sensor_ticks_per_minute
-            ) / (station_average["num_measurements"] + 1)
+            )
+            station_measurements.append(
+                (end_time, get_baseline_key(station_index), flow_sensor_ticks_per_minute)
+            )
 
-            # add to number of measurements
-            station_average["num_measurements"] += 1
+        return station_measurements
 
-        return station_averages
+    def _get_baseline_key(self, station: pyopensprinkler.Station) -> int:
+        program_key = get_baseline_key(station.index, station.running_program_id)
 
-    def _get_station_flow_monitor(
-        self, station: Optional[pyopensprinkler.Station]
-    ) -> Optional[station_flow.Monitor]:
+        # the same station may flow differently under different programs (e.g. a short
+        # cycle and a deep soak), so prefer the running program's own runs
+        if self._station_averages.get_count(program_key) >= self._min_program_runs:
+            return program_key
 
-        # if there's not running station, return no monitor
-        if station is None:
-            return None
+        return get_baseline_key(station.index)
 
-        # if we're already monitoring this station, return the previously created monitor
-        if (
-            self._station_flow_monitor is not None
-            and self._station_flow_monitor.station.index == station.index
-        ):
-            return self._station_flow_monitor
+    def _get_station_flow_monitor(
+        self, station: pyopensprinkler.Station
+    ) -> station_flow.Monitor:
 
-        station_key = self._get_station_key(station)
+        # if we're already monitoring this station, return the previously created monitor
+        station_flow_monitor = self._station_flow_monitors.get(station.index)
+        if station_flow_monitor is not None:
+            return station_flow_monitor
+
+        baseline_key = self._get_baseline_key(station)
+        station_thresholds = self._thresholds.get_thresholds(station)
+
+        # a station without runs in the history (e.g. a new one, or the first run of the
+        # season) is only checked against its maximum until it has some
+        if baseline_key in self._station_averages:
+            expected_average_value = float(self._station_averages.get_average(baseline_key))
+            detectors = self._detection_factory.create(
+                station, detection.Baseline.from_accumulator(self._station_averages, baseline_key)
+            )
+        else:
+            expected_average_value = None
+            detectors = []
 
         # create a monitor
-        self._station_flow_monitor = station_flow.Monitor(
+        station_flow_monitor = station_flow.Monitor(
             self._logger,
             station,
-            int(
-                self._get_station_config_field_or_default(
-                    station_key, "num_inrush_measurements"
-                )
-            ),
-            self._get_station_config_field_or_default(
-                station_key, "allowed_flow_rate_max"
-            ),
-            self._get_station_config_field_or_default(
-                station_key, "allowed_flow_rate_diff_from_average"
-            ),
-            float(
-                self._station_averages[station_key][
-                    "average_flow_sensor_ticks_per_minute"
-                ]
+            station_thresholds.inrush_measurements,
+            station_thresholds.allowed_max,
+            station_thresholds.allowed_average_diff,
+            expected_average_value,
+            station_thresholds.expected_average_history,
+            self._on_station_flow_monitor_event,
+            detectors,
+        )
+
+        self._station_flow_monitors[station.index] = station_flow_monitor
+
+        return station_flow_monitor
+
+    async def _snapshot_state(self, now: float) -> None:
+        if self._state_path is None:
+            return
+
+        station_indexes = set(self._station_flow_monitors)
+        events_raised = self._get_events_raised()
+
+        # snapshot periodically while stations are running, and whenever stations
+        # start/stop or alerts are raised/cleared - so that a restart neither raises an
+        # alert again nor misses one. the idle flow's baseline changes slowly, so it's
+        # saved along
+        if (
+            station_indexes == self._snapshot_station_indexes
+            and events_raised == self._snapshot_events_raised
+            and (not station_indexes or now < self._next_snapshot_time)
+        ):
+            return
+
+        self._next_snapshot_time = now + self._snapshot_interval_seconds
+        self._snapshot_station_indexes = station_indexes
+        self._snapshot_events_raised = events_raised
+
+        # a run is identified by its station and the time it started
+        state = {
+            "idle_flow_monitor": (
+                self._idle_flow_monitor.get_state()
+                if self._idle_flow_monitor is not None
+                else None
             ),
-            int(
-                self._get_station_config_field_or_default(
-                    station_key, "flow_rate_average_history_meansurements"
-                )
+            "monitors": [
+                {
+                    "station_index": station_index,
+                    "start_time": station_flow_monitor.station.start_time,
+                    "monitor": station_flow_monitor.get_state(),
+                }
+                for station_index, station_flow_monitor in self._station_flow_monitors.items()
+            ]
+        }
+
+        # writing waits on the disk, so do it off the event loop
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, snapshot.write, self._state_path, state
+            )
+        except OSError as e:
+            self._logger.warn_with("Failed to snapshot state", error=str(e))
+
+    def _get_events_raised(self) -> Tuple[bool, FrozenSet[int]]:
+        """Returns whether the idle flow monitor raised an alert, and the indexes of the
+        stations whose runs did"""
+        return (
+            self._idle_flow_monitor is not None and self._idle_flow_monitor.event_raised,
+            frozenset(
+                station_index
+                for station_index, station_flow_monitor in self._station_flow_monitors.items()
+                if station_flow_monitor.event_raised
             ),
-            self._on_station_flow_monitor_event,
         )
 
-        return self._station_flow_monitor
+    async def _restore_state(self) -> None:
+        if self._state_path is None:
+            return
 
-    def _get_station_config_field_or_default(
-        self, station_key: str, field_name: str
-    ) -> Union[float, int]:
-        default_station_config = self._config["detector"]["stations"].get("default")
-        station_config = (
-            self._config["detector"]["stations"].get(station_key)
-            or default_station_config
+        state = await asyncio.get_running_loop().run_in_executor(
+            None, snapshot.read, self._state_path
         )
+        if state is None:
+            return
 
-        if station_config.get(field_name) is None:
-            return default_station_config[field_name]
+        if self._idle_flow_monitor is not None:
+            self._idle_flow_monitor.restore_state(state.get("idle_flow_monitor"))
 
-        return station_config[field_name]
+        for monitor_state in state["monitors"]:
+            station = self._controller.stations.get(monitor_state["station_index"])
 
-    def _get_station_key(self, station) -> str:
-        return station.name.lower().replace(" ", "_")
+            # only resume runs that are still going
+            if (
+                station is None
+                or not station.is_running
+                or station.is_master
+                or station.start_time != monitor_state["start_time"]
+            ):
+                continue
 
-    def _create_telegram_bot(self, config: Dict) -> Optional[aiogram.Bot]:
-        if "telegram" in config:
-            self._logger.debug("Creating Telegram bot")
-            return aiogram.Bot(config["telegram"]["token"])
+            self._get_station_flow_monitor(station).restore_state(monitor_state["monitor"])
 
-        return None
+        # the snapshot holds the alerts raised so far
+        self._snapshot_events_raised = self._get_events_raised()
+
+        self._logger.debug_with(
+            "Restored state",
+            num_monitors=len(state["monitors"]),
+            num_restored_monitors=len(self._station_flow_monitors),
+        )
 
     async def _on_station_flow_monitor_event(self, event: object) -> None:
 
-        # if there's a telegram bot configured, sent the message
-        if self._telegram_bot is not None:
-            self._logger.debug_with("Sending message to Telegram", msg=str(event))
-            await self._telegram_bot.send_message(
-                chat_id=self._config["telegram"]["chat_id"], text=str(event)
-            )
+        # if there's a dispatcher, queue the notification. delivery happens in the
+        # background so this never waits on Telegram
+        if self._notification_dispatcher is not None:
+            self._logger.debug_with("Queueing notification", msg=logger.Lazy(str, event))
+            self._notification_dispatcher.notify(self._get_notification_text(event))
+
+    def _get_notification_text(self, event: object) -> str:
+        controller_name = self._config["controller"].get("name")
+
+        # notifications of several controllers may be sent to the same chat
+        if controller_name is None:
+            return str(event)
+
+        return f"{controller_name}: {event}"
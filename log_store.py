@@ -0,0 +1,250 @@
+from typing import List, Optional, Tuple
+
+import asyncio
+import concurrent.futures
+import math
+import os
+import sqlite3
+import time
+
+import logger
+import pyopensprinkler
+
+
+# bumped whenever the schema changes in a way that requires existing databases to be
+# migrated on open
+_SCHEMA_VERSION = 1
+
+
+class Store:
+    def __init__(
+        self,
+        logger_instance: logger.Logger,
+        controller: pyopensprinkler.Controller,
+        directory: str,
+        initial_history_days: int,
+    ):
+        self._logger = logger_instance
+        self._controller = controller
+        self._path = os.path.join(directory, "logs.sqlite3")
+        self._initial_history_days = initial_history_days
+        self._update_lock = asyncio.Lock()
+
+        # sqlite connections are bound to the thread that created them, so run all
+        # database work in a single dedicated thread
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._connection = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    async def get_logs(self, days: int) -> List:
+
+        # read whatever the controller has that we don't
+        await self.update()
+
+        return await self.get_logs_range(time.time() - days * 24 * 60 * 60)
+
+    async def get_logs_range(
+        self, start_time: float, end_time: Optional[float] = None
+    ) -> List:
+        return await self._run(self._select_logs, start_time, end_time)
+
+    async def get_daily_rollups(self, days: int) -> List:
+        """Returns a [day, station, flow_sensor_ticks, flow_sensor_ticks_per_minute,
+        num_logs] record per station per local day over the last days, after reading
+        whatever the controller has that we don't. flow_sensor_ticks_per_minute is the
+        sum over the day's runs"""
+        await self.update()
+
+        return await self._run(
+            self._select_daily_rollups, time.time() - days * 24 * 60 * 60
+        )
+
+    async def get_logs_after(
+        self, cursor: int, start_time: float
+    ) -> Tuple[int, List]:
+        """Returns the logs stored since the given cursor (0 for all logs) that ended at or
+        after start_time, along with the cursor to pass on the next call"""
+        return await self._run(self._select_logs_after, cursor, start_time)
+
+    async def update(self) -> None:
+
+        # the detector and report generator may update at the same time - only one
+        # of them needs to hit the controller
+        async with self._update_lock:
+            last_end_time = await self._run(self._select_last_end_time)
+
+            if last_end_time is None:
+                days = self._initial_history_days
+            else:
+
+                # read an extra day so that nothing is lost at the edges, records we
+                # already have are ignored
+                days = math.ceil((time.time() - last_end_time) / (24 * 60 * 60)) + 1
+                days = max(1, min(days, self._initial_history_days))
+
+            self._logger.debug_with(
+                "Updating log store", last_end_time=last_end_time, days=days
+            )
+
+            logs = await self._controller.get_logs(days)
+            num_inserted = await self._run(self._insert_logs, logs)
+
+            self._logger.debug_with(
+                "Updated log store", num_read=len(logs), num_inserted=num_inserted
+            )
+
+    async def close(self) -> None:
+        await self._run(self._close)
+        self._executor.shutdown()
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, function, *args
+        )
+
+    def _get_connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._path)
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS logs (
+                    program INTEGER NOT NULL,
+                    station NOT NULL,
+                    duration_seconds INTEGER NOT NULL,
+                    end_time INTEGER NOT NULL,
+                    flow_sensor_ticks_per_minute REAL NOT NULL,
+                    UNIQUE (program, station, duration_seconds, end_time)
+                )
+                """
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS logs_end_time ON logs (end_time)"
+            )
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS daily_rollups (
+                    day TEXT NOT NULL,
+                    station INTEGER NOT NULL,
+                    flow_sensor_ticks REAL NOT NULL,
+                    flow_sensor_ticks_per_minute REAL NOT NULL,
+                    num_logs INTEGER NOT NULL,
+                    PRIMARY KEY (day, station)
+                )
+                """
+            )
+
+            # roll up records per local day of the run's start as they're stored, so
+            # that reports needn't read the raw history. the trigger only fires for
+            # records that were actually inserted, so records read again are ignored
+            self._connection.execute(
+                """
+                CREATE TRIGGER IF NOT EXISTS logs_daily_rollups AFTER INSERT ON logs
+                WHEN NEW.program != 99 AND NEW.station != 'rd'
+                BEGIN
+                    INSERT INTO daily_rollups VALUES (
+                        date(NEW.end_time - NEW.duration_seconds, 'unixepoch', 'localtime'),
+                        NEW.station,
+                        NEW.flow_sensor_ticks_per_minute * NEW.duration_seconds / 60.0,
+                        NEW.flow_sensor_ticks_per_minute,
+                        1
+                    )
+                    ON CONFLICT (day, station) DO UPDATE SET
+                        flow_sensor_ticks = flow_sensor_ticks + excluded.flow_sensor_ticks,
+                        flow_sensor_ticks_per_minute = flow_sensor_ticks_per_minute + excluded.flow_sensor_ticks_per_minute,
+                        num_logs = num_logs + excluded.num_logs;
+                END
+                """
+            )
+
+            self._migrate()
+
+        return self._connection
+
+    def _migrate(self) -> None:
+        schema_version = self._connection.execute("PRAGMA user_version").fetchone()[0]
+        if schema_version >= _SCHEMA_VERSION:
+            return
+
+        self._logger.info_with(
+            "Migrating log store", path=self._path, schema_version=schema_version
+        )
+
+        # databases created before the rollups existed need them built from the logs
+        with self._connection:
+            self._connection.execute("DELETE FROM daily_rollups")
+            self._connection.execute(
+                """
+                INSERT INTO daily_rollups
+                SELECT
+                    date(end_time - duration_seconds, 'unixepoch', 'localtime') AS day,
+                    station,
+                    SUM(flow_sensor_ticks_per_minute * duration_seconds / 60.0),
+                    SUM(flow_sensor_ticks_per_minute),
+                    COUNT(*)
+                FROM logs WHERE program != 99 AND station != 'rd'
+                GROUP BY day, station
+                """
+            )
+            self._connection.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _select_last_end_time(self) -> Optional[int]:
+        return self._get_connection().execute("SELECT MAX(end_time) FROM logs").fetchone()[0]
+
+    def _select_logs(self, start_time: float, end_time: Optional[float]) -> List:
+        if end_time is None:
+            end_time = math.inf
+
+        cursor = self._get_connection().execute(
+            """
+            SELECT program, station, duration_seconds, end_time, flow_sensor_ticks_per_minute
+            FROM logs WHERE end_time >= ? AND end_time <= ? ORDER BY end_time, rowid
+            """,
+            (start_time, end_time),
+        )
+
+        return [list(row) for row in cursor]
+
+    def _select_daily_rollups(self, start_time: float) -> List:
+        cursor = self._get_connection().execute(
+            """
+            SELECT day, station, flow_sensor_ticks, flow_sensor_ticks_per_minute, num_logs
+            FROM daily_rollups WHERE day >= date(?, 'unixepoch', 'localtime')
+            ORDER BY day, station
+            """,
+            (start_time,),
+        )
+
+        return [list(row) for row in cursor]
+
+    def _select_logs_after(self, cursor: int, start_time: float) -> Tuple[int, List]:
+        connection = self._get_connection()
+
+        rows = connection.execute(
+            """
+            SELECT rowid, program, station, duration_seconds, end_time, flow_sensor_ticks_per_minute
+            FROM logs WHERE rowid > ? AND end_time >= ? ORDER BY rowid
+            """,
+            (cursor, start_time),
+        ).fetchall()
+
+        # the cursor moves past everything stored so far, even records that were too old
+        last_row_id = connection.execute("SELECT MAX(rowid) FROM logs").fetchone()[0]
+
+        return max(cursor, last_row_id or 0), [list(row[1:]) for row in rows]
+
+    def _insert_logs(self, logs: List) -> int:
+        connection = self._get_connection()
+
+        # the cursor's row count excludes rows written by the rollups trigger
+        with connection:
+            cursor = connection.executemany(
+                "INSERT OR IGNORE INTO logs VALUES (?, ?, ?, ?, ?)", logs
+            )
+
+            return cursor.rowcount
@@ -1,4 +1,29 @@
+import json
 import logging
+import logging.handlers
+import queue
+
+
+class Lazy(object):
+    """A field whose value is only computed if the record is actually emitted"""
+
+    def __init__(self, function, *args):
+        self._function = function
+        self._args = args
+
+    def __call__(self):
+        return self._function(*self._args)
+
+
+def _get_record_with(record):
+    record_with = getattr(record, 'with', {})
+
+    # evaluate lazy fields, once
+    for key, value in record_with.items():
+        if isinstance(value, Lazy):
+            record_with[key] = value()
+
+    return record_with
 
 
 class HumanReadableFormatter(logging.Formatter):
@@ -7,7 +32,7 @@ class HumanReadableFormatter(logging.Formatter):
         super(HumanReadableFormatter, self).__init__()
 
     def format(self, record):
-        record_with = getattr(record, 'with', {})
+        record_with = _get_record_with(record)
         if record_with:
             more = ': {0}'.format(record_with)
         else:
@@ -19,6 +44,41 @@ class HumanReadableFormatter(logging.Formatter):
                                          more)
 
 
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a single line JSON document, for log collectors"""
+
+    def __init__(self):
+        super(JsonFormatter, self).__init__()
+
+    def format(self, record):
+        document = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname.lower(),
+            'message': record.getMessage(),
+        }
+
+        record_with = _get_record_with(record)
+        if record_with:
+            document['with'] = record_with
+
+        if record.exc_info:
+            document['exception'] = self.formatException(record.exc_info)
+
+        # values that aren't JSON serializable are logged as their string form
+        return json.dumps(document, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+
+        # lazy fields refer to state owned by the logging thread, so evaluate them
+        # before the record is handed to the listener's thread
+        _get_record_with(record)
+
+        return super(_QueueHandler, self).prepare(record)
+
+
 class Logger(object):
 
     def __init__(self, level='DEBUG'):
@@ -26,7 +86,7 @@ class Logger(object):
         self._logger.setLevel(level)
         self._handlers = {}
 
-    def set_handler(self, handler_name, file, formatter):
+    def set_handler(self, handler_name, file, formatter, asynchronous=False):
 
         # check if there's a handler by this name
         if handler_name in self._handlers:
@@ -34,7 +94,7 @@ class Logger(object):
             # log that we're removing it
             self.info_with('Replacing logger output')
 
-            self._logger.removeHandler(self._handlers[handler_name])
+            self._remove_handler(handler_name)
 
         # create a stream handler from the file
         stream_handler = logging.StreamHandler(file)
@@ -42,11 +102,41 @@ class Logger(object):
         # set the formatter
         stream_handler.setFormatter(formatter)
 
+        # when asynchronous, records are queued and written by a listener thread so
+        # that writing never blocks the caller (e.g. the event loop)
+        if asynchronous:
+            listener = logging.handlers.QueueListener(queue.SimpleQueue(), stream_handler)
+            listener.start()
+
+            handler = _QueueHandler(listener.queue)
+        else:
+            listener = None
+            handler = stream_handler
+
         # add the handler to the logger
-        self._logger.addHandler(stream_handler)
+        self._logger.addHandler(handler)
 
         # save as the named output
-        self._handlers[handler_name] = stream_handler
+        self._handlers[handler_name] = (handler, listener)
+
+    def close(self):
+
+        # flush whatever's queued in asynchronous handlers
+        for handler_name in list(self._handlers):
+            self._remove_handler(handler_name)
+
+    def _remove_handler(self, handler_name):
+        handler, listener = self._handlers.pop(handler_name)
+
+        self._logger.removeHandler(handler)
+
+        if listener is not None:
+            listener.stop()
+
+    @property
+    def debug_enabled(self):
+        """Lets hot paths skip building log fields altogether"""
+        return self._logger.isEnabledFor(logging.DEBUG)
 
     def debug(self, message, *args):
         self._logger.debug(message, *args)
@@ -60,14 +150,21 @@ class Logger(object):
     def error(self, message, *args):
         self._logger.error(message, *args)
 
+    # the level is checked before the fields are wrapped in a record. fields may be
+    # Lazy, in which case they're only evaluated if the record is emitted
+
     def debug_with(self, message, *args, **kw_args):
-        self._logger.debug(message, *args, extra={'with': kw_args})
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(message, *args, extra={'with': kw_args})
 
     def info_with(self, message, *args, **kw_args):
-        self._logger.info(message, *args, extra={'with': kw_args})
+        if self._logger.isEnabledFor(logging.INFO):
+            self._logger.info(message, *args, extra={'with': kw_args})
 
     def warn_with(self, message, *args, **kw_args):
-        self._logger.warning(message, *args, extra={'with': kw_args})
+        if self._logger.isEnabledFor(logging.WARNING):
+            self._logger.warning(message, *args, extra={'with': kw_args})
 
     def error_with(self, message, *args, **kw_args):
-        self._logger.error(message, *args, extra={'with': kw_args})
\ No newline at end of file
+        if self._logger.isEnabledFor(logging.ERROR):
+            self._logger.error(message, *args, extra={'with': kw_args})
@@ -1,7 +1,9 @@
-from logging import root
-from typing import Dict
+from typing import Dict, List, Optional, Tuple
 
+import aiohttp
 import asyncio
+import datetime
+import os
 import uvloop
 import logger
 import sys
@@ -11,95 +13,304 @@ import pyopensprinkler
 import aiocron
 import signal
 import functools
+import importlib
 import traceback
 
 import leak
-import report
+import log_store
+import metrics
+import notifier
+
+
+class _Site:
+    def __init__(self, name: Optional[str], config: Dict):
+        self.name = name
+        self.config = config
+        self.controller = None
+        self.log_store = None
+        self.notification_dispatcher = None
+        self.detector = None
 
 
 class Leak:
     def __init__(self, root_logger: logger.Logger, args: argparse.Namespace):
         self._logger = root_logger
-        self._leak_detector = None
-        self._report_generator = None
+        self._http_session = None
+        self._notification_dispatchers = {}
+        self._metrics_server = None
+        self._config_path = args.config_path
+        self._config = self._read_config()
+        self._sites = [
+            _Site(name, config) for name, config in self._get_site_configs(self._config)
+        ]
+
+    async def start(self) -> None:
+        self._logger.debug("Starting")
+
+        # serve metrics, if configured
+        if "metrics" in self._config:
+            self._metrics_server = metrics.Server(
+                self._logger,
+                metrics.registry,
+                self._config["metrics"].get("host", "0.0.0.0"),
+                self._config["metrics"]["port"],
+            )
+            await self._metrics_server.start()
+
+        # all controllers share a single connection pool
+        self._http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self._config.get("http", {}).get("max_connections", 10)
+            )
+        )
+
+        for site in self._sites:
+            self._create_site_controller(site)
+            self._create_site_notification_dispatcher(site)
+
+            # do the initial refresh
+            await site.controller.refresh()
+
+            # create a leak detector, validating its configuration before detection starts
+            site.detector = leak.Detector(
+                self._logger,
+                site.controller,
+                site.config,
+                site.log_store,
+                site.notification_dispatcher,
+                os.path.join(self._get_site_directory(site), "detector_state.json"),
+            )
+
+        # detect leaks, staggering the sites so that they don't all poll at the same time
+        for site_index, site in enumerate(self._sites):
+            asyncio.create_task(
+                self._detect_leaks(
+                    site,
+                    site_index
+                    * site.config["detector"]["running_station_interval_seconds"]
+                    / len(self._sites),
+                )
+            )
 
-        # create logger
+        # create reports - once detection is running
+        asyncio.create_task(self._generate_periodic_reports())
+
+    async def stop(self) -> None:
+        self._logger.debug("Stopping")
+
+        for site in self._sites:
+            if site.log_store is not None:
+                await site.log_store.close()
+
+        for notification_dispatcher in self._notification_dispatchers.values():
+            await notification_dispatcher.stop()
+
+        if self._http_session is not None:
+            await self._http_session.close()
+
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+
+    def reload_config(self) -> None:
+        """Re-reads the configuration and applies it to the running detectors, leaving
+        monitors of running stations in place. Only the detector stanza is reloaded and
+        sites are matched by name - anything else (e.g. adding a controller) requires a
+        restart"""
+        try:
+            config = self._read_config()
+            site_configs = dict(self._get_site_configs(config))
+        except Exception as e:
+            self._logger.warn_with("Failed to reload configuration", error=str(e))
+            return
+
+        for site in self._sites:
+            site_config = site_configs.pop(site.name, None)
+
+            if site_config is None:
+                self._logger.warn_with("Site removed from configuration, ignoring", site=site.name)
+                continue
+
+            # detectors are created once the initial refresh is done
+            if site.detector is None:
+                continue
+
+            # an invalid configuration (of any shape - a missing key, a wrong type) is
+            # logged and the site keeps running with the configuration it has
+            try:
+                # only the detector stanza is reloaded
+                site_config = dict(site.config, detector=site_config["detector"])
+                site.detector.update_config(site_config)
+            except Exception as e:
+                self._logger.warn_with(
+                    "Invalid detector configuration, not reloading",
+                    site=site.name,
+                    error=str(e),
+                )
+                continue
+
+            site.config = site_config
+
+        for site_name in site_configs:
+            self._logger.warn_with("Site added to configuration, ignoring", site=site_name)
+
+    def _read_config(self) -> Dict:
         self._logger.debug_with(
-            "Reading configuration", config_file_path=args.config_path
+            "Reading configuration", config_file_path=self._config_path
         )
 
-        with open(args.config_path, "r") as config_file:
-            self._config = yaml.load(config_file, Loader=yaml.Loader)
+        with open(self._config_path, "r") as config_file:
+            return yaml.load(config_file, Loader=yaml.Loader)
+
+    def _get_site_configs(self, config: Dict) -> List[Tuple[Optional[str], Dict]]:
+
+        # a single controller stanza is a single, unnamed site
+        if "controller" in config:
+            return [(None, config)]
+
+        site_configs = []
+
+        for controller_config in config["controllers"]:
+            site_config = dict(config)
+            del site_config["controllers"]
+            site_config["controller"] = controller_config
+
+            # sections may be overridden per controller
+            for section_name in ["detector", "report", "telegram"]:
+                if section_name in controller_config:
+                    site_config[section_name] = controller_config[section_name]
+
+            site_configs.append((controller_config["name"], site_config))
+
+        return site_configs
+
+    def _create_site_controller(self, site: _Site) -> None:
 
         # create a controller
-        root_logger.debug_with(
-            "Creating controller", url=self._config["controller"]["url"]
+        self._logger.debug_with(
+            "Creating controller", name=site.name, url=site.config["controller"]["url"]
         )
-        self._controller = pyopensprinkler.Controller(
-            self._config["controller"]["url"], self._config["controller"]["password"]
+        site.controller = pyopensprinkler.Controller(
+            site.config["controller"]["url"],
+            site.config["controller"]["password"],
+            {"session": self._http_session},
         )
 
-    async def start(self) -> None:
-        self._logger.debug("Starting")
+        # create a log store, shared by the detector and the report generator
+        site.log_store = log_store.Store(
+            self._logger,
+            site.controller,
+            self._get_site_directory(site),
+            max(
+                site.config["detector"]["averages_history_days"],
+                site.config["report"]["generator"]["history_days"],
+            ),
+        )
 
-        # do the initial refresh
-        await self._controller.refresh()
+    def _get_site_directory(self, site: _Site) -> str:
+        directory = self._config.get("log_store", {}).get("directory", "/leak/data")
 
-        # detect leaks
-        asyncio.create_task(self._detect_leaks())
+        # each named site keeps its data in its own directory
+        if site.name is not None:
+            directory = os.path.join(directory, site.name)
 
-        # create reports
-        asyncio.create_task(self._generate_periodic_reports())
+        return directory
 
-    async def stop(self) -> None:
-        self._logger.debug("Stopping")
-        await self._controller.session_close()
+    def _create_site_notification_dispatcher(self, site: _Site) -> None:
+        telegram_config = site.config.get("telegram")
+        if telegram_config is None:
+            return
 
-    async def _detect_leaks(self) -> None:
+        # sites notifying the same chat share a dispatcher, so that their notifications
+        # are merged and the chat's rate limit is respected
+        chat_key = (telegram_config["token"], telegram_config["chat_id"])
 
-        self._logger.debug_with("Starting leak detection")
+        if chat_key not in self._notification_dispatchers:
+            self._logger.debug_with("Creating notification dispatcher", site=site.name)
 
-        # create a leak detector
-        detector = leak.Detector(self._logger, self._controller, self._config)
+            notification_dispatcher = notifier.Dispatcher(
+                self._logger, self._http_session, telegram_config
+            )
+            notification_dispatcher.start()
+
+            self._notification_dispatchers[chat_key] = notification_dispatcher
+
+        site.notification_dispatcher = self._notification_dispatchers[chat_key]
+
+    async def _detect_leaks(self, site: _Site, start_delay_seconds: float) -> None:
+        await asyncio.sleep(start_delay_seconds)
+
+        self._logger.debug_with("Starting leak detection", site=site.name)
 
         # start detection
-        await detector.start()
+        await site.detector.start()
 
     async def _generate_periodic_reports(self) -> None:
-        temporary_file_name = "/tmp/os-temp.pdf"
         self._logger.debug_with(
             "Periodically creating reports", schedule=self._config["report"]["schedule"]
         )
 
-        # create a report generator and emailer
-        generator = report.Generator(self._controller)
+        # the reporting stack (pandas, matplotlib, sendgrid) takes a long time to import
+        # and isn't needed to detect leaks. import it in a thread so that detection isn't
+        # held back by it
+        report = await asyncio.get_running_loop().run_in_executor(
+            None, importlib.import_module, "report"
+        )
+
+        self._logger.debug("Imported reporting")
+
+        # create a report generator per site and a single emailer
+        generators = [
+            report.Generator(
+                site.controller,
+                site.log_store,
+                site.config["report"]["generator"].get("reports_per_worker", 4),
+                site.config["report"]["generator"].get("dpi", 600),
+            )
+            for site in self._sites
+        ]
         emailer = report.Emailer(
             self._config["sendgrid"]["from_email_address"],
             self._config["sendgrid"]["api_key"],
         )
 
-        while True:
+        try:
+            while True:
 
-            # wait until next schedule
-            await aiocron.crontab(self._config["report"]["schedule"]).next()
+                # wait until next schedule
+                await aiocron.crontab(self._config["report"]["schedule"]).next()
 
-            self._logger.debug_with(
-                "Sending report",
-                history=self._config["report"]["generator"]["history_days"],
-                to=self._config["report"]["emailer"]["to_email_address"],
-            )
+                # generate the reports one after the other
+                for site, generator in zip(self._sites, generators):
+                    self._logger.debug_with(
+                        "Sending report",
+                        site=site.name,
+                        history=site.config["report"]["generator"]["history_days"],
+                        to=site.config["report"]["emailer"]["to_email_address"],
+                    )
 
-            # generate a report @ tmp file and create a description
-            weekly_description = await generator.generate(
-                self._config["report"]["generator"]["history_days"], temporary_file_name
-            )
+                    # generate a report in memory and create a description
+                    report_contents, weekly_description = await generator.generate(
+                        site.config["report"]["generator"]["history_days"]
+                    )
 
-            # email the report
-            await emailer.send_report(
-                temporary_file_name,
-                self._config["report"]["emailer"]["to_email_address"],
-                contents=weekly_description,
-            )
+                    # email the report
+                    await emailer.send_report(
+                        report_contents,
+                        site.config["report"]["emailer"]["to_email_address"],
+                        subject=self._get_report_subject(site),
+                        contents=weekly_description,
+                    )
+        finally:
+
+            # shut down the rendering workers
+            for generator in generators:
+                generator.close()
+
+    def _get_report_subject(self, site: _Site) -> Optional[str]:
+        if site.name is None:
+            return None
+
+        return f"OpenSprinkler Report for {site.name} for {datetime.date.today()}"
 
 
 async def _shutdown(
@@ -142,22 +353,38 @@ def _handle_exception(
 
 def _register_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
     parser.add_argument("--config-path", required=True)
+    parser.add_argument("--log-format", choices=["human", "json"], default="human")
+    parser.add_argument(
+        "--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], type=str.upper, default="INFO"
+    )
 
     return parser
 
 
 if __name__ == "__main__":
-    root_logger = logger.Logger(level="DEBUG")
-    root_logger.set_handler("stdout", sys.stdout, logger.HumanReadableFormatter())
-
     parser = _register_arguments(argparse.ArgumentParser())
+    args = parser.parse_args()
+
+    # write logs from a separate thread so that the event loop never waits on stdout
+    root_logger = logger.Logger(level=args.log_level)
+    root_logger.set_handler(
+        "stdout",
+        sys.stdout,
+        logger.JsonFormatter() if args.log_format == "json" else logger.HumanReadableFormatter(),
+        asynchronous=True,
+    )
+
     uvloop.install()
 
-    loop = asyncio.get_event_loop()
-    leak_instance = Leak(root_logger, parser.parse_args())
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    leak_instance = Leak(root_logger, args)
+
+    # reload the configuration on SIGHUP, without restarting
+    loop.add_signal_handler(signal.SIGHUP, leak_instance.reload_config)
 
     # register common signals
-    shutdown_signals = (signal.SIGHUP, signal.SIGTERM, signal.SIGINT)
+    shutdown_signals = (signal.SIGTERM, signal.SIGINT)
     for shutdown_signal in shutdown_signals:
         loop.add_signal_handler(
             shutdown_signal,
@@ -178,3 +405,4 @@ if __name__ == "__main__":
     finally:
         root_logger.debug("Shutting down")
         loop.close()
+        root_logger.close()
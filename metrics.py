@@ -0,0 +1,254 @@
+from typing import Callable, List, Optional, Sequence
+
+import aiohttp.web
+import bisect
+import math
+import resource
+
+import logger
+
+
+# latency buckets, in seconds, from a few milliseconds (a controller refresh on the
+# local network) to minutes (rendering a 600 dpi report on a pi)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class _Counter:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def get_samples(self, name: str, labels: str) -> List[str]:
+        return [f"{name}{labels} {_format_value(self.value)}"]
+
+
+class _Gauge:
+    def __init__(self, function: Optional[Callable[[], float]] = None):
+        self.value = 0.0
+        self._function = function
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def get_samples(self, name: str, labels: str) -> List[str]:
+        value = self._function() if self._function is not None else self.value
+        return [f"{name}{labels} {_format_value(value)}"]
+
+
+class _Histogram:
+    def __init__(self, buckets: Sequence[float]):
+        self._buckets = buckets
+        self._bucket_counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+
+    def observe(self, value: float) -> None:
+        self._bucket_counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+        self._count += 1
+
+    def get_samples(self, name: str, labels: str) -> List[str]:
+        samples = []
+        cumulative_count = 0
+
+        # buckets are cumulative, the last (+Inf) one counts everything
+        for bucket, bucket_count in zip(
+            list(self._buckets) + [math.inf], self._bucket_counts
+        ):
+            cumulative_count += bucket_count
+            bucket_labels = _join_labels(labels, f'le="{_format_value(bucket)}"')
+            samples.append(f"{name}_bucket{bucket_labels} {cumulative_count}")
+
+        samples.append(f"{name}_sum{labels} {_format_value(self._sum)}")
+        samples.append(f"{name}_count{labels} {self._count}")
+
+        return samples
+
+
+class Metric:
+    """A named metric, with a child (counter, gauge or histogram) per combination of
+    label values"""
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        metric_type: str,
+        label_names: Sequence[str],
+        create_child: Callable,
+    ):
+        self.name = name
+        self._help_text = help_text
+        self._metric_type = metric_type
+        self._label_names = tuple(label_names)
+        self._create_child = create_child
+        self._children = {}
+
+        # a metric without labels has a single child
+        if not self._label_names:
+            self._children[()] = create_child()
+
+    def labels(self, *label_values) -> object:
+        label_values = tuple("" if value is None else str(value) for value in label_values)
+
+        child = self._children.get(label_values)
+        if child is None:
+            child = self._children[label_values] = self._create_child()
+
+        return child
+
+    # shortcuts for metrics without labels
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._children[()].inc(amount)
+
+    def set(self, value: float) -> None:
+        self._children[()].set(value)
+
+    def observe(self, value: float) -> None:
+        self._children[()].observe(value)
+
+    def get_lines(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self._help_text}",
+            f"# TYPE {self.name} {self._metric_type}",
+        ]
+
+        for label_values, child in self._children.items():
+            labels = ",".join(
+                f'{label_name}="{_escape_label_value(label_value)}"'
+                for label_name, label_value in zip(self._label_names, label_values)
+            )
+            lines.extend(child.get_samples(self.name, f"{{{labels}}}" if labels else ""))
+
+        return lines
+
+
+class Registry:
+    """Holds metrics and renders them in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name: str, help_text: str, label_names: Sequence[str] = ()) -> Metric:
+        return self._register(Metric(name, help_text, "counter", label_names, _Counter))
+
+    def gauge(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str] = (),
+        function: Optional[Callable[[], float]] = None,
+    ) -> Metric:
+        """A gauge is either set, or read through function whenever it's collected"""
+        return self._register(
+            Metric(name, help_text, "gauge", label_names, lambda: _Gauge(function))
+        )
+
+    def histogram(
+        self,
+        name: str,
+        help_text: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Metric:
+        buckets = tuple(sorted(buckets))
+        return self._register(
+            Metric(name, help_text, "histogram", label_names, lambda: _Histogram(buckets))
+        )
+
+    def get_metric(self, name: str) -> Metric:
+        return self._metrics[name]
+
+    def get_text(self) -> str:
+        lines = []
+
+        for metric in self._metrics.values():
+            lines.extend(metric.get_lines())
+
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+
+        self._metrics[metric.name] = metric
+
+        return metric
+
+
+class Server:
+    """Serves a registry's metrics over http from the running event loop"""
+
+    def __init__(
+        self,
+        logger_instance: logger.Logger,
+        registry_instance: Registry,
+        host: str,
+        port: int,
+    ):
+        self._logger = logger_instance
+        self._registry = registry_instance
+        self._host = host
+        self._port = port
+        self._runner = None
+
+    async def start(self) -> None:
+        app = aiohttp.web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self._runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, self._host, self._port).start()
+
+        self._logger.debug_with("Serving metrics", host=self._host, port=self._port)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_metrics(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        return aiohttp.web.Response(
+            text=self._registry.get_text(), content_type="text/plain", charset="utf-8"
+        )
+
+
+def _get_rss_bytes() -> float:
+
+    # current rss where procfs is available, otherwise the peak rss
+    try:
+        with open("/proc/self/statm", "r") as statm_file:
+            return float(int(statm_file.read().split()[1]) * resource.getpagesize())
+    except OSError:
+        return float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+
+    return repr(float(value))
+
+
+def _join_labels(labels: str, label: str) -> str:
+    if not labels:
+        return f"{{{label}}}"
+
+    return f"{labels[:-1]},{label}}}"
+
+
+def _escape_label_value(label_value: str) -> str:
+    return label_value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+# the registry the process' metrics are registered with
+registry = Registry()
+
+process_resident_memory_bytes = registry.gauge(
+    "leak_process_resident_memory_bytes",
+    "Resident memory of the process",
+    function=_get_rss_bytes,
+)
@@ -0,0 +1,258 @@
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import asyncio
+import collections
+import time
+
+import logger
+import metrics
+
+
+_notification_delivery_seconds = metrics.registry.histogram(
+    "leak_notification_delivery_seconds",
+    "Time from queueing a notification until Telegram accepted it",
+)
+_notifications_total = metrics.registry.counter(
+    "leak_notifications_total",
+    "Notifications by outcome - sent, dropped (queue full) or failed (all attempts failed)",
+    ["result"],
+)
+_notification_queue_depth = metrics.registry.gauge(
+    "leak_notification_queue_depth",
+    "Notifications waiting to be sent",
+    ["chat_id"],
+)
+
+
+class _Notification:
+    def __init__(self, text: str):
+        self.text = text
+        self.enqueue_time = time.monotonic()
+
+
+class Dispatcher:
+    """Delivers notifications to a Telegram chat. Notifications are queued (up to a
+    bound, beyond which they're dropped rather than hold up detection), merged into a
+    single message while waiting for the chat's rate limit and retried with an
+    exponential backoff"""
+
+    # telegram rejects longer messages
+    _max_message_length = 4096
+
+    def __init__(
+        self,
+        logger_instance: logger.Logger,
+        http_session: aiohttp.ClientSession,
+        telegram_config: Dict,
+    ):
+        self._logger = logger_instance
+        self._http_session = http_session
+        self._url = "{0}/bot{1}/sendMessage".format(
+            telegram_config.get("api_url", "https://api.telegram.org"),
+            telegram_config["token"],
+        )
+        self._chat_id = telegram_config["chat_id"]
+        self._batch_delay_seconds = telegram_config.get("batch_delay_seconds", 1.0)
+        self._min_send_interval_seconds = telegram_config.get(
+            "min_send_interval_seconds", 1.0
+        )
+        self._max_attempts = telegram_config.get("max_attempts", 8)
+        self._retry_delay_seconds = telegram_config.get("retry_delay_seconds", 1.0)
+        self._max_retry_delay_seconds = telegram_config.get(
+            "max_retry_delay_seconds", 300.0
+        )
+        self._request_timeout = aiohttp.ClientTimeout(
+            total=telegram_config.get("request_timeout_seconds", 10.0)
+        )
+        self._queue = asyncio.Queue(telegram_config.get("queue_size", 100))
+        self._queue_depth_gauge = _notification_queue_depth.labels(self._chat_id)
+        self._task = None
+        self._next_send_time = 0.0
+
+        # a notification which didn't fit in the last message
+        self._carried_notification = None
+
+        # delivery metrics
+        self._num_sent_notifications = 0
+        self._num_sent_messages = 0
+        self._num_dropped_notifications = 0
+        self._num_failed_notifications = 0
+        self._num_retries = 0
+        self._delivery_latencies = collections.deque(maxlen=100)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._deliver_notifications())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def notify(self, text: str) -> bool:
+        """Queues a notification for delivery, returning False if it was dropped because
+        the queue is full"""
+        try:
+            self._queue.put_nowait(_Notification(text))
+        except asyncio.QueueFull:
+            self._num_dropped_notifications += 1
+            _notifications_total.labels("dropped").inc()
+            self._logger.error_with(
+                "Notification queue full, dropping notification",
+                text=text,
+                num_dropped=self._num_dropped_notifications,
+            )
+
+            return False
+
+        self._queue_depth_gauge.set(self.queue_depth)
+
+        return True
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() + (1 if self._carried_notification else 0)
+
+    def get_metrics(self) -> Dict:
+        return {
+            "queue_depth": self.queue_depth,
+            "num_sent_notifications": self._num_sent_notifications,
+            "num_sent_messages": self._num_sent_messages,
+            "num_dropped_notifications": self._num_dropped_notifications,
+            "num_failed_notifications": self._num_failed_notifications,
+            "num_retries": self._num_retries,
+            "last_delivery_latency_seconds": (
+                self._delivery_latencies[-1] if self._delivery_latencies else None
+            ),
+            "max_delivery_latency_seconds": max(self._delivery_latencies, default=None),
+        }
+
+    async def _deliver_notifications(self) -> None:
+        while True:
+            notifications = await self._get_notification_batch()
+
+            await self._send_notifications(notifications)
+
+    async def _get_notification_batch(self) -> List[_Notification]:
+        notifications = [await self._get_notification()]
+        message_length = len(notifications[0].text)
+
+        # give notifications raised at about the same time (e.g. by several stations) a
+        # chance to arrive, and don't send faster than the chat's rate limit. whatever
+        # arrives in the meantime is merged into this message
+        await asyncio.sleep(
+            max(
+                self._batch_delay_seconds,
+                self._next_send_time - asyncio.get_running_loop().time(),
+            )
+        )
+
+        while not self._queue.empty():
+            notification = self._queue.get_nowait()
+
+            # leave what doesn't fit for the next message
+            if message_length + 2 + len(notification.text) > self._max_message_length:
+                self._carried_notification = notification
+                break
+
+            notifications.append(notification)
+            message_length += 2 + len(notification.text)
+
+        self._queue_depth_gauge.set(self.queue_depth)
+
+        return notifications
+
+    async def _get_notification(self) -> _Notification:
+        if self._carried_notification is not None:
+            notification, self._carried_notification = self._carried_notification, None
+            return notification
+
+        return await self._queue.get()
+
+    async def _send_notifications(self, notifications: List[_Notification]) -> None:
+        text = "\n\n".join(notification.text for notification in notifications)
+
+        for attempt in range(self._max_attempts):
+            sent, retry_delay_seconds = await self._send_message(text)
+            self._next_send_time = (
+                asyncio.get_running_loop().time() + self._min_send_interval_seconds
+            )
+
+            if sent:
+                self._num_sent_messages += 1
+                self._num_sent_notifications += len(notifications)
+                _notifications_total.labels("sent").inc(len(notifications))
+
+                now = time.monotonic()
+                for notification in notifications:
+                    self._delivery_latencies.append(now - notification.enqueue_time)
+                    _notification_delivery_seconds.observe(now - notification.enqueue_time)
+
+                self._logger.debug_with(
+                    "Sent notifications",
+                    num_notifications=len(notifications),
+                    num_attempts=attempt + 1,
+                    latency_seconds=self._delivery_latencies[-1],
+                )
+
+                return
+
+            # the request can't succeed (or this was the last attempt), don't retry
+            if retry_delay_seconds is None or attempt == self._max_attempts - 1:
+                break
+
+            # back off exponentially, unless told how long to wait
+            if retry_delay_seconds == 0:
+                retry_delay_seconds = min(
+                    self._retry_delay_seconds * 2 ** attempt, self._max_retry_delay_seconds
+                )
+
+            self._num_retries += 1
+            self._logger.warn_with(
+                "Failed to send notifications, retrying",
+                attempt=attempt + 1,
+                retry_delay_seconds=retry_delay_seconds,
+            )
+
+            await asyncio.sleep(retry_delay_seconds)
+
+        self._num_failed_notifications += len(notifications)
+        _notifications_total.labels("failed").inc(len(notifications))
+        self._logger.error_with("Failed to send notifications, dropping", text=text)
+
+    async def _send_message(self, text: str) -> Tuple[bool, Optional[float]]:
+        """Returns whether the message was sent and, if not, how long to wait before
+        retrying - 0 to back off, None if retrying won't help"""
+        try:
+            async with self._http_session.post(
+                self._url,
+                json={"chat_id": self._chat_id, "text": text},
+                timeout=self._request_timeout,
+            ) as response:
+                if response.status == 200:
+                    return True, None
+
+                response_body = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            self._logger.warn_with("Failed to reach Telegram", error=repr(e))
+            return False, 0
+
+        if not isinstance(response_body, dict):
+            response_body = {}
+
+        self._logger.warn_with(
+            "Telegram rejected message", status=response.status, response=response_body
+        )
+
+        # rate limited - telegram says how long to wait
+        if response.status == 429:
+            return False, float(
+                (response_body.get("parameters") or {}).get("retry_after", 0)
+            )
+
+        if response.status >= 500:
+            return False, 0
+
+        return False, None
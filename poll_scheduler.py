@@ -0,0 +1,168 @@
+from typing import Dict, Iterable, List, Optional
+
+import collections
+import time
+
+import logger
+import pyopensprinkler
+
+import station_flow
+
+
+class Scheduler:
+    """Decides how long to wait before polling the controller again - rarely while idle,
+    just before programs are due to start, quickly while a station is close to its
+    limits and quicker still while a station is in inrush"""
+
+    def __init__(self, detector_config: Dict):
+        self._running_interval_seconds = detector_config["running_station_interval_seconds"]
+        self._idle_interval_seconds = detector_config.get(
+            "idle_interval_seconds", self._running_interval_seconds
+        )
+        self._fast_interval_seconds = detector_config.get(
+            "fast_interval_seconds", self._running_interval_seconds
+        )
+        self._inrush_interval_seconds = detector_config.get(
+            "inrush_interval_seconds", self._fast_interval_seconds
+        )
+        self._program_wake_lead_seconds = detector_config.get(
+            "program_wake_lead_seconds", 0
+        )
+        self._near_limits_ratio = detector_config.get("near_limits_ratio", 0.8)
+
+    def get_interval(
+        self,
+        controller: pyopensprinkler.Controller,
+        station_flow_monitors: Iterable[station_flow.Monitor],
+        seconds_until_measurement: float,
+    ) -> float:
+        station_flow_monitors = list(station_flow_monitors)
+
+        # while stations are running, wake up for the next measurement - or sooner if
+        # a station is in inrush, when the flow changes fastest, or close to its limits
+        if station_flow_monitors:
+            interval = max(0.0, seconds_until_measurement)
+
+            if any(
+                station_flow_monitor.in_inrush
+                for station_flow_monitor in station_flow_monitors
+            ):
+                interval = min(interval, self._inrush_interval_seconds)
+
+            if any(
+                station_flow_monitor.near_limits(self._near_limits_ratio)
+                for station_flow_monitor in station_flow_monitors
+            ):
+                interval = min(interval, self._fast_interval_seconds)
+
+            return interval
+
+        seconds_until_program_start = self._get_seconds_until_program_start(controller)
+
+        # nothing is expected to start, poll rarely
+        if seconds_until_program_start is None:
+            return self._idle_interval_seconds
+
+        # a program is due (or just started) - poll quickly so that the running station
+        # is picked up as soon as possible
+        if seconds_until_program_start <= self._program_wake_lead_seconds:
+            return self._fast_interval_seconds
+
+        # wake up just before the program is due
+        return min(
+            self._idle_interval_seconds,
+            seconds_until_program_start - self._program_wake_lead_seconds,
+        )
+
+    def _get_seconds_until_program_start(
+        self, controller: pyopensprinkler.Controller
+    ) -> Optional[float]:
+        if not self._program_wake_lead_seconds:
+            return None
+
+        # programs are scheduled in the controller's local time, which is assumed to be
+        # the local time of this host. days on which programs don't run are not taken
+        # into account, which only means waking up for nothing
+        local_time = time.localtime()
+        seconds_since_midnight = (
+            local_time.tm_hour * 60 * 60 + local_time.tm_min * 60 + local_time.tm_sec
+        )
+
+        seconds_until_program_starts = []
+
+        for program in controller.programs.values():
+            if not program.enabled:
+                continue
+
+            for start_minute in self._get_program_start_minutes(controller, program):
+                seconds_until_program_start = (
+                    start_minute % (24 * 60)
+                ) * 60 - seconds_since_midnight
+
+                # starts which passed more than the lead ago are due tomorrow
+                if seconds_until_program_start < -self._program_wake_lead_seconds:
+                    seconds_until_program_start += 24 * 60 * 60
+
+                seconds_until_program_starts.append(seconds_until_program_start)
+
+        return min(seconds_until_program_starts, default=None)
+
+    def _get_program_start_minutes(
+        self, controller: pyopensprinkler.Controller, program: pyopensprinkler.Program
+    ) -> List[int]:
+        start_minutes = []
+
+        for offset_type, offset in zip(
+            program.program_start_time_offset_types,
+            program.program_start_time_offsets,
+        ):
+            if offset_type == "midnight":
+                start_minutes.append(offset)
+            elif offset_type == "sunrise":
+                start_minutes.append(controller.sunrise + offset)
+            elif offset_type == "sunset":
+                start_minutes.append(controller.sunset + offset)
+            else:
+                start_minutes.append(None)
+
+        # a repeating program starts at the first start time and then every interval
+        if program.start_time_type == 0:
+            if start_minutes[0] is None:
+                return []
+
+            return [
+                start_minutes[0] + repeat * program.program_start_repeat_interval
+                for repeat in range(program.program_start_repeat_count + 1)
+            ]
+
+        return [start_minute for start_minute in start_minutes if start_minute is not None]
+
+
+class RefreshCounter:
+    """Counts controller refreshes over the last hour and logs the count every hour"""
+
+    def __init__(self, logger_instance: logger.Logger, name: Optional[str] = None):
+        self._logger = logger_instance
+        self._name = name
+        self._refresh_times = collections.deque()
+        self._last_log_time = time.monotonic()
+
+    def add(self) -> None:
+        now = time.monotonic()
+        self._refresh_times.append(now)
+
+        # only keep the last hour
+        while self._refresh_times[0] < now - 60 * 60:
+            self._refresh_times.popleft()
+
+        if now - self._last_log_time >= 60 * 60:
+            self._last_log_time = now
+            self._logger.info_with(
+                "Controller refreshes in the last hour",
+                name=self._name,
+                refreshes=self.refreshes_per_hour,
+            )
+
+    @property
+    def refreshes_per_hour(self) -> int:
+        return len(self._refresh_times)
@@ -0,0 +1,383 @@
+from typing import Dict, List
+
+import argparse
+import collections
+import csv
+import itertools
+import json
+import sys
+
+import numpy as np
+import yaml
+
+
+class Series:
+    """Flow measurements of station runs, padded with NaN into a runs x measurements
+    matrix so that they can be evaluated all at once"""
+
+    def __init__(
+        self,
+        stations: List[str],
+        runs: List[List[float]],
+        expected_averages: List[float],
+        leak_starts: List[int],
+    ):
+        self.stations = stations
+        self.expected_averages = np.asarray(expected_averages, dtype=np.float64)
+
+        # index of the first leaking measurement of each run, -1 if the run didn't leak
+        self.leak_starts = np.asarray(leak_starts, dtype=np.int64)
+
+        self.measurements = np.full(
+            (len(runs), max((len(run) for run in runs), default=0)), np.nan
+        )
+        for run_index, run in enumerate(runs):
+            self.measurements[run_index, : len(run)] = run
+
+    def __len__(self) -> int:
+        return len(self.stations)
+
+
+class Grid:
+    """Threshold values to evaluate - every combination of them is replayed"""
+
+    def __init__(
+        self,
+        inrush_measurements: List[int],
+        allowed_max: List[float],
+        allowed_average_diff: List[float],
+        expected_average_history: List[int],
+    ):
+        self.inrush_measurements = np.asarray(inrush_measurements, dtype=np.int64)
+        self.allowed_max = np.asarray(allowed_max, dtype=np.float64)
+        self.allowed_average_diff = np.asarray(allowed_average_diff, dtype=np.float64)
+        self.expected_average_history = np.asarray(expected_average_history, dtype=np.int64)
+
+    @property
+    def shape(self) -> tuple:
+        return (
+            len(self.inrush_measurements),
+            len(self.allowed_max),
+            len(self.allowed_average_diff),
+            len(self.expected_average_history),
+        )
+
+
+def get_alert_indexes(series: Series, grid: Grid, max_runs_per_batch: int = 256) -> np.ndarray:
+    """Returns the index of the measurement at which station_flow.Monitor would raise
+    its (single) event, for every run and every combination of thresholds - a runs x
+    inrush x max x diff x history array. Runs without an event are set to their number
+    of measurements"""
+    alert_indexes = np.empty((len(series),) + grid.shape, dtype=np.int64)
+    run_lengths = np.sum(~np.isnan(series.measurements), axis=1)
+
+    # bound memory by evaluating a batch of runs at a time
+    for first_run_index in range(0, len(series), max_runs_per_batch):
+        batch = slice(first_run_index, first_run_index + max_runs_per_batch)
+
+        alert_indexes[batch] = np.minimum(
+            _get_batch_alert_indexes(
+                series.measurements[batch], series.expected_averages[batch], grid
+            ),
+            run_lengths[batch].reshape((-1, 1, 1, 1, 1)),
+        )
+
+    return alert_indexes
+
+
+def _get_batch_alert_indexes(
+    measurements: np.ndarray, expected_averages: np.ndarray, grid: Grid
+) -> np.ndarray:
+    num_runs, num_measurements = measurements.shape
+
+    # the monitor ignores the measurements counted before num_inrush_measurements, so
+    # the first measurement it keeps is at index inrush - 1
+    first_kept_indexes = np.maximum(grid.inrush_measurements - 1, 0)
+
+    # first measurement above each allowed max, at or after each index: runs x
+    # measurements x max
+    max_alert_indexes = _get_next_true_indexes(
+        measurements[:, :, None] > grid.allowed_max[None, None, :]
+    )
+
+    # ... taken at the first kept measurement: runs x inrush x max
+    max_alert_indexes = max_alert_indexes[:, np.minimum(first_kept_indexes, num_measurements), :]
+
+    # rolling mean of the last history measurements, at each index: runs x measurements
+    # x history. kept measurements are contiguous, so the monitor's window is the last
+    # history measurements as long as they're all kept
+    cumulative_sums = np.zeros((num_runs, num_measurements + 1))
+    cumulative_sums[:, 1:] = np.cumsum(np.nan_to_num(measurements), axis=1)
+
+    mean_diffs = np.full((num_runs, num_measurements, len(grid.expected_average_history)), np.nan)
+    for history_index, history in enumerate(grid.expected_average_history):
+        if history > num_measurements:
+            continue
+
+        # window ending at each index
+        mean_diffs[:, history - 1:, history_index] = (
+            cumulative_sums[:, history:] - cumulative_sums[:, :num_measurements - history + 1]
+        ) / history - expected_averages[:, None]
+
+    # padding beyond a run's end never alerts
+    mean_diffs[np.isnan(measurements)] = np.nan
+
+    # first mean above each allowed diff, at or after each index: runs x measurements x
+    # history x diff
+    mean_alert_indexes = _get_next_true_indexes(
+        mean_diffs[:, :, :, None] > np.abs(grid.allowed_average_diff)[None, None, None, :]
+    )
+
+    # the window is full once history measurements were kept: runs x inrush x history x diff
+    first_full_indexes = np.minimum(
+        first_kept_indexes[:, None] + grid.expected_average_history[None, :] - 1,
+        num_measurements,
+    )
+    mean_alert_indexes = mean_alert_indexes[
+        :, first_full_indexes, np.arange(len(grid.expected_average_history))[None, :], :
+    ]
+
+    # the monitor raises whichever comes first: runs x inrush x max x diff x history
+    return np.minimum(
+        max_alert_indexes[:, :, :, None, None],
+        mean_alert_indexes.transpose(0, 1, 3, 2)[:, :, None, :, :],
+    )
+
+
+def _get_next_true_indexes(values: np.ndarray) -> np.ndarray:
+    """For a runs x measurements x ... array, returns the index of the first True at or
+    after each measurement (the number of measurements if there's none), with an extra
+    entry at the end for indexes beyond the run"""
+    num_measurements = values.shape[1]
+    padded_shape = (values.shape[0], num_measurements + 1) + values.shape[2:]
+
+    indexes = np.full(padded_shape, num_measurements, dtype=np.int64)
+    indexes[:, :num_measurements] = np.where(
+        values,
+        np.arange(num_measurements).reshape((1, num_measurements) + (1,) * (values.ndim - 2)),
+        num_measurements,
+    )
+
+    # minimum of everything after each index
+    return np.minimum.accumulate(indexes[:, ::-1], axis=1)[:, ::-1]
+
+
+def get_results(
+    series: Series, grid: Grid, alert_indexes: np.ndarray, interval_seconds: float
+) -> List[Dict]:
+    """Returns the false positive rate and detection latency of every combination"""
+    run_lengths = np.sum(~np.isnan(series.measurements), axis=1)
+    alerted = alert_indexes < run_lengths.reshape((-1, 1, 1, 1, 1))
+    leaked = (series.leak_starts >= 0).reshape((-1, 1, 1, 1, 1))
+    leak_starts = series.leak_starts.reshape((-1, 1, 1, 1, 1))
+
+    # alerts before a leak starts (or in runs that didn't leak) are false positives
+    false_positives = alerted & (~leaked | (alert_indexes < leak_starts))
+    detections = alerted & leaked & (alert_indexes >= leak_starts)
+    latencies = np.where(detections, alert_indexes - leak_starts, 0) * interval_seconds
+
+    num_runs = len(series)
+    num_leaks = int(np.sum(series.leak_starts >= 0))
+    num_false_positives = false_positives.sum(axis=0)
+    num_detections = detections.sum(axis=0)
+    total_latencies = latencies.sum(axis=0)
+
+    results = []
+    for grid_index in itertools.product(*(range(size) for size in grid.shape)):
+        inrush_index, max_index, diff_index, history_index = grid_index
+
+        results.append(
+            {
+                "num_inrush_measurements": int(grid.inrush_measurements[inrush_index]),
+                "allowed_flow_rate_max": float(grid.allowed_max[max_index]),
+                "allowed_flow_rate_diff_from_average": float(grid.allowed_average_diff[diff_index]),
+                "flow_rate_average_history_meansurements": int(
+                    grid.expected_average_history[history_index]
+                ),
+                "false_positive_rate": float(num_false_positives[grid_index] / max(num_runs, 1)),
+                "detection_rate": (
+                    float(num_detections[grid_index] / num_leaks) if num_leaks else None
+                ),
+                "mean_latency_seconds": (
+                    float(total_latencies[grid_index] / num_detections[grid_index])
+                    if num_detections[grid_index]
+                    else None
+                ),
+            }
+        )
+
+    return results
+
+
+def read_series_csv(path: str) -> Series:
+    """Reads series from a csv with station, run, measurement and optionally leak (1 for
+    measurements taken while leaking) and expected_average columns. Measurements of a run
+    are expected in order"""
+    runs = collections.OrderedDict()
+    expected_averages = {}
+    leak_starts = {}
+
+    with open(path, "r", newline="") as series_file:
+        for row in csv.DictReader(series_file):
+            run_key = (row["station"], row["run"])
+            run = runs.setdefault(run_key, [])
+
+            if int(row.get("leak") or 0) and run_key not in leak_starts:
+                leak_starts[run_key] = len(run)
+
+            if row.get("expected_average"):
+                expected_averages[run_key] = float(row["expected_average"])
+
+            run.append(float(row["measurement"]))
+
+    return _get_series(runs, expected_averages, leak_starts)
+
+
+def read_series_log(path: str) -> Series:
+    """Reads series from the detector's JSON log (--log-format json --log-level debug) -
+    a run starts with each "Created flow monitor" record and continues with the station's
+    "Adding measurement" records. Logs carry no leak labels"""
+    runs = collections.OrderedDict()
+    expected_averages = {}
+    current_runs = {}
+
+    with open(path, "r") as log_file:
+        for line in log_file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+
+            record_with = record.get("with") or {}
+
+            if record.get("message") == "Created flow monitor":
+                station = record_with["station"]
+                run_key = (station, str(len(runs)))
+
+                current_runs[station] = run_key
+                runs[run_key] = []
+
+                # stations without history are monitored without an expected average
+                if record_with.get("expected_average_value") is not None:
+                    expected_averages[run_key] = float(record_with["expected_average_value"])
+
+            elif record.get("message") == "Adding measurement":
+                run_key = current_runs.get(record_with["name"])
+
+                if run_key is not None:
+                    runs[run_key].append(float(record_with["measurement"]))
+
+    return _get_series(runs, expected_averages, {})
+
+
+def _get_series(runs: Dict, expected_averages: Dict, leak_starts: Dict) -> Series:
+    station_means = collections.defaultdict(list)
+
+    # without an expected average, use the station's mean across runs that didn't leak
+    for run_key, run in runs.items():
+        if run_key not in leak_starts and run:
+            station_means[run_key[0]].append(np.mean(run))
+
+    return Series(
+        [station for station, _ in runs],
+        list(runs.values()),
+        [
+            expected_averages.get(run_key, np.mean(station_means.get(run_key[0]) or [np.nan]))
+            for run_key in runs
+        ],
+        [leak_starts.get(run_key, -1) for run_key in runs],
+    )
+
+
+def _get_values(spec: str, value_type: type) -> List:
+    """Parses a comma separated list of values, each either a value or start:stop:step
+    (inclusive)"""
+    values = []
+
+    for value_spec in spec.split(","):
+        if ":" in value_spec:
+            start, stop, step = (float(field) for field in value_spec.split(":"))
+            values.extend(value_type(value) for value in np.arange(start, stop + step / 2, step))
+        else:
+            values.append(value_type(value_spec))
+
+    return values
+
+
+def _register_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    parser.add_argument("--series-path", required=True, help="csv of flow series, or a JSON log")
+    parser.add_argument("--config-path", help="leak.yaml, for defaults")
+    parser.add_argument("--station", help="only replay runs of this station")
+    parser.add_argument("--num-inrush-measurements")
+    parser.add_argument("--allowed-flow-rate-max")
+    parser.add_argument("--allowed-flow-rate-diff-from-average")
+    parser.add_argument("--flow-rate-average-history-meansurements")
+    parser.add_argument("--interval-seconds", type=float)
+    parser.add_argument("--top", type=int, default=20, help="number of combinations to print")
+
+    return parser
+
+
+def _get_grid(args: argparse.Namespace, station_config: Dict) -> Grid:
+    def _get_grid_values(field_name: str, value_type: type) -> List:
+        spec = getattr(args, field_name)
+
+        # fall back to the configured value
+        if spec is None:
+            return [value_type(station_config[field_name])]
+
+        return _get_values(spec, value_type)
+
+    return Grid(
+        _get_grid_values("num_inrush_measurements", int),
+        _get_grid_values("allowed_flow_rate_max", float),
+        _get_grid_values("allowed_flow_rate_diff_from_average", float),
+        _get_grid_values("flow_rate_average_history_meansurements", int),
+    )
+
+
+def _main(args: argparse.Namespace) -> None:
+    config = {"detector": {"stations": {"default": {}}}}
+    if args.config_path is not None:
+        with open(args.config_path, "r") as config_file:
+            config = yaml.load(config_file, Loader=yaml.Loader)
+
+    if args.series_path.endswith(".csv"):
+        series = read_series_csv(args.series_path)
+    else:
+        series = read_series_log(args.series_path)
+
+    if args.station is not None:
+        run_indexes = [
+            run_index
+            for run_index, station in enumerate(series.stations)
+            if station == args.station
+        ]
+        series.stations = [series.stations[run_index] for run_index in run_indexes]
+        series.measurements = series.measurements[run_indexes]
+        series.expected_averages = series.expected_averages[run_indexes]
+        series.leak_starts = series.leak_starts[run_indexes]
+
+    grid = _get_grid(args, config["detector"]["stations"]["default"])
+    interval_seconds = args.interval_seconds or config["detector"].get(
+        "running_station_interval_seconds", 1
+    )
+
+    results = get_results(series, grid, get_alert_indexes(series, grid), interval_seconds)
+
+    # fewest false positives first, then fastest detection
+    results.sort(
+        key=lambda result: (
+            result["false_positive_rate"],
+            -(result["detection_rate"] or 0),
+            result["mean_latency_seconds"] if result["mean_latency_seconds"] is not None else float("inf"),
+        )
+    )
+
+    writer = csv.DictWriter(sys.stdout, fieldnames=list(results[0]))
+    writer.writeheader()
+    writer.writerows(results[: args.top])
+
+
+if __name__ == "__main__":
+    _main(_register_arguments(argparse.ArgumentParser()).parse_args())
@@ -1,39 +1,60 @@
-from typing import List, Dict, Optional
+from typing import BinaryIO, List, Dict, Optional, Tuple, Union
 import pandas as pd
 import numpy as np
 import matplotlib
-import matplotlib.pyplot
+import matplotlib.figure
 import matplotlib.backends.backend_pdf
 import datetime
 import asyncio
+import concurrent.futures
+import multiprocessing
 import sendgrid
 import sendgrid.helpers.mail
 import base64
+import io
+import time
 
 import pyopensprinkler
 
+import log_store
+import metrics
+
+
+_report_stage_seconds = metrics.registry.histogram(
+    "leak_report_stage_seconds",
+    "Time taken by each stage of generating a report",
+    ["stage"],
+)
+
 
 class Emailer:
+
+    # the attachment is encoded a chunk at a time. chunks are a multiple of 3 bytes so
+    # that the encoded chunks don't need padding and can be concatenated
+    _attachment_chunk_size = 3 * 64 * 1024
+
     def __init__(self, from_email: str, api_key: str):
         self._from_email = from_email
         self._email_client = sendgrid.SendGridAPIClient(api_key)
 
     async def send_report(
         self,
-        report_path: str,
+        report: Union[str, bytes, bytearray, memoryview, BinaryIO],
         to_email: str,
         subject: Optional[str] = None,
         contents: Optional[str] = None,
     ) -> None:
+        """Sends the report, given as a path, a binary file object or the report's
+        contents"""
 
         # client is blocking, so wrap it in a non blocking call
         await asyncio.get_running_loop().run_in_executor(
-            None, self._send_report, report_path, to_email, subject, contents
+            None, self._send_report, report, to_email, subject, contents
         )
 
     def _send_report(
         self,
-        report_path: str,
+        report: Union[str, bytes, bytearray, memoryview, BinaryIO],
         to_email: str,
         subject: Optional[str] = None,
         contents: Optional[str] = None,
@@ -47,13 +68,8 @@ class Emailer:
             html_content=contents or "See attached OpenSprinkler report <3",
         )
 
-        with open(report_path, "rb") as report_file:
-            report_contents = report_file.read()
-
-        encoded_file = base64.b64encode(report_contents).decode()
-
         attachedFile = sendgrid.helpers.mail.Attachment(
-            sendgrid.helpers.mail.FileContent(encoded_file),
+            sendgrid.helpers.mail.FileContent(self._get_encoded_report(report)),
             sendgrid.helpers.mail.FileName(f"os-report-{today}.pdf"),
             sendgrid.helpers.mail.FileType("application/pdf"),
             sendgrid.helpers.mail.Disposition("attachment"),
@@ -62,65 +78,138 @@ class Emailer:
         message.attachment = attachedFile
         response = self._email_client.send(message)
 
+    def _get_encoded_report(
+        self, report: Union[str, bytes, bytearray, memoryview, BinaryIO]
+    ) -> str:
+        if isinstance(report, str):
+            with open(report, "rb") as report_file:
+                return self._get_encoded_report(report_file)
 
-class Generator:
-    def __init__(self, controller: pyopensprinkler.Controller):
-        self._controller = controller
+        encoded_report = bytearray()
 
-        # use non-interactive matplot backend so that it doens't try to pop up
-        # gui and explode if not running in the main thread
-        matplotlib.use("Agg")
+        # slices of a memoryview don't copy the contents
+        if isinstance(report, (bytes, bytearray, memoryview)):
+            report = memoryview(report).cast("B")
 
-    async def generate(self, days: int, output_path: str) -> str:
-        await self._controller.refresh()
+            for offset in range(0, len(report), self._attachment_chunk_size):
+                encoded_report += base64.b64encode(
+                    report[offset:offset + self._attachment_chunk_size]
+                )
+        else:
 
-        # get logs from controller
-        logs = await self._controller.get_logs(days)
+            # reads may return less than asked for, in which case the bytes beyond the
+            # last multiple of 3 are carried over to the next chunk
+            remainder = b""
 
-        # create a dataframe from the logs
-        logs_df = self._get_logs_dataframe(self._controller.stations, logs)
+            while True:
+                chunk = report.read(self._attachment_chunk_size)
+                if not chunk:
+                    break
 
-        # generate weekly totals, needed both for plotting and creating a textual
-        # report
-        weekly_total_df = self._get_weekly_total_dataframe(logs_df, "liters")
+                if remainder:
+                    chunk = remainder + chunk
 
-        # generate the pdf in a thread as to not block the event loop
-        await asyncio.get_running_loop().run_in_executor(
-            None, self._generate_pdf, output_path, logs_df, weekly_total_df
+                encoded_length = len(chunk) - len(chunk) % 3
+                encoded_report += base64.b64encode(chunk[:encoded_length])
+                remainder = chunk[encoded_length:]
+
+            encoded_report += base64.b64encode(remainder)
+
+        return encoded_report.decode("ascii")
+
+
+class _FigureCanvas:
+    """Hands out a single figure that is cleared and reused for every chart, and freed
+    once rendering is done. Figures are created through the object oriented API, so
+    pyplot never holds a reference to them"""
+
+    def __init__(self):
+        self._figure = None
+
+    def __enter__(self) -> "_FigureCanvas":
+        return self
+
+    def __exit__(self, *args) -> None:
+        if self._figure is not None:
+            self._figure.clear()
+            self._figure = None
+
+    def get_figure(self) -> matplotlib.figure.Figure:
+        if self._figure is None:
+            self._figure = matplotlib.figure.Figure()
+        else:
+            self._figure.clear()
+
+        return self._figure
+
+
+class _Aggregates:
+    """Views of the logs, all derived from a single pivot of the daily rollups"""
+
+    def __init__(
+        self,
+        daily_liters: pd.DataFrame,
+        daily_liters_per_minute: pd.DataFrame,
+        weekly_liters: pd.DataFrame,
+    ):
+        self.daily_liters = daily_liters
+        self.daily_liters_per_minute = daily_liters_per_minute
+        self.weekly_liters = weekly_liters
+
+
+class Renderer:
+    """Builds the report from daily rollup columns - the pdf and the weekly totals
+    description. Runs in a worker process, so it is only handed plain column data"""
+
+    def __init__(self, dpi: int = 600):
+        self._dpi = dpi
+
+        # how long each stage of the last render took
+        self.stage_seconds = {}
+
+        # use non-interactive matplot backend so that it doens't try to pop up
+        # gui and explode if not running in the main thread
+        matplotlib.use("Agg")
+
+    def render(
+        self,
+        output: Union[str, BinaryIO],
+        station_names: Dict[int, str],
+        rollups_columns: Dict[str, np.ndarray],
+    ) -> str:
+
+        # pivot the daily rollups once and derive all views from the pivot. weekly
+        # totals are needed both for plotting and creating a textual report
+        start_time = time.perf_counter()
+        aggregates = self._get_aggregates(
+            self._get_daily_dataframe(station_names, rollups_columns)
         )
+        self.stage_seconds["aggregate"] = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        self._generate_pdf(output, aggregates)
+        self.stage_seconds["pdf"] = time.perf_counter() - start_time
 
         # generate string report about weekly totals
-        return self._generate_weekly_total_description(weekly_total_df)
+        return self._generate_weekly_total_description(aggregates.weekly_liters)
 
     def _generate_pdf(
-        self, output_path: str, logs_df: pd.DataFrame, weekly_total_df: pd.DataFrame
+        self, output: Union[str, BinaryIO], aggregates: "_Aggregates"
     ) -> None:
 
-        # create a pdf output
-        pdf = matplotlib.backends.backend_pdf.PdfPages(output_path)
+        # create a pdf output, either a file or a binary file object
+        with matplotlib.backends.backend_pdf.PdfPages(output) as pdf, _FigureCanvas() as figure_canvas:
 
-        # plot the data
-        for figure in [
-            self._get_line_figure(
-                self._get_weekly_total_dataframe(logs_df, "liters"),
-                "Liters",
-                "Weekly totals",
-            ),
-            self._get_line_figure(
-                self._get_pivot_dataframe(logs_df, "liters_per_minute"),
-                "Liters/Min",
-                "Rate over Time",
-            ),
-            self._get_line_figure(
-                self._get_pivot_dataframe(logs_df, "liters"),
-                "Liters",
-                "Volume over Time",
-            ),
-        ]:
-            pdf.savefig(figure, dpi=600, bbox_inches="tight")
+            # plot the data, a page at a time
+            for df, y_label, title in [
+                (aggregates.weekly_liters, "Liters", "Weekly totals"),
+                (aggregates.daily_liters_per_minute, "Liters/Min", "Rate over Time"),
+                (aggregates.daily_liters, "Liters", "Volume over Time"),
+            ]:
+                figure = figure_canvas.get_figure()
+                self._plot_line_figure(figure, df, y_label, title)
 
-        # flush
-        pdf.close()
+                pdf.savefig(figure, dpi=self._dpi, bbox_inches="tight")
 
     def _print_dataframe(self, df: pd.DataFrame) -> None:
         with pd.option_context(
@@ -130,111 +219,74 @@ class Generator:
 
     def _sanitize_dataframe(self, df: pd.DataFrame) -> pd.DataFrame:
         # replace all zeros with NaN
-        columns = list(df.columns.values)
-        df[columns] = df[columns].replace({0.0: np.nan})
+        df = df.replace({0.0: np.nan})
 
         # drop all columns (stations) whose values are all NaN, or it borks the x axis
         return df.dropna(axis=1, how="all")
 
-    def _get_pivot_dataframe(self, logs_df: pd.DataFrame, value: str) -> pd.DataFrame:
-        # pivot on the value
-        pivot_df = logs_df.pivot(
-            values=value, index=["start_time"], columns=["station_name"]
-        )
+    def _get_daily_dataframe(
+        self, station_names: Dict[int, str], rollups_columns: Dict[str, np.ndarray]
+    ) -> pd.DataFrame:
 
-        # sum all values for a given day
-        pivot_df = pivot_df.groupby(pivot_df.index.date).sum()
+        # map station indexes to names through a lookup array
+        station_names_lookup = np.empty(max(station_names, default=-1) + 1, dtype=object)
+        for station_index, station_name in station_names.items():
+            station_names_lookup[station_index] = station_name
 
-        return self._sanitize_dataframe(pivot_df)
+        rollups_df = pd.DataFrame(
+            {
+                "day": pd.to_datetime(rollups_columns["day"], format="%Y-%m-%d").date,
+                "station_name": station_names_lookup[rollups_columns["station"]],
+                "liters": 10.0 * rollups_columns["flow_sensor_ticks"],
+                "liters_per_minute": 10.0 * rollups_columns["flow_sensor_ticks_per_minute"],
+            }
+        )
 
-    def _get_weekly_total_dataframe(
-        self, logs_df: pd.DataFrame, value: str
-    ) -> pd.DataFrame:
-        # pivot on the value
-        pivot_df = logs_df.pivot(
-            values=value, index=["start_time"], columns=["station_name"]
+        # pivot all values at once into a day x (value, station) matrix. there's a
+        # rollup per station per day, days on which a station didn't run are zero
+        return rollups_df.pivot(
+            values=["liters", "liters_per_minute"],
+            index="day",
+            columns="station_name",
+        ).fillna(0.0)
+
+    def _get_aggregates(self, daily_df: pd.DataFrame) -> "_Aggregates":
+        daily_liters_df = daily_df["liters"]
+
+        # weekly totals are summed from the daily totals
+        weekly_liters_df = (
+            daily_liters_df.set_axis(pd.DatetimeIndex(daily_liters_df.index), axis=0)
+            .groupby(pd.Grouper(freq="W-SAT"))
+            .sum()
         )
 
-        pivot_df = pivot_df.groupby(pd.Grouper(freq="W-SAT")).sum()
-        pivot_df["Total"] = pivot_df.sum(axis=1)
+        weekly_liters_df["Total"] = weekly_liters_df.sum(axis=1)
 
-        # round everything down
-        columns = list(pivot_df.columns.values)
-        pivot_df[columns] = pivot_df[columns].round(decimals=2)
+        return _Aggregates(
+            daily_liters=self._sanitize_dataframe(daily_liters_df),
+            daily_liters_per_minute=self._sanitize_dataframe(
+                daily_df["liters_per_minute"]
+            ),
 
-        return self._sanitize_dataframe(pivot_df)
+            # round everything down
+            weekly_liters=self._sanitize_dataframe(weekly_liters_df.round(decimals=2)),
+        )
 
-    def _get_line_figure(self, df: pd.DataFrame, y_label: str, title: str) -> object:
+    def _plot_line_figure(
+        self,
+        figure: matplotlib.figure.Figure,
+        df: pd.DataFrame,
+        y_label: str,
+        title: str,
+    ) -> None:
         plot = df.interpolate(method="linear").plot.line(
-            marker="o", markersize=2, rot=45
+            ax=figure.subplots(), marker="o", markersize=2, rot=45
         )
 
         plot.set_xlabel("Date")
         plot.set_ylabel(y_label)
         plot.set_title(title)
-
-        return plot.legend(loc="center left", bbox_to_anchor=(1, 0.5)).get_figure()
-
-    def _get_logs_dataframe(
-        self, stations: Dict[int, pyopensprinkler.Station], logs: List
-    ) -> pd.DataFrame:
-        filtered_logs = []
-
-        # ignore ad hoc
-        for log in logs:
-            if log[0] == 99:
-                continue
-
-            filtered_logs.append(log)
-
-        logs = filtered_logs
-
-        logs_dataframe = pd.DataFrame(
-            columns=[
-                "station_name",
-                "liters",
-                "liters_per_minute",
-                "duration_seconds",
-                "start_time",
-                "end_time",
-            ],
-            index=range(len(logs)),
-        )
-
-        # force types
-        logs_dataframe = logs_dataframe.astype(
-            {
-                "station_name": "object",
-                "liters": "float64",
-                "liters_per_minute": "float64",
-                "duration_seconds": "float64",
-                "start_time": "datetime64",
-                "end_time": "datetime64",
-            }
-        )
-
-        for log_index, log in enumerate(logs):
-
-            # skip rain delay
-            if log[1] == "rd":
-                continue
-
-            station_name = stations[log[1]].name
-            duration_seconds = log[2]
-            start_time = datetime.datetime.fromtimestamp(log[3] - duration_seconds)
-            end_time = datetime.datetime.fromtimestamp(log[3])
-            flow_sensor_ticks_per_minute = log[4]
-
-            logs_dataframe.loc[log_index] = {
-                "station_name": station_name,
-                "liters": 10.0 * flow_sensor_ticks_per_minute * duration_seconds / 60.0,
-                "liters_per_minute": 10 * flow_sensor_ticks_per_minute,
-                "duration_seconds": duration_seconds,
-                "start_time": start_time,
-                "end_time": end_time,
-            }
-
-        return logs_dataframe
+        plot.legend(loc="center left", bbox_to_anchor=(1, 0.5))
 
     def _generate_weekly_total_description(self, weekly_total_df: pd.DataFrame) -> str:
         weekly_total_description = "Summary for this week:<br/>"
@@ -260,3 +312,119 @@ class Generator:
             weekly_total_description += f"{arrow} {column}: {last_value:,}L (Last week: {penultimate_value:,}L; {diff_percent:.2f}% change)<br/>"
 
         return weekly_total_description
+
+
+def _get_rollups_columns(rollups: List) -> Dict[str, np.ndarray]:
+    if not rollups:
+        return {
+            "day": np.empty(0, dtype=object),
+            "station": np.empty(0, dtype=np.int64),
+            "flow_sensor_ticks": np.empty(0, dtype=np.float64),
+            "flow_sensor_ticks_per_minute": np.empty(0, dtype=np.float64),
+        }
+
+    # transpose the rollup records into columns once
+    days, stations, flow_sensor_ticks, flow_sensor_ticks_per_minute, _ = zip(*rollups)
+
+    return {
+        "day": np.asarray(days, dtype=object),
+        "station": np.asarray(stations, dtype=np.int64),
+        "flow_sensor_ticks": np.asarray(flow_sensor_ticks, dtype=np.float64),
+        "flow_sensor_ticks_per_minute": np.asarray(
+            flow_sensor_ticks_per_minute, dtype=np.float64
+        ),
+    }
+
+
+def _render_in_worker(
+    station_names: Dict[int, str],
+    rollups_columns: Dict[str, np.ndarray],
+    dpi: int,
+) -> Tuple[bytes, str, Dict[str, float]]:
+    pdf_buffer = io.BytesIO()
+    renderer = Renderer(dpi)
+    weekly_description = renderer.render(pdf_buffer, station_names, rollups_columns)
+
+    # getvalue() shares the buffer's contents rather than copying them, as long as
+    # nothing else holds on to the buffer
+    return pdf_buffer.getvalue(), weekly_description, renderer.stage_seconds
+
+
+class Generator:
+    def __init__(
+        self,
+        controller: pyopensprinkler.Controller,
+        log_store_instance: log_store.Store,
+        reports_per_worker: int = 4,
+        dpi: int = 600,
+    ):
+        self._controller = controller
+        self._log_store = log_store_instance
+        self._dpi = dpi
+
+        # rendering runs in a worker process so that pandas/matplotlib neither hold the
+        # GIL nor grow the memory of the detector's process. the worker is recycled
+        # every reports_per_worker reports so that whatever it accumulates is returned
+        self._reports_per_worker = reports_per_worker
+        self._num_worker_reports = 0
+        self._worker_executor = None
+
+    async def generate(self, days: int) -> Tuple[memoryview, str]:
+        """Returns the report pdf's contents and a description of the weekly totals. The
+        contents are never written to disk - they can be handed as is to the emailer
+        or written to any binary file object"""
+        start_time = time.perf_counter()
+        await self._controller.refresh()
+        _report_stage_seconds.labels("refresh").observe(time.perf_counter() - start_time)
+
+        # get the daily rollups, reading only new logs from the controller
+        start_time = time.perf_counter()
+        rollups = await self._log_store.get_daily_rollups(days)
+        _report_stage_seconds.labels("rollups").observe(time.perf_counter() - start_time)
+
+        station_names = {
+            station_index: station.name
+            for station_index, station in self._controller.stations.items()
+        }
+
+        # generate the pdf and weekly totals description in a worker process as to not
+        # block the event loop
+        start_time = time.perf_counter()
+        (
+            pdf_contents,
+            weekly_description,
+            stage_seconds,
+        ) = await asyncio.get_running_loop().run_in_executor(
+            self._get_worker_executor(),
+            _render_in_worker,
+            station_names,
+            _get_rollups_columns(rollups),
+            self._dpi,
+        )
+
+        # the worker's own stages, and the whole round trip to the worker
+        for stage, seconds in stage_seconds.items():
+            _report_stage_seconds.labels(stage).observe(seconds)
+
+        _report_stage_seconds.labels("worker").observe(time.perf_counter() - start_time)
+
+        return memoryview(pdf_contents), weekly_description
+
+    def close(self) -> None:
+        if self._worker_executor is not None:
+            self._worker_executor.shutdown(wait=False)
+            self._worker_executor = None
+
+    def _get_worker_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self._num_worker_reports >= self._reports_per_worker:
+            self.close()
+
+        if self._worker_executor is None:
+            self._worker_executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=multiprocessing.get_context("spawn")
+            )
+            self._num_worker_reports = 0
+
+        self._num_worker_reports += 1
+
+        return self._worker_executor
@@ -0,0 +1,102 @@
+from typing import Dict, Optional
+
+import asyncio
+import time
+
+import logger
+import metrics
+import poll_scheduler
+import pyopensprinkler
+
+
+_controller_refresh_seconds = metrics.registry.histogram(
+    "leak_controller_refresh_seconds",
+    "Time taken to refresh all program/station data from the controller",
+    ["site"],
+)
+_controller_sample_seconds = metrics.registry.histogram(
+    "leak_controller_sample_seconds",
+    "Time taken to sample flow and running stations from the controller",
+    ["site"],
+)
+
+
+class Sampler:
+    """Reads the controller's flow and running stations. A full refresh reads every
+    station, program and option, which is only needed once in a while - in between,
+    the controller's settings (/jc: flow counters, running station bits and the
+    stations' program status) are read with a single, small request and swapped into
+    the controller's state. A full refresh is done as soon as the running stations
+    change, so that stations' status is never read stale"""
+
+    def __init__(
+        self,
+        logger_instance: logger.Logger,
+        controller: pyopensprinkler.Controller,
+        detector_config: Dict,
+        site_name: Optional[str] = None,
+        refresh_counter: Optional[poll_scheduler.RefreshCounter] = None,
+    ):
+        self._logger = logger_instance
+        self._controller = controller
+        self._refresh_interval_seconds = detector_config.get(
+            "full_refresh_interval_seconds", 5 * 60
+        )
+        self._min_sample_interval_seconds = detector_config.get(
+            "min_sample_interval_seconds", 0.2
+        )
+        self._site_name = site_name
+        self._refresh_counter = refresh_counter
+        self._next_refresh_time = 0.0
+        self._last_sample_time = None
+        self._refresh_seconds = _controller_refresh_seconds.labels(site_name)
+        self._sample_seconds = _controller_sample_seconds.labels(site_name)
+
+    async def sample(self) -> None:
+
+        # never hit the controller's http server more often than it can take, however
+        # fast we're asked to sample
+        if self._last_sample_time is not None:
+            await asyncio.sleep(
+                max(
+                    0.0,
+                    self._last_sample_time
+                    + self._min_sample_interval_seconds
+                    - time.monotonic(),
+                )
+            )
+
+        self._last_sample_time = time.monotonic()
+
+        if self._last_sample_time >= self._next_refresh_time:
+            await self._refresh()
+            return
+
+        sample_start_time = time.perf_counter()
+        settings = await self._controller.request("/jc")
+        self._sample_seconds.observe(time.perf_counter() - sample_start_time)
+
+        state = self._controller._state
+
+        # stations started or stopped - read everything so that their status is fresh
+        if settings.get("sbits") != state["settings"].get("sbits"):
+            self._logger.debug_with(
+                "Running stations changed, refreshing", site=self._site_name
+            )
+
+            await self._refresh()
+            return
+
+        # /jc returns exactly the "settings" section of the controller's state
+        state["settings"] = settings
+
+    async def _refresh(self) -> None:
+        refresh_start_time = time.perf_counter()
+        await self._controller.refresh()
+        self._refresh_seconds.observe(time.perf_counter() - refresh_start_time)
+
+        # only full refreshes are counted, samples are cheap
+        if self._refresh_counter is not None:
+            self._refresh_counter.add()
+
+        self._next_refresh_time = time.monotonic() + self._refresh_interval_seconds
@@ -0,0 +1,480 @@
+from typing import Dict, List, Optional
+
+import aiohttp.web
+import argparse
+import asyncio
+import bisect
+import collections
+import csv
+import hashlib
+import math
+import random
+import sys
+import time
+
+import logger
+
+
+class Station:
+    """A simulated station and the flow it draws while running, in flow sensor ticks
+    per minute"""
+
+    def __init__(
+        self,
+        name: str,
+        flow_ticks_per_minute: float,
+        noise: float = 0.05,
+        inrush_seconds: float = 0.0,
+        inrush_ratio: float = 2.0,
+    ):
+        self.name = name
+        self.flow_ticks_per_minute = flow_ticks_per_minute
+        self.noise = noise
+        self.inrush_seconds = inrush_seconds
+        self.inrush_ratio = inrush_ratio
+
+        # from leak_start_time on, the station draws leak_ratio times its usual flow
+        self.leak_start_time = None
+        self.leak_ratio = 1.0
+
+
+class _Run:
+    def __init__(self, station_index: int, program_id: int, start_time: float, end_time: float):
+        self.station_index = station_index
+        self.program_id = program_id
+        self.start_time = start_time
+        self.end_time = end_time
+
+
+class Simulator:
+    """Stands in for an OpenSprinkler controller's HTTP API (the endpoints the detector
+    and the report generator use - /ja, /jc, /jo, /jn, /js, /jp and /jl), so that both
+    can run offline. Logs are replayed or synthesized, stations are run on demand and
+    flow is derived from the running stations, including inrush and leaks"""
+
+    # seconds over which the flow sensor's pulses are counted (flcrt/flwrt)
+    flow_window_seconds = 30
+
+    def __init__(
+        self,
+        logger_instance: logger.Logger,
+        stations: List[Station],
+        password: str = "opendoor",
+        liters_per_tick: float = 10.0,
+        master_station_index: Optional[int] = None,
+        latency_seconds: float = 0.0,
+        seed: int = 0,
+    ):
+        self._logger = logger_instance
+        self.stations = stations
+        self.latency_seconds = latency_seconds
+        self.requests = collections.Counter()
+        self._password_hash = hashlib.md5(password.encode()).hexdigest()
+        self._liters_per_tick = liters_per_tick
+        self._master_station_index = master_station_index
+        self._rng = random.Random(seed)
+        self._runs = {}
+        self._runner = None
+
+        # [program, station, duration_seconds, end_time, flow_ticks_per_minute] ordered
+        # by end_time, along with the end times for bisecting
+        self._logs = []
+        self._log_end_times = []
+
+    @property
+    def num_boards(self) -> int:
+        return max(1, math.ceil(len(self.stations) / 8))
+
+    def add_logs(self, logs: List) -> None:
+        """Adds (replays) log records, e.g. as read from a real controller"""
+        for log in logs:
+            index = bisect.bisect_right(self._log_end_times, log[3])
+            self._log_end_times.insert(index, log[3])
+            self._logs.insert(index, list(log))
+
+    def synthesize_logs(
+        self,
+        days: int,
+        runs_per_day: int = 1,
+        run_seconds: int = 10 * 60,
+        now: Optional[float] = None,
+    ) -> None:
+        """Adds a history of days, in which a program runs all stations one after the
+        other, runs_per_day times a day"""
+        now = time.time() if now is None else now
+        start_time = int(now) - days * 24 * 60 * 60
+        logs = []
+
+        for day in range(days):
+            for run in range(runs_per_day):
+                end_time = start_time + day * 24 * 60 * 60 + run * (24 // runs_per_day) * 60 * 60
+
+                for station_index, station in enumerate(self.stations):
+                    if station_index == self._master_station_index:
+                        continue
+
+                    duration_seconds = int(run_seconds * self._rng.uniform(0.8, 1.2))
+                    end_time += duration_seconds
+
+                    # the last day's runs may not have happened yet
+                    if end_time > now:
+                        break
+
+                    logs.append(
+                        [
+                            1,
+                            station_index,
+                            duration_seconds,
+                            end_time,
+                            self._get_run_flow(station, end_time - duration_seconds, end_time),
+                        ]
+                    )
+
+        self.add_logs(logs)
+
+    def run_station(self, station_index: int, seconds: float, program_id: int = 99) -> None:
+        """Starts running a station now, as if a program (99 being ad hoc) started it"""
+        now = time.time()
+        self._runs[station_index] = _Run(station_index, program_id, now, now + seconds)
+
+    def stop_station(self, station_index: int) -> None:
+        run = self._runs.pop(station_index, None)
+        if run is not None:
+            self._log_run(run, time.time())
+
+    def get_flow_ticks_per_minute(self, now: Optional[float] = None) -> float:
+        """The flow through the sensor - the sum of the running stations' flow"""
+        now = time.time() if now is None else now
+
+        return sum(
+            self._get_station_flow(self.stations[station_index], now - run.start_time, now)
+            for station_index, run in self._get_runs(now).items()
+        )
+
+    async def start(self, host: str, port: int) -> None:
+        app = aiohttp.web.Application()
+
+        for path, handler in (
+            ("/ja", self._handle_all),
+            ("/jc", self._handle_settings),
+            ("/jo", self._handle_options),
+            ("/jn", self._handle_stations),
+            ("/js", self._handle_status),
+            ("/jp", self._handle_programs),
+            ("/jl", self._handle_logs),
+        ):
+            app.router.add_get(path, self._get_api_handler(handler))
+
+        self._runner = aiohttp.web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, host, port).start()
+
+        self._logger.debug_with(
+            "Simulating controller",
+            host=host,
+            port=port,
+            num_stations=len(self.stations),
+            num_logs=len(self._logs),
+        )
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _get_api_handler(self, handler):
+        async def _handle(request: aiohttp.web.Request) -> aiohttp.web.Response:
+            self.requests[request.path] += 1
+
+            if self.latency_seconds:
+                await asyncio.sleep(self.latency_seconds)
+
+            # the controller answers a bad password with result 2
+            if request.query.get("pw") != self._password_hash:
+                return aiohttp.web.json_response({"result": 2})
+
+            return aiohttp.web.json_response(handler(request, time.time()))
+
+        return _handle
+
+    def _handle_all(self, request: aiohttp.web.Request, now: float):
+        return {
+            "settings": self._handle_settings(request, now),
+            "options": self._handle_options(request, now),
+            "stations": self._handle_stations(request, now),
+            "status": self._handle_status(request, now),
+            "programs": self._handle_programs(request, now),
+        }
+
+    def _handle_settings(self, request: aiohttp.web.Request, now: float) -> Dict:
+        runs = self._get_runs(now)
+        station_bits = [0] * self.num_boards
+        program_status = [[0, 0, 0] for _ in self.stations]
+
+        for station_index, run in runs.items():
+            station_bits[station_index // 8] |= 1 << (station_index % 8)
+            program_status[station_index] = [
+                run.program_id,
+                int(run.end_time - now),
+                int(run.start_time),
+            ]
+
+        # the flow sensor's pulses over the last window. pulses are counted fractionally
+        # so that the simulated flow rate reads back exactly
+        return {
+            "devt": int(now),
+            "nbrd": self.num_boards,
+            "en": 1,
+            "sn1": 0,
+            "sn2": 0,
+            "rd": 0,
+            "rdst": 0,
+            "sunrise": 6 * 60,
+            "sunset": 18 * 60,
+            "eip": 0,
+            "lwc": int(now),
+            "lswc": int(now),
+            "lupt": int(now),
+            "lrbtc": 0,
+            "lrun": [0, 0, 0, 0],
+            "mac": "00:00:00:00:00:00",
+            "loc": "",
+            "wto": {},
+            "ifkey": "",
+            "mqtt": {},
+            "wtrestr": 0,
+            "wls": [],
+            "curr": 0,
+            "sbits": station_bits + [0],
+            "ps": program_status,
+            "nq": 0,
+            "pq": 0,
+            "pt": 0,
+            "flcrt": self.get_flow_ticks_per_minute(now) * self.flow_window_seconds / 60,
+            "flwrt": self.flow_window_seconds,
+            "RSSI": -50,
+        }
+
+    def _handle_options(self, request: aiohttp.web.Request, now: float) -> Dict:
+
+        # flow pulse rate, in hundredths of a liter per pulse
+        flow_pulse_rate = int(self._liters_per_tick * 100)
+
+        return {
+            "fwv": 219,
+            "fwm": 9,
+            "hwv": 31,
+            "hwt": 172,
+            "tz": 48,
+            "ntp": 1,
+            "dhcp": 1,
+            "ext": self.num_boards - 1,
+            "sdt": 0,
+            "mas": 0 if self._master_station_index is None else self._master_station_index + 1,
+            "mton": 0,
+            "mtof": 0,
+            "mas2": 0,
+            "mton2": 0,
+            "mtof2": 0,
+            "urs": 0,
+            "rso": 0,
+            "wl": 100,
+            "den": 1,
+            "ipas": 0,
+            "devid": 0,
+            "dexp": -1,
+            "mexp": 24,
+            "lg": 1,
+            "uwt": 0,
+            "sar": 0,
+            "ife": 0,
+            "sn1t": 2,
+            "sn1o": 1,
+            "sn2t": 0,
+            "sn2o": 1,
+            "sn1on": 0,
+            "sn1of": 0,
+            "sn2on": 0,
+            "sn2of": 0,
+            "fpr0": flow_pulse_rate & 0xFF,
+            "fpr1": flow_pulse_rate >> 8,
+            "dim": [],
+        }
+
+    def _handle_stations(self, request: aiohttp.web.Request, now: float) -> Dict:
+        station_bits = [0] * self.num_boards
+
+        return {
+            "snames": [station.name for station in self.stations],
+            "masop": [255] * self.num_boards,
+            "masop2": list(station_bits),
+            "ignore_rain": list(station_bits),
+            "ignore_sn1": list(station_bits),
+            "ignore_sn2": list(station_bits),
+            "stn_dis": list(station_bits),
+            "stn_seq": [255] * self.num_boards,
+            "stn_spe": list(station_bits),
+            "act_relay": list(station_bits),
+            "maxlen": 32,
+        }
+
+    def _handle_status(self, request: aiohttp.web.Request, now: float) -> Dict:
+        runs = self._get_runs(now)
+
+        return {
+            "sn": [int(station_index in runs) for station_index in range(len(self.stations))],
+            "nstations": len(self.stations),
+        }
+
+    def _handle_programs(self, request: aiohttp.web.Request, now: float) -> Dict:
+        return {"nprogs": 0, "nboards": self.num_boards, "mnp": 40, "mnst": 4, "pnsize": 32, "pd": []}
+
+    def _handle_logs(self, request: aiohttp.web.Request, now: float) -> List:
+
+        # logs are either requested for the last "hist" days (including today) or by
+        # start/end time, both inclusive
+        if "hist" in request.query:
+            midnight = now - now % (24 * 60 * 60)
+            start_time = midnight - int(request.query["hist"]) * 24 * 60 * 60
+            end_time = now
+        else:
+            start_time = int(request.query["start"])
+            end_time = int(request.query["end"])
+
+        start_index = bisect.bisect_left(self._log_end_times, start_time)
+        end_index = bisect.bisect_right(self._log_end_times, end_time)
+        logs = self._logs[start_index:end_index]
+
+        # e.g. "rd" only returns rain delays
+        log_type = request.query.get("type")
+        if log_type is not None:
+            logs = [log for log in logs if log[1] == log_type]
+
+        return logs
+
+    def _get_runs(self, now: float) -> Dict[int, _Run]:
+
+        # runs that ended are logged, as the controller does
+        for station_index, run in list(self._runs.items()):
+            if run.end_time <= now:
+                del self._runs[station_index]
+                self._log_run(run, run.end_time)
+
+        return self._runs
+
+    def _log_run(self, run: _Run, end_time: float) -> None:
+        self.add_logs(
+            [
+                [
+                    run.program_id,
+                    run.station_index,
+                    int(end_time - run.start_time),
+                    int(end_time),
+                    self._get_run_flow(self.stations[run.station_index], run.start_time, end_time),
+                ]
+            ]
+        )
+
+    def _get_run_flow(self, station: Station, start_time: float, end_time: float) -> float:
+        """The average flow logged for a run - drawn around the station's flow, which
+        is multiplied by the leak ratio if the run ended while leaking"""
+        flow = station.flow_ticks_per_minute * self._rng.gauss(1.0, station.noise)
+
+        if station.leak_start_time is not None and end_time >= station.leak_start_time:
+            flow *= station.leak_ratio
+
+        return max(0.0, flow)
+
+    def _get_station_flow(self, station: Station, run_seconds: float, now: float) -> float:
+        flow = self._get_run_flow(station, now - run_seconds, now)
+
+        # pipes fill up at the start of a run
+        if run_seconds < station.inrush_seconds:
+            flow *= station.inrush_ratio
+
+        return flow
+
+
+def read_logs_csv(path: str) -> List:
+    """Reads logs to replay from a csv of program, station, duration_seconds, end_time
+    and flow_ticks_per_minute columns"""
+    logs = []
+
+    with open(path, "r") as logs_file:
+        for row in csv.DictReader(logs_file):
+            station = row["station"]
+            logs.append(
+                [
+                    int(row["program"]),
+                    station if station == "rd" else int(station),
+                    int(row["duration_seconds"]),
+                    int(row["end_time"]),
+                    float(row["flow_ticks_per_minute"]),
+                ]
+            )
+
+    return logs
+
+
+def _register_arguments(parser: argparse.ArgumentParser) -> argparse.ArgumentParser:
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--password", default="opendoor")
+    parser.add_argument("--num-stations", type=int, default=8)
+    parser.add_argument("--liters-per-tick", type=float, default=10.0)
+    parser.add_argument("--flow", type=float, default=2.0, help="ticks per minute per station")
+    parser.add_argument("--inrush-seconds", type=float, default=60.0)
+    parser.add_argument("--history-days", type=int, default=30, help="days of logs to synthesize")
+    parser.add_argument("--runs-per-day", type=int, default=1)
+    parser.add_argument("--logs-path", help="csv of logs to replay instead of synthesizing")
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--run-station", type=int, help="station to run right away")
+    parser.add_argument("--run-seconds", type=float, default=10 * 60)
+    parser.add_argument("--leak-station", type=int, help="station that leaks from the start")
+    parser.add_argument("--leak-ratio", type=float, default=1.5)
+
+    return parser
+
+
+async def _main(args: argparse.Namespace) -> None:
+    root_logger = logger.Logger(level="DEBUG")
+    root_logger.set_handler("stdout", sys.stdout, logger.HumanReadableFormatter())
+
+    stations = [
+        Station(f"Station {index}", args.flow, inrush_seconds=args.inrush_seconds)
+        for index in range(args.num_stations)
+    ]
+
+    if args.leak_station is not None:
+        stations[args.leak_station].leak_start_time = time.time()
+        stations[args.leak_station].leak_ratio = args.leak_ratio
+
+    simulator = Simulator(
+        root_logger,
+        stations,
+        password=args.password,
+        liters_per_tick=args.liters_per_tick,
+        latency_seconds=args.latency_ms / 1000,
+    )
+
+    if args.logs_path is not None:
+        simulator.add_logs(read_logs_csv(args.logs_path))
+    else:
+        simulator.synthesize_logs(args.history_days, args.runs_per_day)
+
+    if args.run_station is not None:
+        simulator.run_station(args.run_station, args.run_seconds)
+
+    await simulator.start(args.host, args.port)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await simulator.stop()
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(_main(_register_arguments(argparse.ArgumentParser()).parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,36 @@
+from typing import Dict, Optional
+
+import json
+import os
+
+
+# bumped whenever the snapshot's contents change, older snapshots are ignored
+_VERSION = 1
+
+
+def write(path: str, state: Dict) -> None:
+    """Writes state as a compact JSON document. The document is written to a temporary
+    file which then replaces the snapshot, so a crash mid-write leaves the previous
+    snapshot intact. Blocks on disk, so run it in an executor"""
+    temporary_path = path + ".tmp"
+
+    with open(temporary_path, "w") as snapshot_file:
+        json.dump({"version": _VERSION, "state": state}, snapshot_file, separators=(",", ":"))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+    os.replace(temporary_path, path)
+
+
+def read(path: str) -> Optional[Dict]:
+    """Returns the state in the snapshot, or None if there's no usable snapshot"""
+    try:
+        with open(path, "r") as snapshot_file:
+            document = json.load(snapshot_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if not isinstance(document, dict) or document.get("version") != _VERSION:
+        return None
+
+    return document["state"]
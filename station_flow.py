@@ -1,6 +1,5 @@
-from typing import Callable, List
-import asyncio
-import statistics
+from typing import Callable, Dict, List, Optional, Sequence
+import math
 import pyopensprinkler
 
 
@@ -26,6 +25,78 @@ class MeanDifferenceExceededEvent:
         return f"Measured mean ({self.measured_mean}, from {self.measurements}) for station {self.station.name} too far from mean ({self.expected_mean} ±{self.allowed_mean_diff})"
 
 
+class MeasurementWindow:
+    """Fixed capacity ring buffer of the last measurements, keeping a running sum and
+    a running variance (Welford) so that adding a measurement costs O(1)"""
+
+    def __init__(self, capacity: int):
+        self._capacity = capacity
+        self._values = [0.0] * capacity
+        self._head = 0
+        self._size = 0
+        self._sum = 0.0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value: float) -> None:
+        value = float(value)
+
+        if self._size < self._capacity:
+            self._size += 1
+
+            # welford's update
+            delta = value - self._mean
+            self._mean += delta / self._size
+            self._m2 += delta * (value - self._mean)
+            self._sum += value
+        else:
+            evicted_value = self._values[self._head]
+
+            # welford's update for a sliding window - replace the evicted value
+            previous_mean = self._mean
+            self._mean += (value - evicted_value) / self._size
+            self._m2 += (value - evicted_value) * (
+                value - self._mean + evicted_value - previous_mean
+            )
+            self._sum += value - evicted_value
+
+        self._values[self._head] = value
+        self._head = (self._head + 1) % self._capacity
+
+        # every time the buffer wraps around recalculate the sum exactly, so that
+        # floating point error doesn't accumulate over long runs (amortized O(1))
+        if self._head == 0 and self._size == self._capacity:
+            self._sum = math.fsum(self._values)
+            self._mean = self._sum / self._size
+            self._m2 = math.fsum((v - self._mean) ** 2 for v in self._values)
+
+    def values(self) -> List[float]:
+        """Returns the measurements in the window, oldest first (O(capacity))"""
+        if self._size < self._capacity:
+            return self._values[: self._size]
+
+        return self._values[self._head:] + self._values[: self._head]
+
+    @property
+    def full(self) -> bool:
+        return self._size == self._capacity
+
+    @property
+    def mean(self) -> float:
+        return self._sum / self._size
+
+    @property
+    def variance(self) -> float:
+        """Sample variance of the measurements in the window"""
+        if self._size < 2:
+            return 0.0
+
+        return max(self._m2, 0.0) / (self._size - 1)
+
+    def __len__(self) -> int:
+        return self._size
+
+
 class Monitor:
     def __init__(
         self,
@@ -34,9 +105,10 @@ class Monitor:
         inrush_measurements: int,
         allowed_max: float,
         allowed_average_diff: float,
-        expected_average_value: float,
+        expected_average_value: Optional[float],
         expected_average_history: int,
         on_event: Callable,
+        detectors: Sequence = (),
     ):
         self._logger = logger_instance
         self._station = station
@@ -45,12 +117,25 @@ class Monitor:
         self._allowed_average_diff = allowed_average_diff
         self._expected_average_value = expected_average_value
         self._expected_average_history = expected_average_history
-        self._measurements = []
+        self._measurements = MeasurementWindow(expected_average_history)
         self._num_measurements = 0
+        self._last_measurement = None
+        self._inrush_peak = None
         self._on_event = on_event
 
-        # only raise one alert per run
+        # how much measurements vary within the run, from the differences between
+        # successive measurements - unlike the variance, a leak starting mid-run adds a
+        # single difference rather than inflating it from then on
+        self._num_differences = 0
+        self._squared_differences_sum = 0.0
+
+        # further detectors (see detection) that check each measurement past inrush
+        self._detectors = list(detectors)
+
+        # only raise one alert per run. the detectors' alerts are statistical, so they
+        # are counted apart and never hold back the max/mean alerts
         self._event_raised = False
+        self._detector_event_raised = False
 
         self._logger.debug_with(
             "Created flow monitor",
@@ -60,30 +145,52 @@ class Monitor:
             allowed_average_diff=allowed_average_diff,
             expected_average_value=expected_average_value,
             expected_average_history=expected_average_history,
+            detectors=[detector.name for detector in self._detectors],
         )
 
     async def add_measurement(self, measurement: float) -> None:
-        self._logger.debug_with(
-            "Adding measurement",
-            name=self._station.name,
-            measurement=measurement,
-            num_measurements=self._num_measurements,
-        )
+
+        # this runs for every running station on every measurement, so don't even build
+        # the log fields unless they'll be logged
+        debug_enabled = self._logger.debug_enabled
+
+        if debug_enabled:
+            self._logger.debug_with(
+                "Adding measurement",
+                name=self._station.name,
+                measurement=measurement,
+                num_measurements=self._num_measurements,
+            )
 
         self._num_measurements += 1
 
         # ignore the initial number of measurements because inrush
         # will be much higher than average
         if self._num_measurements < self._inrush_measurements:
+            self._add_inrush_sample(measurement)
+
+            if debug_enabled:
+                self._logger.debug_with(
+                    "Ignoring inrush measurement",
+                    measurement=measurement,
+                    measurements_left=self._inrush_measurements - self._num_measurements,
+                )
+            return
+
+        # how high the flow went during inrush helps tune num_inrush_measurements and
+        # allowed_flow_rate_max
+        if self._inrush_peak is not None:
             self._logger.debug_with(
-                "Ignoring inrush measurement",
-                measurement=measurement,
-                measurements_left=self._inrush_measurements - self._num_measurements,
+                "Inrush ended", name=self._station.name, inrush_peak=self._inrush_peak
             )
-            return
+            self._inrush_peak = None
 
         # add to measurements
-        self._measurements.append(measurement)
+        self._measurements.add(measurement)
+        if self._last_measurement is not None:
+            self._num_differences += 1
+            self._squared_differences_sum += (measurement - self._last_measurement) ** 2
+        self._last_measurement = measurement
 
         # check if absolute maximum passed
         if measurement > self._allowed_max:
@@ -93,42 +200,191 @@ class Monitor:
                 )
             )
 
-        # if there's less than expected_average_history measurements, nothing to do
-        if len(self._measurements) < self._expected_average_history:
-            return
+        for detector in self._detectors:
+            event = detector.add(measurement, self._measurements, self.noise_variance)
 
-        measurements_for_mean = self._measurements[-self._expected_average_history :]
+            if event is not None and not self._detector_event_raised:
+                self._detector_event_raised = True
+                await self._on_event(event)
 
-        self._logger.debug_with("Calculating mean", measurements=measurements_for_mean)
+        # if there's less than expected_average_history measurements, nothing to do. a
+        # station without history (e.g. a new one) has no mean to compare with
+        if not self._measurements.full or self._expected_average_value is None:
+            return
 
-        # calculate average over the expected_average_history
-        measured_mean = statistics.mean(measurements_for_mean)
+        # the window holds the last expected_average_history measurements
+        measured_mean = self._measurements.mean
         mean_diff = measured_mean - self._expected_average_value
 
-        self._logger.debug_with(
-            "Calculated mean", measured_mean=measured_mean, mean_diff=mean_diff, allowed_diff=self._allowed_average_diff
-        )
+        if debug_enabled:
+            self._logger.debug_with(
+                "Calculated mean", measured_mean=measured_mean, mean_diff=mean_diff, allowed_diff=self._allowed_average_diff
+            )
 
         if mean_diff > abs(self._allowed_average_diff):
             await self._raise_event(
                 MeanDifferenceExceededEvent(
                     self._station,
-                    measurements_for_mean,
+                    self._measurements.values(),
                     measured_mean,
                     self._expected_average_value,
                     self._allowed_average_diff,
                 )
             )
 
+    async def check_measurement(self, measurement: float) -> None:
+        """Checks a measurement against the absolute maximum without adding it to the
+        measurements (e.g. when sampling between measurements)"""
+
+        # inrush measurements are ignored, other than for the inrush peak. the flow is
+        # sampled more often during inrush, so the peak is caught even if it's short
+        if self.in_inrush:
+            self._add_inrush_sample(measurement)
+            return
+
+        if measurement > self._allowed_max:
+            await self._raise_event(
+                MaxMeasurementExceededEvent(
+                    self._station, measurement, self._allowed_max
+                )
+            )
+
+    def near_limits(self, ratio: float) -> bool:
+        """Returns whether the last measurement or the mean are within the given ratio of
+        their allowed limits"""
+        if self._last_measurement is None:
+            return False
+
+        if self._last_measurement >= ratio * self._allowed_max:
+            return True
+
+        if not self._measurements.full or self._expected_average_value is None:
+            return False
+
+        mean_diff = self._measurements.mean - self._expected_average_value
+
+        return mean_diff >= ratio * abs(self._allowed_average_diff)
+
+    def update_thresholds(
+        self,
+        inrush_measurements: int,
+        allowed_max: float,
+        allowed_average_diff: float,
+        expected_average_history: int,
+    ) -> None:
+        """Applies new thresholds to a running station (e.g. when the configuration is
+        reloaded), keeping the measurements taken so far"""
+        self._inrush_measurements = inrush_measurements
+        self._allowed_max = allowed_max
+        self._allowed_average_diff = allowed_average_diff
+
+        # resize the window, keeping the latest measurements that still fit
+        if expected_average_history != self._expected_average_history:
+            measurements = MeasurementWindow(expected_average_history)
+
+            for measurement in self._measurements.values()[-expected_average_history:]:
+                measurements.add(measurement)
+
+            self._measurements = measurements
+            self._expected_average_history = expected_average_history
+
+        self._logger.debug_with(
+            "Updated flow monitor thresholds",
+            station=self._station.name,
+            inrush_measurements=inrush_measurements,
+            allowed_max=allowed_max,
+            allowed_average_diff=allowed_average_diff,
+            expected_average_history=expected_average_history,
+        )
+
+    def get_state(self) -> Dict:
+        """Returns the state of the run so far, for restore_state"""
+        return {
+            "expected_average_value": self._expected_average_value,
+            "num_measurements": self._num_measurements,
+            "measurements": self._measurements.values(),
+            "last_measurement": self._last_measurement,
+            "num_differences": self._num_differences,
+            "squared_differences_sum": self._squared_differences_sum,
+            "event_raised": self._event_raised,
+            "detector_event_raised": self._detector_event_raised,
+            "detectors": [
+                {"name": detector.name, "state": detector.get_state()}
+                for detector in self._detectors
+            ],
+        }
+
+    def restore_state(self, state: Dict) -> None:
+        """Resumes a run from get_state (e.g. after a restart), so that inrush isn't
+        ignored again and an alert that was raised isn't raised again"""
+        self._expected_average_value = state["expected_average_value"]
+        self._num_measurements = state["num_measurements"]
+        self._last_measurement = state["last_measurement"]
+        self._num_differences = state.get("num_differences", 0)
+        self._squared_differences_sum = state.get("squared_differences_sum", 0.0)
+        self._event_raised = state["event_raised"]
+        self._detector_event_raised = state.get("detector_event_raised", False)
+
+        # the history may have been reconfigured since
+        self._measurements = MeasurementWindow(self._expected_average_history)
+        for measurement in state["measurements"][-self._expected_average_history:]:
+            self._measurements.add(measurement)
+
+        # the detectors may have been reconfigured too - those that weren't running
+        # before start over (as do all, from snapshots that predate named states)
+        detector_states = {
+            detector_state["name"]: detector_state["state"]
+            for detector_state in state.get("detectors", [])
+            if "name" in detector_state
+        }
+        for detector in self._detectors:
+            detector_state = detector_states.get(detector.name)
+            if detector_state is not None:
+                detector.restore_state(detector_state)
+
+        self._logger.debug_with(
+            "Restored flow monitor",
+            station=self._station.name,
+            num_measurements=self._num_measurements,
+            event_raised=self._event_raised,
+        )
+
+    def _add_inrush_sample(self, measurement: float) -> None:
+        if self._inrush_peak is None or measurement > self._inrush_peak:
+            self._inrush_peak = measurement
+
     async def _raise_event(self, event: object) -> None:
         if self._event_raised:
             return
 
         self._event_raised = True
 
-        # call the event
-        asyncio.create_task(self._on_event(event))
+        # call the event - handlers only queue the event, so they don't hold up
+        # monitoring
+        await self._on_event(event)
 
     @property
     def station(self) -> pyopensprinkler.Station:
         return self._station
+
+    @property
+    def noise_variance(self) -> float:
+        """Variance of the run's measurements around their (possibly shifting) level"""
+        if not self._num_differences:
+            return 0.0
+
+        return self._squared_differences_sum / (2 * self._num_differences)
+
+    @property
+    def event_raised(self) -> bool:
+        """Whether an alert was raised during the run, by the monitor or its detectors"""
+        return self._event_raised or self._detector_event_raised
+
+    @property
+    def in_inrush(self) -> bool:
+        return self._num_measurements < self._inrush_measurements
+
+    @property
+    def inrush_peak(self) -> Optional[float]:
+        """The highest flow sampled during inrush so far, or None if not in inrush"""
+        return self._inrush_peak
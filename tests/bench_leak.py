@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+import pytest
+
+import leak
+import logger
+
+
+class _Station:
+    def __init__(self, index: int):
+        self.index = index
+        self.name = f"Station {index}"
+        self.is_running = True
+        self.is_master = False
+        self.running_program_id = 1
+
+
+class _Controller:
+    def __init__(self, num_stations: int):
+        self.stations = {index: _Station(index) for index in range(num_stations)}
+        self.flow_rate = 10.0 * num_stations
+
+
+def _create_detector(controller: _Controller) -> leak.Detector:
+    config = {
+        "controller": {"liters_per_tick": 10},
+        "detector": {
+            "averages_history_days": 30,
+            "running_station_interval_seconds": 30,
+            "stations": {
+                "default": {
+                    "flow_rate_average_history_meansurements": 6,
+                    "allowed_flow_rate_diff_from_average": 1,
+                    "num_inrush_measurements": 4,
+                    "allowed_flow_rate_max": 8,
+                }
+            },
+        },
+    }
+
+    detector = leak.Detector(logger.Logger(level="INFO"), controller, config, None)
+    detector._station_averages.add(
+        [(0, leak.get_baseline_key(index), 1.0) for index in controller.stations]
+    )
+
+    return detector
+
+
+# 72 stations is the OpenSprinkler maximum with expansion boards
+@pytest.mark.parametrize("num_stations", [8, 32, 72])
+def test_update_station_flow_monitors(num_stations: int):
+    num_ticks = 1000
+    controller = _Controller(num_stations)
+    detector = _create_detector(controller)
+
+    async def _tick():
+        for _ in range(num_ticks):
+            await detector._update_station_flow_monitors()
+
+    start = time.perf_counter()
+    asyncio.run(_tick())
+    duration = time.perf_counter() - start
+
+    assert len(detector._station_flow_monitors) == num_stations
+
+    print(
+        f"\n{num_stations} running stations: {1e6 * duration / num_ticks:.1f}us/tick, "
+        f"{1e6 * duration / (num_ticks * num_stations):.2f}us/station"
+    )
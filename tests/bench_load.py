@@ -0,0 +1,149 @@
+import contextlib
+import time
+
+import aiohttp
+import pyopensprinkler
+import pytest
+
+import leak
+import log_store
+import logger
+import report
+import simulator
+
+
+@contextlib.asynccontextmanager
+async def _get_controller(port: int, num_stations: int, latency_seconds: float = 0.0):
+    """Yields a controller pointed at a simulator of num_stations, and the simulator"""
+    simulator_instance = simulator.Simulator(
+        logger.Logger(level="INFO"),
+        [simulator.Station(f"Station {index}", 2.0) for index in range(num_stations)],
+        latency_seconds=latency_seconds,
+    )
+    await simulator_instance.start("127.0.0.1", port)
+
+    try:
+        async with aiohttp.ClientSession() as http_session:
+            yield pyopensprinkler.Controller(
+                f"http://127.0.0.1:{port}", "opendoor", {"session": http_session}
+            ), simulator_instance
+    finally:
+        await simulator_instance.stop()
+
+
+def _create_detector(
+    controller: pyopensprinkler.Controller, store: log_store.Store, history_days: int
+) -> leak.Detector:
+    config = {
+        "controller": {"liters_per_tick": 10},
+        "detector": {
+            "averages_history_days": history_days,
+            "running_station_interval_seconds": 30,
+            "min_sample_interval_seconds": 0,
+            "stations": {
+                "default": {
+                    "flow_rate_average_history_meansurements": 6,
+                    "allowed_flow_rate_diff_from_average": 1,
+                    "num_inrush_measurements": 4,
+                    "allowed_flow_rate_max": 8,
+                }
+            },
+        },
+    }
+
+    return leak.Detector(logger.Logger(level="INFO"), controller, config, store)
+
+
+# a detector tick - sampling the controller and feeding the running stations' monitors
+# - with all stations running, over the loopback and over a slow link
+@pytest.mark.parametrize("latency_seconds", [0.0, 0.02])
+@pytest.mark.parametrize("num_stations", [8, 32, 72])
+@pytest.mark.asyncio
+async def test_detector_tick(unused_tcp_port, num_stations: int, latency_seconds: float):
+    num_ticks = 100
+
+    async with _get_controller(unused_tcp_port, num_stations, latency_seconds) as (
+        controller,
+        simulator_instance,
+    ):
+        for station_index in range(num_stations):
+            simulator_instance.run_station(station_index, 60 * 60)
+
+        detector = _create_detector(controller, None, 30)
+        detector._station_averages.add(
+            [(0, leak.get_baseline_key(index), 2.0) for index in range(num_stations)]
+        )
+
+        start = time.perf_counter()
+        for _ in range(num_ticks):
+            await detector._sampler.sample()
+            await detector._update_station_flow_monitors()
+        duration = time.perf_counter() - start
+
+        requests = dict(simulator_instance.requests)
+
+    assert len(detector._station_flow_monitors) == num_stations
+
+    print(
+        f"\n{num_stations} running stations, {1000 * latency_seconds:.0f}ms latency: "
+        f"{1000 * duration / num_ticks:.2f}ms/tick, requests {requests}"
+    )
+
+
+# reading the averages' history from the controller into an empty log store, and then
+# folding in what arrived since
+@pytest.mark.parametrize("history_days", [30, 180, 365])
+@pytest.mark.asyncio
+async def test_averages_refresh(unused_tcp_port, tmp_path, history_days: int):
+    async with _get_controller(unused_tcp_port, 32) as (controller, simulator_instance):
+        simulator_instance.synthesize_logs(history_days, runs_per_day=3)
+        await controller.refresh()
+
+        store = log_store.Store(logger.Logger(level="INFO"), controller, str(tmp_path), history_days)
+        detector = _create_detector(controller, store, history_days)
+
+        try:
+            start = time.perf_counter()
+            await detector._update_station_averages()
+            cold_duration = time.perf_counter() - start
+
+            start = time.perf_counter()
+            await detector._update_station_averages()
+            warm_duration = time.perf_counter() - start
+        finally:
+            await store.close()
+
+    print(
+        f"\n{history_days} days, {len(detector._station_averages)} values: "
+        f"cold {cold_duration:.3f}s, warm {warm_duration:.3f}s"
+    )
+
+
+# building a report - refresh, rollups and rendering - over growing histories
+@pytest.mark.parametrize("history_days", [30, 180, 365])
+@pytest.mark.asyncio
+async def test_report_build(unused_tcp_port, tmp_path, history_days: int):
+    async with _get_controller(unused_tcp_port, 32) as (controller, simulator_instance):
+        simulator_instance.synthesize_logs(history_days, runs_per_day=3)
+
+        store = log_store.Store(logger.Logger(level="INFO"), controller, str(tmp_path), history_days)
+        generator = report.Generator(controller, store, dpi=100)
+
+        try:
+
+            # the first report reads the history from the controller
+            start = time.perf_counter()
+            await generator.generate(history_days)
+            cold_duration = time.perf_counter() - start
+
+            start = time.perf_counter()
+            report_contents, _ = await generator.generate(history_days)
+            warm_duration = time.perf_counter() - start
+        finally:
+            generator.close()
+            await store.close()
+
+    print(
+        f"\n{history_days} days: cold {cold_duration:.3f}s, warm {warm_duration:.3f}s "
+        f"({len(report_contents)} bytes)"
+    )
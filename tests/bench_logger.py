@@ -0,0 +1,74 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import logger
+import station_flow
+
+
+class _Station:
+    def __init__(self):
+        self.index = 0
+        self.name = "test"
+
+
+class _EagerLogger(logger.Logger):
+    """The previous logger, which built the record fields regardless of the level"""
+
+    @property
+    def debug_enabled(self):
+        return True
+
+    def debug_with(self, message, *args, **kw_args):
+        self._logger.debug(message, *args, extra={"with": kw_args})
+
+
+async def _on_event(event):
+    pass
+
+
+# measurement throughput with logging disabled (INFO) and enabled (DEBUG), writing to
+# /dev/null either directly or through the asynchronous sink
+@pytest.mark.parametrize(
+    "logger_class,level,asynchronous",
+    [
+        (_EagerLogger, "INFO", False),
+        (logger.Logger, "INFO", False),
+        (logger.Logger, "DEBUG", False),
+        (logger.Logger, "DEBUG", True),
+    ],
+)
+def test_add_measurement(logger_class, level: str, asynchronous: bool):
+    num_measurements = 50_000
+    root_logger = logger_class(level=level)
+
+    with open(os.devnull, "w") as devnull:
+        root_logger.set_handler("bench", devnull, logger.HumanReadableFormatter(), asynchronous)
+
+        monitor = station_flow.Monitor(
+            root_logger,
+            station=_Station(),
+            inrush_measurements=0,
+            allowed_max=1000.0,
+            allowed_average_diff=1000.0,
+            expected_average_value=1.8,
+            expected_average_history=10,
+            on_event=_on_event,
+        )
+
+        async def _add_measurements():
+            for measurement_idx in range(num_measurements):
+                await monitor.add_measurement(1.0 + (measurement_idx % 7) / 10)
+
+        start = time.perf_counter()
+        asyncio.run(_add_measurements())
+        duration = time.perf_counter() - start
+
+        root_logger.close()
+
+    print(
+        f"\n{logger_class.__name__} {level} (asynchronous: {asynchronous}): "
+        f"{num_measurements / duration:,.0f} measurements/s"
+    )
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import sys
+import time
+
+import aiohttp.web
+import pytest
+import yaml
+
+
+_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def _get_seconds_to_first_refresh(config_path: str, port: int, prelude: str) -> float:
+    first_request = asyncio.get_running_loop().create_future()
+
+    async def _handle(request: aiohttp.web.Request) -> aiohttp.web.Response:
+        if not first_request.done():
+            first_request.set_result(time.perf_counter())
+
+        return aiohttp.web.json_response({"result": 1})
+
+    app = aiohttp.web.Application()
+    app.router.add_route("GET", "/{path:.*}", _handle)
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, "127.0.0.1", port).start()
+
+    start = time.perf_counter()
+
+    # run main.py the way the container does, with whatever the prelude imports up front
+    process = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-c",
+        f"{prelude}; import runpy, sys; sys.argv = ['main.py', '--config-path', {config_path!r}]; "
+        "runpy.run_path('main.py', run_name='__main__')",
+        cwd=_ROOT_PATH,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+
+    try:
+        return await asyncio.wait_for(first_request, 60) - start
+    finally:
+        if process.returncode is None:
+            process.kill()
+
+        await process.wait()
+        await runner.cleanup()
+
+
+@pytest.fixture
+def config_path(tmp_path, unused_tcp_port):
+    config = {
+        "controller": {
+            "url": f"http://127.0.0.1:{unused_tcp_port}",
+            "password": "password",
+            "liters_per_tick": 10,
+        },
+        "log_store": {"directory": str(tmp_path)},
+        "detector": {
+            "averages_history_days": 30,
+            "averages_update_interval_hours": 10,
+            "running_station_interval_seconds": 30,
+            "stations": {},
+        },
+        "report": {"schedule": "0 0 * * FRI", "generator": {"history_days": 30}},
+    }
+
+    config_path = tmp_path / "leak.yaml"
+    config_path.write_text(yaml.dump(config))
+
+    return str(config_path)
+
+
+# time from process start to the first controller refresh, with the reporting stack
+# imported lazily (as main.py does) and eagerly (as it used to)
+@pytest.mark.parametrize("prelude", ["pass", "import report"])
+@pytest.mark.asyncio
+async def test_time_to_first_refresh(config_path, unused_tcp_port, prelude):
+    seconds = await _get_seconds_to_first_refresh(config_path, unused_tcp_port, prelude)
+
+    print(f"\n{prelude}: {seconds:.3f}s to first refresh")
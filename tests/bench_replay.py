@@ -0,0 +1,54 @@
+import random
+import time
+
+import pytest
+
+import replay
+
+
+def _get_series(num_runs: int, num_measurements: int) -> replay.Series:
+    rng = random.Random(num_runs)
+    runs = []
+    leak_starts = []
+
+    for run_index in range(num_runs):
+        run = [rng.gauss(2.0, 0.3) for _ in range(num_measurements)]
+        leak_start = rng.randrange(num_measurements) if run_index % 10 == 0 else -1
+
+        if leak_start >= 0:
+            run[leak_start:] = [measurement + 1.5 for measurement in run[leak_start:]]
+
+        runs.append(run)
+        leak_starts.append(leak_start)
+
+    return replay.Series(["station"] * num_runs, runs, [2.0] * num_runs, leak_starts)
+
+
+# a season of runs (e.g. 32 stations running daily for a month, a measurement every 30
+# seconds for 20 minutes) against 10,000 threshold combinations
+@pytest.mark.parametrize("num_runs", [100, 1_000])
+def test_replay(num_runs: int):
+    series = _get_series(num_runs, 40)
+    grid = replay.Grid(
+        list(range(10)),
+        [3.0 + 0.5 * index for index in range(10)],
+        [0.1 * index for index in range(1, 11)],
+        list(range(1, 11)),
+    )
+    num_combinations = len(grid.inrush_measurements) * len(grid.allowed_max) * len(
+        grid.allowed_average_diff
+    ) * len(grid.expected_average_history)
+
+    start = time.perf_counter()
+    alert_indexes = replay.get_alert_indexes(series, grid)
+    replay_duration = time.perf_counter() - start
+
+    start = time.perf_counter()
+    replay.get_results(series, grid, alert_indexes, 30)
+    results_duration = time.perf_counter() - start
+
+    print(
+        f"\n{num_runs} runs x {num_combinations} combinations: replay {replay_duration:.3f}s "
+        f"({1e9 * replay_duration / (num_runs * num_combinations * 40):.1f}ns/measurement), "
+        f"results {results_duration:.3f}s"
+    )
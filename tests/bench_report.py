@@ -0,0 +1,172 @@
+import asyncio
+import concurrent.futures
+import datetime
+import multiprocessing
+import random
+import time
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import log_store
+import logger
+import report
+
+
+class _Station:
+    def __init__(self, index: int):
+        self.index = index
+        self.name = f"Station {index}"
+
+
+class _Controller:
+    def __init__(self, logs: List):
+        self.logs = logs
+
+    async def get_logs(self, days: int) -> List:
+        return self.logs
+
+
+def _get_stations(num_stations: int) -> Dict[int, _Station]:
+    return {index: _Station(index) for index in range(num_stations)}
+
+
+def _get_scheduled_logs(num_days: int, num_stations: int, runs_per_day: int) -> List:
+    rng = random.Random(num_days)
+    start_time = int(time.time()) - num_days * 24 * 60 * 60
+    logs = []
+
+    # stations run one after the other, a few times a day
+    for day in range(num_days):
+        for run in range(runs_per_day):
+            run_start_time = start_time + day * 24 * 60 * 60 + run * 8 * 60 * 60
+
+            for station_index in range(num_stations):
+                duration_seconds = rng.randint(60, 600)
+                run_start_time += duration_seconds
+                logs.append([1, station_index, duration_seconds, run_start_time, rng.uniform(0.5, 4.0)])
+
+    return logs
+
+
+def _get_rollups(num_days: int, num_stations: int) -> List:
+    rng = random.Random(num_days)
+    today = datetime.date.today()
+
+    return [
+        [str(today - datetime.timedelta(days=day_offset)), station_index, rng.uniform(10, 100), rng.uniform(0.5, 4.0), 1]
+        for day_offset in range(num_days, 0, -1)
+        for station_index in range(num_stations)
+    ]
+
+
+async def _get_max_poll_lag(work) -> float:
+    interval = 0.01
+    max_lag = 0.0
+    task = asyncio.ensure_future(work)
+
+    # simulate the detector's polling loop, measuring how late each wake up is
+    while not task.done():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - start - interval)
+
+    await task
+
+    return max_lag
+
+
+def _sanitize_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.replace({0.0: np.nan})
+    return df.dropna(axis=1, how="all")
+
+
+def _get_daily_liters_dataframe(stations: Dict[int, _Station], logs: List) -> pd.DataFrame:
+    # the original per-report work on the raw logs, kept here as the baseline
+    logs_df = pd.DataFrame(
+        {
+            "station_name": [stations[log[1]].name for log in logs],
+            "liters": [10.0 * log[4] * log[2] / 60.0 for log in logs],
+            "start_time": [datetime.datetime.fromtimestamp(log[3] - log[2]) for log in logs],
+        }
+    )
+
+    pivot_df = logs_df.pivot(values="liters", index=["start_time"], columns=["station_name"])
+    pivot_df = pivot_df.groupby(pivot_df.index.date).sum()
+
+    return _sanitize_dataframe(pivot_df)
+
+
+# the data a report needs from years of logs for 32 stations, each running a few times
+# a day - read from the raw logs vs. from the daily rollups
+@pytest.mark.parametrize("num_years", [1, 3])
+@pytest.mark.asyncio
+async def test_daily_rollups(tmp_path, num_years: int):
+    stations = _get_stations(32)
+    num_days = num_years * 365
+    controller = _Controller(_get_scheduled_logs(num_days, len(stations), 3))
+    store = log_store.Store(logger.Logger(level="INFO"), controller, str(tmp_path), num_days)
+    renderer = report.Renderer()
+
+    # store the history up front, nothing new arrives while measuring
+    await store.update()
+    controller.logs = []
+
+    try:
+        start = time.perf_counter()
+        logs = await store.get_logs(num_days + 1)
+        daily_liters_df = _get_daily_liters_dataframe(stations, logs)
+        logs_duration = time.perf_counter() - start
+
+        start = time.perf_counter()
+        rollups = await store.get_daily_rollups(num_days + 1)
+        aggregates = renderer._get_aggregates(
+            renderer._get_daily_dataframe(
+                {index: station.name for index, station in stations.items()},
+                report._get_rollups_columns(rollups),
+            )
+        )
+        rollups_duration = time.perf_counter() - start
+    finally:
+        await store.close()
+
+    print(
+        f"\n{num_years} years: {len(logs)} logs {logs_duration:.3f}s, "
+        f"{len(rollups)} rollups {rollups_duration:.3f}s"
+    )
+
+    pd.testing.assert_frame_equal(aggregates.daily_liters, daily_liters_df, check_names=False)
+
+
+# how late the detector's polling loop wakes up while a report renders - in a worker
+# process, as reports are, vs. in a thread of the detector's process
+@pytest.mark.parametrize("executor_type", ["process", "thread"])
+@pytest.mark.asyncio
+async def test_render_poll_lag(executor_type: str):
+    station_names = {index: f"Station {index}" for index in range(16)}
+    rollups_columns = report._get_rollups_columns(_get_rollups(365, len(station_names)))
+
+    if executor_type == "process":
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("spawn")
+        )
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    try:
+
+        # start the worker up front so that its startup isn't measured
+        await asyncio.get_running_loop().run_in_executor(executor, int)
+
+        idle_lag = await _get_max_poll_lag(asyncio.sleep(1))
+        render_lag = await _get_max_poll_lag(
+            asyncio.get_running_loop().run_in_executor(
+                executor, report._render_in_worker, station_names, rollups_columns, 600
+            )
+        )
+    finally:
+        executor.shutdown()
+
+    print(f"\n{executor_type}: max poll lag idle {idle_lag:.3f}s, rendering {render_lag:.3f}s")
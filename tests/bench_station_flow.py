@@ -0,0 +1,107 @@
+import asyncio
+import statistics
+import time
+
+import pytest
+
+import averages
+import detection
+import logger
+import station_flow
+
+
+class _Station:
+    def __init__(self):
+        self.index = 0
+        self.name = "test"
+
+
+async def _on_event(event):
+    pass
+
+
+def _get_detectors(detector_names) -> list:
+    histogram = averages.Histogram()
+    for value in range(1, 100):
+        histogram.add(value / 10)
+
+    # thresholds high enough that nothing is raised, so every detector runs throughout
+    baseline = detection.Baseline(1.8, 100.0, histogram)
+    return [
+        detection.detector_types[detector_name](_Station(), baseline)
+        for detector_name in detector_names
+    ]
+
+
+def _create_monitor(expected_average_history: int, detectors=()) -> station_flow.Monitor:
+    return station_flow.Monitor(
+        logger.Logger(level="INFO"),
+        station=_Station(),
+        inrush_measurements=0,
+        allowed_max=1000.0,
+        allowed_average_diff=1000.0,
+        expected_average_value=1.8,
+        expected_average_history=expected_average_history,
+        on_event=_on_event,
+        detectors=detectors,
+    )
+
+
+# cost per measurement should stay flat as the window and the run length grow
+@pytest.mark.parametrize("expected_average_history", [10, 1_000, 100_000])
+@pytest.mark.parametrize("num_measurements", [10_000, 200_000])
+def test_add_measurement(expected_average_history: int, num_measurements: int):
+    monitor = _create_monitor(expected_average_history)
+
+    async def _add_measurements():
+        for measurement_idx in range(num_measurements):
+            await monitor.add_measurement(1.0 + (measurement_idx % 7) / 10)
+
+    start = time.perf_counter()
+    asyncio.run(_add_measurements())
+    duration = time.perf_counter() - start
+
+    print(
+        f"\nwindow {expected_average_history}, {num_measurements} measurements: "
+        f"{1e6 * duration / num_measurements:.2f}us/measurement"
+    )
+
+
+# cost per measurement of each detector on top of the monitor's own checks
+@pytest.mark.parametrize(
+    "detector_names", [[], ["ewma"], ["cusum"], ["percentile"], ["zscore"], list(detection.detector_types)]
+)
+def test_add_measurement_detectors(detector_names):
+    num_measurements = 100_000
+    monitor = _create_monitor(10, _get_detectors(detector_names))
+
+    async def _add_measurements():
+        for measurement_idx in range(num_measurements):
+            await monitor.add_measurement(1.0 + (measurement_idx % 7) / 10)
+
+    start = time.perf_counter()
+    asyncio.run(_add_measurements())
+    duration = time.perf_counter() - start
+
+    print(f"\ndetectors {detector_names}: {1e6 * duration / num_measurements:.2f}us/measurement")
+
+
+# the previous implementation - slice the last window and statistics.mean() it
+@pytest.mark.parametrize("expected_average_history", [10, 1_000])
+def test_slice_and_mean_baseline(expected_average_history: int):
+    num_measurements = 10_000
+    measurements = []
+
+    start = time.perf_counter()
+    for measurement_idx in range(num_measurements):
+        measurements.append(1.0 + (measurement_idx % 7) / 10)
+
+        if len(measurements) >= expected_average_history:
+            statistics.mean(measurements[-expected_average_history:])
+
+    duration = time.perf_counter() - start
+
+    print(
+        f"\nbaseline window {expected_average_history}: "
+        f"{1e6 * duration / num_measurements:.2f}us/measurement"
+    )
@@ -0,0 +1,103 @@
+import pytest
+import random
+import statistics
+import averages
+
+
+class TestAccumulator:
+
+    # verify that averages only cover the values within the history window
+    def test_expire(self):
+        accumulator = averages.Accumulator(history_seconds=100)
+
+        accumulator.add([(10, 1, 1.0), (20, 2, 4.0), (50, 1, 3.0)])
+        accumulator.expire(now=100)
+        assert accumulator.get_average(1) == 2.0
+        assert accumulator.get_average(2) == 4.0
+
+        accumulator.add([(120, 1, 5.0)])
+        accumulator.expire(now=130)
+        assert accumulator.get_average(1) == 4.0
+        assert 2 not in accumulator
+        assert len(accumulator) == 2
+
+        with pytest.raises(KeyError):
+            accumulator.get_average(2)
+
+    # verify that values expire on time even when a batch is older than the previous
+    # one
+    def test_expire_out_of_order(self):
+        accumulator = averages.Accumulator(history_seconds=100)
+
+        accumulator.add([(90, 1, 1.0), (80, 1, 3.0)])
+        accumulator.add([(10, 1, 100.0), (50, 2, 4.0)])
+        accumulator.expire(now=150)
+
+        assert accumulator.get_average(1) == 2.0
+        assert accumulator.get_average(2) == 4.0
+        assert len(accumulator) == 3
+
+    # verify that a key that comes back after all its values expired starts over
+    def test_key_returns(self):
+        accumulator = averages.Accumulator(history_seconds=100)
+
+        accumulator.add([(10, 1, 1e9), (20, 2, 4.0)])
+        accumulator.expire(now=150)
+        assert 1 not in accumulator
+        assert accumulator.get_count(1) == 0
+
+        accumulator.add([(200, 1, 0.5), (210, 1, 1.5)])
+        assert accumulator.get_average(1) == 1.0
+        assert accumulator.get_variance(1) == 0.5
+        assert accumulator.get_histogram(1).get_percentile(100) == pytest.approx(1.5, rel=0.05)
+        assert accumulator.to_dict() == {1: {"average": 1.0, "count": 2}}
+
+    # verify that adding and expiring many values doesn't accumulate error
+    def test_no_drift(self):
+        rng = random.Random(0)
+        accumulator = averages.Accumulator(history_seconds=1000)
+        values = [(end_time, 1, rng.uniform(0, 1e6) * 10 ** rng.randint(-6, 0)) for end_time in range(100000)]
+
+        for batch_start in range(0, len(values), 500):
+            accumulator.add(values[batch_start:batch_start + 500])
+            accumulator.expire(now=values[batch_start + 499][0])
+
+        expected_average = statistics.mean(value for _, _, value in values[-1001:])
+        assert accumulator.get_average(1) == pytest.approx(expected_average, rel=1e-12)
+
+    # verify that the variance and percentiles cover the values within the history
+    # window, like the average
+    def test_distribution(self):
+        rng = random.Random(1)
+        accumulator = averages.Accumulator(history_seconds=1000)
+        values = [(end_time, 1, rng.lognormvariate(0, 0.5)) for end_time in range(5000)]
+
+        accumulator.add(values)
+        accumulator.expire(now=4999)
+
+        window_values = [value for _, _, value in values[-1001:]]
+        assert accumulator.get_count(1) == 1001
+        assert accumulator.get_variance(1) == pytest.approx(statistics.variance(window_values), rel=1e-9)
+
+        # percentiles are within a bin (5%) of the exact ones
+        for percentile in [1, 50, 99]:
+            exact_percentile = statistics.quantiles(window_values, n=100, method="inclusive")[percentile - 1]
+            assert accumulator.get_histogram(1).get_percentile(percentile) == pytest.approx(
+                exact_percentile, rel=0.06
+            )
+
+
+class TestHistogram:
+
+    # verify that zeros fall in their own bin and that removed values are forgotten
+    def test_add_remove(self):
+        histogram = averages.Histogram()
+
+        histogram.add(0.0)
+        histogram.add(2.0)
+        histogram.add(100.0)
+        histogram.add(100.0, -1)
+
+        assert len(histogram) == 2
+        assert histogram.get_percentile(50) == 0.0
+        assert histogram.get_percentile(100) == pytest.approx(2.0, rel=0.05)
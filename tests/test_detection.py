@@ -0,0 +1,135 @@
+import pytest
+import random
+
+import averages
+import detection
+import station_flow
+
+
+class _Station:
+    def __init__(self):
+        self.name = "test"
+
+
+def _get_baseline(mean: float = 2.0, std: float = 0.05) -> detection.Baseline:
+    rng = random.Random(0)
+    accumulator = averages.Accumulator(history_seconds=1000)
+    accumulator.add([(end_time, 0, rng.gauss(mean, std)) for end_time in range(200)])
+
+    return detection.Baseline.from_accumulator(accumulator, 0)
+
+
+def _get_event_index(detector: detection.Detector, measurements) -> int:
+    """Returns the index of the measurement an event was raised for, or -1. Measurements
+    are fed the way a monitor with a window of 6 feeds them"""
+    window = station_flow.MeasurementWindow(6)
+    squared_differences = []
+
+    for measurement_index, measurement in enumerate(measurements):
+        window.add(measurement)
+        if measurement_index:
+            squared_differences.append((measurement - measurements[measurement_index - 1]) ** 2)
+
+        noise_variance = (
+            sum(squared_differences) / (2 * len(squared_differences)) if squared_differences else 0.0
+        )
+
+        if detector.add(measurement, window, noise_variance) is not None:
+            return measurement_index
+
+    return -1
+
+
+def _get_run(rng: random.Random, num_measurements: int, baseline_std: float, noise_std: float):
+    """Measurements of a normal run - runs differ by the baseline's spread, and the
+    measurements within a run by the noise"""
+    level = rng.gauss(2.0, baseline_std)
+
+    return [rng.gauss(level, noise_std) for _ in range(num_measurements)]
+
+
+class TestDetectors:
+
+    # verify that each detector is quiet while the flow is as usual, and raises once it
+    # leaks
+    @pytest.mark.parametrize("detector_name", list(detection.detector_types))
+    def test_leak(self, detector_name):
+        baseline = _get_baseline()
+        measurements = _get_run(random.Random(1), 100, 0.0, 0.15) + [3.5] * 10
+
+        event_index = _get_event_index(
+            detection.detector_types[detector_name](_Station(), baseline), measurements
+        )
+
+        assert 100 <= event_index < 110
+
+    # verify that normal runs don't raise when measurements within a run spread much
+    # more than the averages of past runs do (as is usually the case)
+    @pytest.mark.parametrize("detector_name", list(detection.detector_types))
+    def test_noisy_runs(self, detector_name):
+        baseline = _get_baseline(std=0.057)
+        rng = random.Random(2)
+
+        num_raised = sum(
+            _get_event_index(
+                detection.detector_types[detector_name](_Station(), baseline),
+                _get_run(rng, 120, 0.057, 0.15),
+            )
+            >= 0
+            for _ in range(200)
+        )
+
+        assert num_raised <= 2
+
+    # verify that a small persistent increase (a drip), which never takes the window
+    # far from the mean given the noise, is caught by the cumulative sum
+    def test_drip(self):
+        baseline = _get_baseline()
+        measurements = [1.85, 2.15] * 5 + [2.15, 2.45] * 30
+
+        assert _get_event_index(detection.ZScoreDetector(_Station(), baseline), measurements) == -1
+        assert _get_event_index(detection.CusumDetector(_Station(), baseline), measurements) > 10
+
+    # verify that a detector's run state survives a restart
+    def test_restore_state(self):
+        baseline = _get_baseline()
+        detector = detection.CusumDetector(_Station(), baseline)
+        _get_event_index(detector, [2.3, 2.5] * 5)
+
+        restored_detector = detection.CusumDetector(_Station(), baseline)
+        restored_detector.restore_state(detector.get_state())
+
+        assert restored_detector.get_state() == detector.get_state() != {"sum": 0.0}
+
+
+class TestFactory:
+
+    # verify that detectors are only created for stations with enough history
+    def test_create(self):
+        factory = detection.Factory({"min_history": 10, "ewma": {"alpha": 0.5}, "zscore": None})
+
+        assert [detector.name for detector in factory.create(_Station(), _get_baseline())] == [
+            "ewma",
+            "zscore",
+        ]
+        assert factory.create(_Station(), None) == []
+        assert factory.create(_Station(), _get_baseline(std=0)) == []
+
+        accumulator = averages.Accumulator(history_seconds=1000)
+        accumulator.add([(0, 0, 1.0), (1, 0, 2.0)])
+        assert factory.create(_Station(), detection.Baseline.from_accumulator(accumulator, 0)) == []
+
+    # verify that configuration errors are raised when the factory is created
+    @pytest.mark.parametrize(
+        "detection_config",
+        [
+            {"median": {}},
+            {"ewma": {"beta": 0.5}},
+            {"ewma": {"alpha": "0.5"}},
+            {"ewma": [0.5]},
+            {"min_history": 1},
+        ],
+    )
+    def test_invalid(self, detection_config):
+        with pytest.raises(ValueError):
+            detection.Factory(detection_config)
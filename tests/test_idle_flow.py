@@ -0,0 +1,88 @@
+import pytest
+import idle_flow
+import logger
+
+
+@pytest.fixture
+def events():
+    return []
+
+
+@pytest.fixture
+def monitor(events):
+    async def _on_event(event):
+        events.append(event)
+
+    return idle_flow.Monitor(
+        logger.Logger(level="DEBUG"),
+        allowed_diff=0.5,
+        num_measurements=2,
+        learning_rate=0.5,
+        grace_seconds=60,
+        seed_measurements=0,
+        on_event=_on_event,
+    )
+
+
+class TestIdleFlowMonitor:
+
+    # verify that the idle flow is learned, and that flow far above it is raised once
+    # until it's back to normal
+    @pytest.mark.asyncio
+    async def test_learn_and_raise(self, monitor, events):
+        for now, measurement in enumerate([0.2] * 10):
+            await monitor.add_measurement(measurement, now)
+
+        assert monitor.baseline == pytest.approx(0.2, abs=0.01)
+
+        # a single spike isn't enough
+        for now, measurement in enumerate([1.0, 0.2, 1.0, 1.0, 1.0], 10):
+            await monitor.add_measurement(measurement, now)
+
+        assert len(events) == 1
+        assert isinstance(events[0], idle_flow.IdleFlowEvent)
+        assert events[0].measurement == 1.0
+
+        # the leak wasn't learned
+        assert monitor.baseline == pytest.approx(0.2, abs=0.01)
+
+        for now, measurement in enumerate([0.2, 1.0, 1.0], 20):
+            await monitor.add_measurement(measurement, now)
+
+        assert len(events) == 2
+
+    # verify that flow right after stations stop is ignored
+    @pytest.mark.asyncio
+    async def test_grace(self, monitor, events):
+        monitor.set_stations_running(100)
+
+        for now in range(100, 160, 10):
+            await monitor.add_measurement(5.0, now)
+
+        assert events == []
+
+        await monitor.add_measurement(5.0, 160)
+        await monitor.add_measurement(5.0, 170)
+        assert len(events) == 1
+
+    # verify that a steady idle flow (e.g. a sensor that ticks on its own) is learned
+    # from the first measurements rather than alerted on, and kept across a restart
+    @pytest.mark.asyncio
+    async def test_seed(self, monitor, events):
+        monitor._seed_measurements = 4
+
+        for now, measurement in enumerate([1.0, 1.2, 0.8, 1.0, 1.1, 0.9] * 5):
+            await monitor.add_measurement(measurement, now)
+
+        assert events == []
+        assert monitor.baseline == pytest.approx(1.0, abs=0.1)
+
+        restored_monitor = idle_flow.Monitor(
+            monitor._logger, 0.5, 2, 0.5, 60, 4, monitor._on_event
+        )
+        restored_monitor.restore_state(monitor.get_state())
+
+        for now, measurement in enumerate([2.0, 2.0], 30):
+            await restored_monitor.add_measurement(measurement, now)
+
+        assert len(events) == 1
@@ -0,0 +1,358 @@
+import pytest
+import copy
+import leak
+import logger
+import snapshot
+
+
+class _Station:
+    def __init__(self, index: int):
+        self.index = index
+        self.name = f"Station {index}"
+        self.is_running = False
+        self.is_master = False
+        self.start_time = 0
+        self.running_program_id = 0
+
+
+class _Controller:
+    def __init__(self, num_stations: int):
+        self.stations = {index: _Station(index) for index in range(num_stations)}
+        self.flow_rate = 0.0
+
+
+class _NotificationDispatcher:
+    def __init__(self):
+        self.texts = []
+
+    def notify(self, text: str) -> bool:
+        self.texts.append(text)
+        return True
+
+
+@pytest.fixture
+def config():
+    return {
+        "controller": {"liters_per_tick": 10},
+        "detector": {
+            "averages_history_days": 30,
+            "running_station_interval_seconds": 30,
+            "stations": {
+                "default": {
+                    "flow_rate_average_history_meansurements": 2,
+                    "allowed_flow_rate_diff_from_average": 1,
+                    "num_inrush_measurements": 0,
+                    "allowed_flow_rate_max": 8,
+                }
+            },
+        },
+    }
+
+
+@pytest.fixture
+def controller():
+    return _Controller(4)
+
+
+def _get_detector(controller, config, state_path=None) -> leak.Detector:
+    detector = leak.Detector(
+        logger.Logger(level="DEBUG"), controller, config, None, state_path=state_path
+    )
+    detector._station_averages.add(
+        [
+            (0, leak.get_baseline_key(0), 1.0),
+            (0, leak.get_baseline_key(1), 3.0),
+            (0, leak.get_baseline_key(2), 2.0),
+        ]
+    )
+
+    return detector
+
+
+@pytest.fixture
+def detector(controller, config):
+    return _get_detector(controller, config)
+
+
+class TestDetector:
+
+    # verify that a monitor is created for each running station and retired when the
+    # station stops running
+    @pytest.mark.asyncio
+    async def test_monitor_registry(self, detector, controller):
+        controller.stations[0].is_running = True
+        controller.stations[1].is_running = True
+        controller.stations[3].is_master = True
+        controller.stations[3].is_running = True
+
+        await detector._update_station_flow_monitors()
+        assert sorted(detector._station_flow_monitors) == [0, 1]
+        station_0_monitor = detector._station_flow_monitors[0]
+
+        controller.stations[1].is_running = False
+        controller.stations[2].is_running = True
+
+        await detector._update_station_flow_monitors()
+        assert sorted(detector._station_flow_monitors) == [0, 2]
+        assert detector._station_flow_monitors[0] is station_0_monitor
+
+        for station in controller.stations.values():
+            station.is_running = False
+
+        await detector._update_station_flow_monitors()
+        assert detector._station_flow_monitors == {}
+
+    # verify that flow is split by the stations' averages, and equally if any of the
+    # stations has no average
+    def test_flow_shares(self, detector, controller):
+        stations = controller.stations
+
+        assert detector._get_station_flow_shares([stations[0]]) == [1.0]
+        assert detector._get_station_flow_shares([stations[0], stations[1]]) == [0.25, 0.75]
+        assert detector._get_station_flow_shares([stations[0], stations[3]]) == [0.5, 0.5]
+
+    # verify that nothing is measured while the controller doesn't report a flow
+    @pytest.mark.asyncio
+    async def test_no_flow_rate(self, detector, controller):
+        controller.stations[0].is_running = True
+        controller.flow_rate = None
+
+        await detector._update_station_flow_monitors()
+        await detector._check_station_flow_monitors()
+
+        assert detector._station_flow_monitors == {}
+
+    # verify that a station without history is monitored against its maximum only
+    @pytest.mark.asyncio
+    async def test_no_history(self, controller, config):
+        config["detector"]["detection"] = {"min_history": 2, "zscore": None}
+        notification_dispatcher = _NotificationDispatcher()
+        detector = _get_detector(controller, config)
+        detector._notification_dispatcher = notification_dispatcher
+
+        controller.stations[3].is_running = True
+        for flow_rate in [30.0] * 5 + [70.0, 90.0]:
+            controller.flow_rate = flow_rate
+            await detector._update_station_flow_monitors()
+
+        assert detector._station_flow_monitors[3]._detectors == []
+        assert detector._station_flow_monitors[3].near_limits(0.1)
+        assert notification_dispatcher.texts == [
+            "Measurement (9.0) for station Station 3 exceeded max (8.0)"
+        ]
+
+    # verify that events are queued with the dispatcher, named after the controller
+    @pytest.mark.asyncio
+    async def test_notify(self, controller, config):
+        notification_dispatcher = _NotificationDispatcher()
+        config["controller"]["name"] = "orchard"
+        detector = leak.Detector(
+            logger.Logger(level="DEBUG"), controller, config, None, notification_dispatcher
+        )
+
+        await detector._on_station_flow_monitor_event("Station 0 exceeded")
+
+        assert notification_dispatcher.texts == ["orchard: Station 0 exceeded"]
+
+    # verify that a reloaded configuration applies to the monitors of running stations
+    # without replacing them, and that an invalid one is rejected as a whole
+    @pytest.mark.asyncio
+    async def test_update_config(self, detector, controller, config):
+        controller.stations[0].is_running = True
+        await detector._update_station_flow_monitors()
+        station_0_monitor = detector._station_flow_monitors[0]
+
+        config = copy.deepcopy(config)
+        config["detector"]["stations"]["station_0"] = {"allowed_flow_rate_max": 4}
+        detector.update_config(config)
+
+        assert detector._station_flow_monitors[0] is station_0_monitor
+        assert station_0_monitor._allowed_max == 4.0
+
+        invalid_config = copy.deepcopy(config)
+        invalid_config["detector"]["stations"]["station_0"] = {"allowed_flow_rate_max": "high"}
+        with pytest.raises(ValueError):
+            detector.update_config(invalid_config)
+
+        # a stanza of the wrong shape is rejected the same way
+        invalid_config = copy.deepcopy(config)
+        invalid_config["detector"]["stations"]["station_0"] = {"allowed_flow_rate_max": 2}
+        invalid_config["detector"]["idle"] = 5
+        with pytest.raises(TypeError):
+            detector.update_config(invalid_config)
+
+        assert station_0_monitor._allowed_max == 4.0
+        assert detector._config is config
+
+    # verify that a restarted detector resumes the monitors of runs that are still going
+    @pytest.mark.asyncio
+    async def test_restore_state(self, controller, config, tmp_path):
+        state_path = str(tmp_path / "detector_state.json")
+        detector = _get_detector(controller, config, state_path)
+
+        controller.stations[0].is_running = True
+        controller.stations[1].is_running = True
+        controller.stations[1].start_time = 1000
+        await detector._update_station_flow_monitors()
+        await detector._snapshot_state(0.0)
+
+        # station 1 ran again since the snapshot
+        controller.stations[1].start_time = 2000
+        restarted_detector = _get_detector(controller, config, state_path)
+        await restarted_detector._restore_state()
+
+        assert sorted(restarted_detector._station_flow_monitors) == [0]
+        assert (
+            restarted_detector._station_flow_monitors[0].get_state()
+            == detector._station_flow_monitors[0].get_state()
+        )
+
+    # verify that state is snapshotted when stations start/stop, but not on every
+    # measurement in between
+    @pytest.mark.asyncio
+    async def test_snapshot_interval(self, controller, config, tmp_path):
+        state_path = str(tmp_path / "detector_state.json")
+        detector = _get_detector(controller, config, state_path)
+
+        controller.stations[0].is_running = True
+        await detector._update_station_flow_monitors()
+        await detector._snapshot_state(0.0)
+        assert snapshot.read(state_path)["monitors"][0]["monitor"]["num_measurements"] == 1
+
+        await detector._update_station_flow_monitors()
+        await detector._snapshot_state(30.0)
+        assert snapshot.read(state_path)["monitors"][0]["monitor"]["num_measurements"] == 1
+
+        await detector._snapshot_state(300.0)
+        assert snapshot.read(state_path)["monitors"][0]["monitor"]["num_measurements"] == 2
+
+        controller.stations[0].is_running = False
+        await detector._update_station_flow_monitors()
+        await detector._snapshot_state(330.0)
+        assert snapshot.read(state_path)["monitors"] == []
+
+    # verify that state is snapshotted as soon as alerts are raised or cleared, so that a
+    # restart doesn't raise them again
+    @pytest.mark.asyncio
+    async def test_snapshot_events(self, controller, config, tmp_path):
+        state_path = str(tmp_path / "detector_state.json")
+        config["detector"]["idle"] = {
+            "allowed_flow_rate_diff": 0.5,
+            "grace_seconds": 0,
+            "seed_measurements": 0,
+        }
+        notification_dispatcher = _NotificationDispatcher()
+        detector = _get_detector(controller, config, state_path)
+        detector._notification_dispatcher = notification_dispatcher
+
+        controller.stations[0].is_running = True
+        controller.flow_rate = 10.0
+        await detector._update_station_flow_monitors()
+        await detector._snapshot_state(0.0)
+        assert not snapshot.read(state_path)["monitors"][0]["monitor"]["event_raised"]
+
+        # between measurements, well within the snapshot interval
+        controller.flow_rate = 100.0
+        await detector._check_station_flow_monitors()
+        await detector._snapshot_state(10.0)
+        assert snapshot.read(state_path)["monitors"][0]["monitor"]["event_raised"]
+
+        controller.stations[0].is_running = False
+        await detector._update_station_flow_monitors()
+        for now in [20.0, 30.0]:
+            await detector._update_idle_flow_monitor(now)
+            await detector._snapshot_state(now)
+
+        assert snapshot.read(state_path)["idle_flow_monitor"]["event_raised"]
+        assert len(notification_dispatcher.texts) == 2
+
+        # the idle alert isn't raised again after a restart
+        restarted_detector = _get_detector(controller, config, state_path)
+        restarted_detector._notification_dispatcher = notification_dispatcher
+        await restarted_detector._restore_state()
+        await restarted_detector._update_idle_flow_monitor(40.0)
+        assert len(notification_dispatcher.texts) == 2
+
+        # the flow is back to normal, so the next leak raises
+        controller.flow_rate = 0.0
+        await restarted_detector._update_idle_flow_monitor(50.0)
+        await restarted_detector._snapshot_state(50.0)
+        assert not snapshot.read(state_path)["idle_flow_monitor"]["event_raised"]
+
+    # verify that a station's runs by a program are its baseline once there are enough
+    # of them, and that other programs fall back to all of the station's runs
+    @pytest.mark.asyncio
+    async def test_program_averages(self, controller, config):
+        config["detector"]["averages_min_program_runs"] = 2
+        detector = _get_detector(controller, config)
+        detector._station_averages.add(
+            detector._get_station_measurements(
+                [
+                    [1, 0, 600, 10, 5.0],
+                    [1, 0, 600, 20, 5.0],
+                    [2, 0, 60, 30, 2.0],
+                    [1, "rd", 0, 40, 0.0],
+                ]
+            )
+        )
+
+        assert detector._station_averages.get_average(leak.get_baseline_key(0, 1)) == 5.0
+        assert detector._station_averages.get_average(leak.get_baseline_key(0, 2)) == 2.0
+        assert detector._station_averages.get_average(leak.get_baseline_key(0)) == 3.25
+
+        controller.stations[0].running_program_id = 1
+        controller.stations[0].is_running = True
+        await detector._update_station_flow_monitors()
+        assert detector._station_flow_monitors[0]._expected_average_value == 5.0
+
+        # a single run of program 2 isn't enough history
+        controller.stations[0].running_program_id = 2
+        controller.stations[0].is_running = False
+        await detector._update_station_flow_monitors()
+        controller.stations[0].is_running = True
+        await detector._update_station_flow_monitors()
+        assert detector._station_flow_monitors[0]._expected_average_value == 3.25
+
+    # verify that the configured detectors are attached to monitors of stations with
+    # enough history
+    @pytest.mark.asyncio
+    async def test_detection(self, controller, config):
+        config["detector"]["detection"] = {"min_history": 2, "zscore": {"threshold": 3}}
+        detector = _get_detector(controller, config)
+        detector._station_averages.add([(1, leak.get_baseline_key(0), 2.0)])
+
+        controller.stations[0].is_running = True
+        controller.stations[1].is_running = True
+        await detector._update_station_flow_monitors()
+
+        assert [
+            station_flow_detector.name
+            for station_flow_detector in detector._station_flow_monitors[0]._detectors
+        ] == ["zscore"]
+        assert detector._station_flow_monitors[1]._detectors == []
+
+    # verify that flow while no station is running is fed to the idle flow monitor, and
+    # that it notifies through the same path as station monitors
+    @pytest.mark.asyncio
+    async def test_idle_flow(self, controller, config):
+        notification_dispatcher = _NotificationDispatcher()
+        config["detector"]["idle"] = {
+            "allowed_flow_rate_diff": 0.5,
+            "grace_seconds": 30,
+            "seed_measurements": 0,
+        }
+        detector = leak.Detector(
+            logger.Logger(level="DEBUG"), controller, config, None, notification_dispatcher
+        )
+
+        controller.stations[3].is_master = True
+        controller.stations[3].is_running = True
+        controller.flow_rate = 20.0
+        await detector._update_idle_flow_monitor(0)
+
+        controller.stations[3].is_running = False
+        for now in [10, 40, 50]:
+            await detector._update_idle_flow_monitor(now)
+
+        assert len(notification_dispatcher.texts) == 1
+        assert notification_dispatcher.texts[0].startswith("Measurement (2.0) while no station is running")
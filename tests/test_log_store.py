@@ -0,0 +1,137 @@
+import pytest
+from typing import List
+import sqlite3
+import time
+import log_store
+import logger
+
+
+class _Controller:
+    def __init__(self, logs: List):
+        self.logs = logs
+        self.requested_days = []
+
+    async def get_logs(self, days: int) -> List:
+        self.requested_days.append(days)
+        return self.logs
+
+
+@pytest.fixture
+def now():
+    return int(time.time())
+
+
+@pytest.fixture
+def controller(now):
+    return _Controller(
+        [
+            [1, 0, 600, now - 3 * 24 * 60 * 60, 1.5],
+            [1, 1, 300, now - 2 * 24 * 60 * 60, 2.0],
+            [0, "rd", 0, now - 60 * 60, 0],
+        ]
+    )
+
+
+@pytest.fixture
+def root_logger():
+    return logger.Logger(level="DEBUG")
+
+
+class TestLogStore:
+
+    # verify that the first update reads the full history and later updates only
+    # read the days since the last stored record
+    @pytest.mark.asyncio
+    async def test_incremental_update(self, root_logger, controller, now, tmp_path):
+        store = log_store.Store(root_logger, controller, str(tmp_path), 30)
+
+        assert len(await store.get_logs(30)) == 3
+        assert len(await store.get_logs(30)) == 3
+        assert controller.requested_days == [30, 2]
+
+        # only the records within the window are returned
+        assert await store.get_logs(1) == [[0, "rd", 0, now - 60 * 60, 0]]
+
+        await store.close()
+
+    # verify that logs survive a restart
+    @pytest.mark.asyncio
+    async def test_persist(self, root_logger, controller, now, tmp_path):
+        store = log_store.Store(root_logger, controller, str(tmp_path), 30)
+        await store.update()
+        await store.close()
+
+        controller.logs = [[2, 1, 60, now, 3.0]]
+
+        store = log_store.Store(root_logger, controller, str(tmp_path), 30)
+        logs = await store.get_logs(30)
+        await store.close()
+
+        assert controller.requested_days == [30, 2]
+        assert [log[3] for log in logs] == sorted(log[3] for log in logs)
+        assert len(logs) == 4
+
+    # verify range queries
+    @pytest.mark.asyncio
+    async def test_range(self, root_logger, controller, now, tmp_path):
+        store = log_store.Store(root_logger, controller, str(tmp_path), 30)
+        await store.update()
+
+        logs = await store.get_logs_range(
+            now - 4 * 24 * 60 * 60, now - 2 * 24 * 60 * 60
+        )
+        await store.close()
+
+        assert [log[1] for log in logs] == [0, 1]
+
+    # verify that rollups sum each station's runs per local day, skip ad hoc and rain
+    # delay records and don't count records that are read again
+    @pytest.mark.asyncio
+    async def test_daily_rollups(self, root_logger, controller, now, tmp_path):
+        controller.logs = controller.logs + [
+            [2, 0, 1200, now - 3 * 24 * 60 * 60 + 1800, 0.5],
+            [99, 1, 60, now - 60, 4.0],
+        ]
+
+        store = log_store.Store(root_logger, controller, str(tmp_path), 30)
+        await store.get_daily_rollups(30)
+        rollups = await store.get_daily_rollups(30)
+        await store.close()
+
+        assert controller.requested_days == [30, 2]
+        assert [rollup[1:] for rollup in rollups] == [[0, 15.0 + 10.0, 1.5 + 0.5, 2], [1, 10.0, 2.0, 1]]
+        assert [rollup[0] for rollup in rollups] == [
+            time.strftime("%Y-%m-%d", time.localtime(now - 3 * 24 * 60 * 60 - 600)),
+            time.strftime("%Y-%m-%d", time.localtime(now - 2 * 24 * 60 * 60 - 300)),
+        ]
+
+    # verify that rollups are built for databases which predate them
+    @pytest.mark.asyncio
+    async def test_migrate_daily_rollups(self, root_logger, controller, tmp_path):
+        store = log_store.Store(root_logger, controller, str(tmp_path), 30)
+        await store.update()
+        rollups = await store.get_daily_rollups(30)
+        await store.close()
+
+        # drop back to the schema before rollups
+        connection = sqlite3.connect(str(tmp_path / "logs.sqlite3"))
+        connection.execute("DROP TRIGGER logs_daily_rollups")
+        connection.execute("DROP TABLE daily_rollups")
+        connection.execute("PRAGMA user_version = 0")
+        connection.commit()
+        connection.close()
+
+        store = log_store.Store(root_logger, controller, str(tmp_path), 30)
+        assert await store.get_daily_rollups(30) == rollups
+        await store.close()
+
+    # verify that only inserted logs are counted - not the rollups they update or logs
+    # that are read again
+    @pytest.mark.asyncio
+    async def test_num_inserted(self, root_logger, controller, tmp_path):
+        store = log_store.Store(root_logger, controller, str(tmp_path), 30)
+
+        assert await store._run(store._insert_logs, controller.logs) == 3
+        assert await store._run(store._insert_logs, controller.logs) == 0
+
+        await store.close()
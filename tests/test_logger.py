@@ -0,0 +1,65 @@
+import pytest
+import io
+import json
+import logger
+
+
+@pytest.fixture
+def root_logger():
+    root_logger = logger.Logger(level="INFO")
+    yield root_logger
+    root_logger.close()
+
+
+class TestLogger:
+
+    # verify that lazy fields are only evaluated for records that are emitted
+    def test_lazy(self, root_logger):
+        output = io.StringIO()
+        root_logger.set_handler("test", output, logger.HumanReadableFormatter())
+        evaluated = []
+
+        def _get_value(value):
+            evaluated.append(value)
+            return value
+
+        root_logger.debug_with("Skipped", value=logger.Lazy(_get_value, 1))
+        root_logger.info_with("Emitted", value=logger.Lazy(_get_value, 2))
+
+        assert evaluated == [2]
+        assert not root_logger.debug_enabled
+        assert output.getvalue().endswith("[info] Emitted: {'value': 2}\n")
+
+    # verify that records are written as a JSON document per line
+    def test_json(self, root_logger):
+        output = io.StringIO()
+        root_logger.set_handler("test", output, logger.JsonFormatter())
+
+        root_logger.info_with("Emitted", value=logger.Lazy(lambda: 1), other=object)
+        root_logger.info("Plain %s", "message")
+
+        documents = [json.loads(line) for line in output.getvalue().splitlines()]
+
+        assert documents[0]["message"] == "Emitted"
+        assert documents[0]["level"] == "info"
+        assert documents[0]["with"] == {"value": 1, "other": "<class 'object'>"}
+        assert documents[1]["message"] == "Plain message"
+        assert "with" not in documents[1]
+
+    # verify that records written asynchronously are all written by the time the logger
+    # is closed, with lazy fields evaluated when logging
+    def test_asynchronous(self, root_logger):
+        output = io.StringIO()
+        root_logger.set_handler("test", output, logger.HumanReadableFormatter(), asynchronous=True)
+        values = [0]
+
+        for index in range(100):
+            values[0] = index
+            root_logger.info_with("Emitted %d", index, value=logger.Lazy(lambda: values[0]))
+
+        root_logger.close()
+
+        lines = output.getvalue().splitlines()
+        assert len(lines) == 100
+        assert lines[-1].endswith("[info] Emitted 99: {'value': 99}")
+        assert lines[50].endswith("[info] Emitted 50: {'value': 50}")
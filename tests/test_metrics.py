@@ -0,0 +1,75 @@
+import pytest
+import aiohttp
+import logger
+import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+class TestRegistry:
+
+    # verify the text exposition of each type of metric
+    def test_text(self, registry):
+        counter = registry.counter("requests_total", "Requests", ["site"])
+        gauge = registry.gauge("depth", "Depth")
+        histogram = registry.histogram("latency_seconds", "Latency", ["site"], buckets=(0.1, 1))
+
+        counter.labels("home").inc()
+        counter.labels("home").inc(2)
+        counter.labels(None).inc()
+        gauge.set(3)
+
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.labels('a "b"').observe(value)
+
+        assert registry.get_text().splitlines() == [
+            "# HELP requests_total Requests",
+            "# TYPE requests_total counter",
+            'requests_total{site="home"} 3.0',
+            'requests_total{site=""} 1.0',
+            "# HELP depth Depth",
+            "# TYPE depth gauge",
+            "depth 3.0",
+            "# HELP latency_seconds Latency",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{site="a \\"b\\"",le="0.1"} 2',
+            'latency_seconds_bucket{site="a \\"b\\"",le="1.0"} 3',
+            'latency_seconds_bucket{site="a \\"b\\"",le="+Inf"} 4',
+            'latency_seconds_sum{site="a \\"b\\""} 5.65',
+            'latency_seconds_count{site="a \\"b\\""} 4',
+        ]
+
+    # verify that gauges may be read when collected, and that names are unique
+    def test_gauge_function(self, registry):
+        registry.gauge("value", "Value", function=lambda: 7)
+
+        assert "value 7.0" in registry.get_text().splitlines()
+
+        with pytest.raises(ValueError):
+            registry.counter("value", "Value")
+
+    # verify that the process' metrics are served over http
+    @pytest.mark.asyncio
+    async def test_server(self, unused_tcp_port):
+        server = metrics.Server(
+            logger.Logger(level="DEBUG"), metrics.registry, "127.0.0.1", unused_tcp_port
+        )
+        await server.start()
+
+        try:
+            async with aiohttp.ClientSession() as http_session:
+                async with http_session.get(f"http://127.0.0.1:{unused_tcp_port}/metrics") as response:
+                    assert response.status == 200
+                    text = await response.text()
+        finally:
+            await server.stop()
+
+        rss_bytes = [
+            float(line.split()[1])
+            for line in text.splitlines()
+            if line.startswith("leak_process_resident_memory_bytes ")
+        ]
+        assert rss_bytes[0] > 0
@@ -0,0 +1,157 @@
+import pytest
+import asyncio
+import contextlib
+
+import aiohttp
+import aiohttp.web
+
+import logger
+import notifier
+
+
+class _TelegramStub:
+    """Local stand in for the Telegram bot API, answering with the given statuses in
+    order (and 200 once they run out)"""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.messages = []
+        self.statuses = []
+        self._runner = None
+
+    async def start(self) -> None:
+        app = aiohttp.web.Application()
+        app.router.add_post("/bot{token}/sendMessage", self._handle_send_message)
+        self._runner = aiohttp.web.AppRunner(app)
+        await self._runner.setup()
+        await aiohttp.web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def stop(self) -> None:
+        await self._runner.cleanup()
+
+    async def _handle_send_message(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        status = self.statuses.pop(0) if self.statuses else 200
+        body = await request.json()
+
+        if status == 200:
+            self.messages.append(body)
+            return aiohttp.web.json_response({"ok": True})
+
+        if status == 429:
+            return aiohttp.web.json_response(
+                {"ok": False, "parameters": {"retry_after": 0.1}}, status=status
+            )
+
+        return aiohttp.web.json_response({"ok": False}, status=status)
+
+
+@contextlib.asynccontextmanager
+async def _get_dispatcher(port: int, serve: bool = True, **telegram_config):
+    """Yields a dispatcher sending to a local Telegram stub, and the stub"""
+    telegram_config = {
+        "api_url": f"http://127.0.0.1:{port}",
+        "token": "token",
+        "chat_id": 1234,
+        "batch_delay_seconds": 0.1,
+        "min_send_interval_seconds": 0.1,
+        "retry_delay_seconds": 0.01,
+        **telegram_config,
+    }
+
+    telegram_stub = _TelegramStub(port)
+    if serve:
+        await telegram_stub.start()
+
+    try:
+        async with aiohttp.ClientSession() as http_session:
+            dispatcher = notifier.Dispatcher(
+                logger.Logger(level="DEBUG"), http_session, telegram_config
+            )
+
+            try:
+                yield dispatcher, telegram_stub
+            finally:
+                await dispatcher.stop()
+    finally:
+        if serve:
+            await telegram_stub.stop()
+
+
+async def _wait_for(condition) -> None:
+    for _ in range(500):
+        if condition():
+            return
+
+        await asyncio.sleep(0.01)
+
+    raise AssertionError("Condition not met")
+
+
+class TestDispatcher:
+
+    # verify that notifications raised together are sent as a single message
+    @pytest.mark.asyncio
+    async def test_batch(self, unused_tcp_port):
+        async with _get_dispatcher(unused_tcp_port) as (dispatcher, telegram_stub):
+            dispatcher.start()
+
+            for station_index in range(3):
+                assert dispatcher.notify(f"Station {station_index} exceeded")
+
+            await _wait_for(lambda: dispatcher.get_metrics()["num_sent_notifications"] == 3)
+
+        assert telegram_stub.messages == [
+            {"chat_id": 1234, "text": "Station 0 exceeded\n\nStation 1 exceeded\n\nStation 2 exceeded"}
+        ]
+        assert dispatcher.get_metrics()["num_sent_messages"] == 1
+        assert dispatcher.get_metrics()["queue_depth"] == 0
+        assert dispatcher.get_metrics()["max_delivery_latency_seconds"] >= 0.1
+
+    # verify that notifications which don't fit in a single message are sent separately
+    @pytest.mark.asyncio
+    async def test_batch_split(self, unused_tcp_port):
+        async with _get_dispatcher(unused_tcp_port) as (dispatcher, telegram_stub):
+            for text in ["a" * 3000, "b" * 3000]:
+                dispatcher.notify(text)
+
+            dispatcher.start()
+            await _wait_for(lambda: dispatcher.get_metrics()["num_sent_notifications"] == 2)
+
+        assert [message["text"] for message in telegram_stub.messages] == ["a" * 3000, "b" * 3000]
+
+    # verify that server errors and rate limiting are retried, and client errors aren't
+    @pytest.mark.asyncio
+    async def test_retry(self, unused_tcp_port):
+        async with _get_dispatcher(unused_tcp_port) as (dispatcher, telegram_stub):
+            dispatcher.start()
+
+            telegram_stub.statuses = [500, 429, 502]
+            dispatcher.notify("retried")
+            await _wait_for(lambda: dispatcher.get_metrics()["num_sent_notifications"] == 1)
+
+            telegram_stub.statuses = [400]
+            dispatcher.notify("rejected")
+            await _wait_for(lambda: dispatcher.get_metrics()["num_failed_notifications"] == 1)
+
+        assert [message["text"] for message in telegram_stub.messages] == ["retried"]
+        assert dispatcher.get_metrics()["num_retries"] == 3
+
+    # verify that a message is dropped once all attempts fail, e.g. when Telegram can't
+    # be reached at all
+    @pytest.mark.asyncio
+    async def test_give_up(self, unused_tcp_port):
+        async with _get_dispatcher(unused_tcp_port, serve=False, max_attempts=3) as (dispatcher, _):
+            dispatcher.start()
+
+            dispatcher.notify("unreachable")
+            await _wait_for(lambda: dispatcher.get_metrics()["num_failed_notifications"] == 1)
+
+        assert dispatcher.get_metrics()["num_retries"] == 2
+
+    # verify that notifications beyond the queue size are dropped rather than waited on
+    @pytest.mark.asyncio
+    async def test_queue_full(self, unused_tcp_port):
+        async with _get_dispatcher(unused_tcp_port, serve=False, queue_size=2) as (dispatcher, _):
+            assert [dispatcher.notify(str(index)) for index in range(3)] == [True, True, False]
+            assert dispatcher.get_metrics()["queue_depth"] == 2
+            assert dispatcher.get_metrics()["num_dropped_notifications"] == 1
@@ -0,0 +1,97 @@
+import pytest
+from typing import List
+import time
+import poll_scheduler
+
+
+class _Program:
+    def __init__(self, start_time_type: int, offset_types: List, offsets: List, enabled=True):
+        self.enabled = enabled
+        self.start_time_type = start_time_type
+        self.program_start_time_offset_types = offset_types
+        self.program_start_time_offsets = offsets
+        self.program_start_repeat_count = 2
+        self.program_start_repeat_interval = 60
+
+
+class _Controller:
+    def __init__(self, programs: List[_Program]):
+        self.programs = dict(enumerate(programs))
+        self.sunrise = 6 * 60
+        self.sunset = 18 * 60
+
+
+class _Monitor:
+    def __init__(self, near_limits: bool, in_inrush: bool = False):
+        self._near_limits = near_limits
+        self.in_inrush = in_inrush
+
+    def near_limits(self, ratio: float) -> bool:
+        return self._near_limits
+
+
+@pytest.fixture
+def scheduler():
+    return poll_scheduler.Scheduler(
+        {
+            "running_station_interval_seconds": 30,
+            "idle_interval_seconds": 600,
+            "fast_interval_seconds": 5,
+            "inrush_interval_seconds": 0.5,
+            "program_wake_lead_seconds": 60,
+        },
+    )
+
+
+def _get_minutes_from_now(minutes: float) -> int:
+    local_time = time.localtime()
+    return (local_time.tm_hour * 60 + local_time.tm_min + minutes) % (24 * 60)
+
+
+class TestScheduler:
+
+    # verify that idle polling is rare when nothing is scheduled
+    def test_idle(self, scheduler):
+        controller = _Controller([_Program(1, ["disabled"] * 4, [0] * 4)])
+
+        assert scheduler.get_interval(controller, [], 0) == 600
+
+    # verify that polling wakes up just before a program is due and is fast around
+    # the program start
+    def test_program_start(self, scheduler):
+        controller = _Controller(
+            [_Program(1, ["midnight", "disabled", "disabled", "disabled"], [_get_minutes_from_now(5), 0, 0, 0])]
+        )
+        assert 170 <= scheduler.get_interval(controller, [], 0) <= 240
+
+        controller = _Controller(
+            [_Program(1, ["midnight", "disabled", "disabled", "disabled"], [_get_minutes_from_now(0), 0, 0, 0])]
+        )
+        assert scheduler.get_interval(controller, [], 0) == 5
+
+        # disabled programs are ignored
+        controller.programs[0].enabled = False
+        assert scheduler.get_interval(controller, [], 0) == 600
+
+    # verify that repeating programs wake up for every repetition
+    def test_repeating_program(self, scheduler):
+        controller = _Controller(
+            [_Program(0, ["midnight", None, None, None], [_get_minutes_from_now(-60), 0, 0, 0])]
+        )
+        assert scheduler.get_interval(controller, [], 0) == 5
+
+    # verify that while stations are running, polling follows the measurements unless
+    # a station is close to its limits
+    def test_running(self, scheduler):
+        controller = _Controller([])
+
+        assert scheduler.get_interval(controller, [_Monitor(False)], 30) == 30
+        assert scheduler.get_interval(controller, [_Monitor(False), _Monitor(True)], 30) == 5
+        assert scheduler.get_interval(controller, [_Monitor(True)], 2) == 2
+
+    # verify that polling is quickest while a station is in inrush
+    def test_inrush(self, scheduler):
+        controller = _Controller([])
+
+        assert scheduler.get_interval(controller, [_Monitor(False), _Monitor(True, True)], 30) == 0.5
+        assert scheduler.get_interval(controller, [_Monitor(False, True)], 0.2) == 0.2
@@ -0,0 +1,155 @@
+import asyncio
+import itertools
+import random
+import numpy as np
+import logger
+import replay
+import station_flow
+
+
+class _Station:
+    def __init__(self, name: str):
+        self.index = 0
+        self.name = name
+
+
+def _get_series(num_runs: int) -> replay.Series:
+    rng = random.Random(num_runs)
+    runs = []
+    leak_starts = []
+
+    for run_index in range(num_runs):
+        run = [rng.gauss(2.0, 0.3) for _ in range(rng.randint(1, 40))]
+
+        # inrush at the start of some runs, leaks at some point of others
+        if run_index % 3 == 0:
+            num_inrush_measurements = min(rng.randint(1, 4), len(run))
+            run[:num_inrush_measurements] = [rng.uniform(3.0, 6.0)] * num_inrush_measurements
+
+        leak_start = -1
+        if run_index % 4 == 0:
+            leak_start = rng.randrange(len(run))
+            run[leak_start:] = [measurement + rng.uniform(0.5, 4.0) for measurement in run[leak_start:]]
+
+        runs.append(run)
+        leak_starts.append(leak_start)
+
+    return replay.Series(["station"] * num_runs, runs, [2.0] * num_runs, leak_starts)
+
+
+def _get_monitor_alert_index(run, expected_average, inrush, allowed_max, allowed_diff, history):
+    alert_indexes = []
+
+    async def _on_event(event):
+        alert_indexes.append(measurement_index)
+
+    monitor = station_flow.Monitor(
+        logger.Logger(level="INFO"),
+        _Station("station"),
+        inrush,
+        allowed_max,
+        allowed_diff,
+        expected_average,
+        history,
+        _on_event,
+    )
+
+    async def _add_measurements():
+        nonlocal measurement_index
+        for measurement_index, measurement in enumerate(run):
+            await monitor.add_measurement(measurement)
+
+    measurement_index = None
+    asyncio.run(_add_measurements())
+
+    return alert_indexes[0] if alert_indexes else len(run)
+
+
+class TestReplay:
+
+    # verify that the vectorized replay raises events at the same measurement as the
+    # monitor does, for every combination of thresholds
+    def test_monitor_equivalence(self):
+        series = _get_series(60)
+        grid = replay.Grid([0, 1, 3], [3.5, 5.0], [0.2, 1.0, -1.5], [1, 4, 50])
+
+        alert_indexes = replay.get_alert_indexes(series, grid, max_runs_per_batch=16)
+
+        assert alert_indexes.shape == (60, 3, 2, 3, 3)
+
+        for run_index, run in enumerate(series.measurements):
+            run = run[~np.isnan(run)].tolist()
+
+            for grid_index in itertools.product(*(range(size) for size in grid.shape)):
+                inrush_index, max_index, diff_index, history_index = grid_index
+
+                assert alert_indexes[(run_index,) + grid_index] == _get_monitor_alert_index(
+                    run,
+                    float(series.expected_averages[run_index]),
+                    int(grid.inrush_measurements[inrush_index]),
+                    float(grid.allowed_max[max_index]),
+                    float(grid.allowed_average_diff[diff_index]),
+                    int(grid.expected_average_history[history_index]),
+                ), (run_index, grid_index)
+
+    # verify false positive rate and latency
+    def test_results(self):
+        series = replay.Series(
+            ["a", "a", "b"],
+            [[1.0, 1.0, 1.0], [1.0, 1.0, 9.0, 9.0], [9.0, 1.0]],
+            [1.0, 1.0, 1.0],
+            [-1, 2, -1],
+        )
+        grid = replay.Grid([0, 2], [5.0], [100.0], [1])
+
+        results = replay.get_results(series, grid, replay.get_alert_indexes(series, grid), 30)
+
+        # the spike at the start of the last run is a false positive unless it's inrush
+        assert [result["false_positive_rate"] for result in results] == [1 / 3, 0.0]
+        assert [result["detection_rate"] for result in results] == [1.0, 1.0]
+        assert [result["mean_latency_seconds"] for result in results] == [0.0, 0.0]
+
+    # verify that series are read from the detector's JSON log
+    def test_read_series_log(self, tmp_path):
+        log_path = tmp_path / "leak.log"
+        log_path.write_text(
+            "\n".join(
+                [
+                    '{"message": "Created flow monitor", "with": {"station": "a", "expected_average_value": 2.0}}',
+                    '{"message": "Adding measurement", "with": {"name": "a", "measurement": 1.5}}',
+                    '{"message": "Created flow monitor", "with": {"station": "b", "expected_average_value": 3.0}}',
+                    '{"message": "Adding measurement", "with": {"name": "b", "measurement": 3.5}}',
+                    '{"message": "Adding measurement", "with": {"name": "a", "measurement": 2.5}}',
+                    "not json",
+                    '{"message": "Created flow monitor", "with": {"station": "a", "expected_average_value": 2.0}}',
+                    '{"message": "Adding measurement", "with": {"name": "a", "measurement": 4.0}}',
+                ]
+            )
+        )
+
+        series = replay.read_series_log(str(log_path))
+
+        assert series.stations == ["a", "b", "a"]
+        assert series.expected_averages.tolist() == [2.0, 3.0, 2.0]
+        assert series.leak_starts.tolist() == [-1, -1, -1]
+        assert series.measurements[:, :1].tolist() == [[1.5], [3.5], [4.0]]
+        assert series.measurements[0].tolist() == [1.5, 2.5]
+
+    # verify that runs of stations without history fall back to the station's mean
+    # across its runs
+    def test_read_series_log_no_history(self, tmp_path):
+        log_path = tmp_path / "leak.log"
+        log_path.write_text(
+            "\n".join(
+                [
+                    '{"message": "Created flow monitor", "with": {"station": "a", "expected_average_value": null}}',
+                    '{"message": "Adding measurement", "with": {"name": "a", "measurement": 1.0}}',
+                    '{"message": "Created flow monitor", "with": {"station": "a", "expected_average_value": 2.0}}',
+                    '{"message": "Adding measurement", "with": {"name": "a", "measurement": 3.0}}',
+                ]
+            )
+        )
+
+        series = replay.read_series_log(str(log_path))
+
+        assert series.expected_averages.tolist() == [2.0, 2.0]
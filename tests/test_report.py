@@ -1,9 +1,13 @@
 from typing import Dict
 import pytest
-import os
+import contextlib
+import log_store
+import logger
 import report
+import simulator
 import yaml
 
+import aiohttp
 import pyopensprinkler
 
 
@@ -13,20 +17,34 @@ def config():
         return yaml.load(config_file, Loader=yaml.Loader)
 
 
-@pytest.fixture
-@pytest.mark.asyncio
-async def controller(config):
-    controller = pyopensprinkler.Controller(
-        config["controller"]["url"], config["controller"]["password"]
+@contextlib.asynccontextmanager
+async def _get_generator(port: int, directory: str, history_days: int):
+    """Yields a report generator reading from a simulated controller with history_days
+    of logs"""
+    simulator_instance = simulator.Simulator(
+        logger.Logger(level="DEBUG"),
+        [simulator.Station(f"Station {index}", 1.0 + index / 4) for index in range(8)],
     )
-    yield controller
-
-    await controller.session_close()
-
-
-@pytest.fixture
-def generator(controller):
-    return report.Generator(controller)
+    simulator_instance.synthesize_logs(history_days, runs_per_day=2)
+    await simulator_instance.start("127.0.0.1", port)
+
+    try:
+        async with aiohttp.ClientSession() as http_session:
+            controller = pyopensprinkler.Controller(
+                f"http://127.0.0.1:{port}", "opendoor", {"session": http_session}
+            )
+            store = log_store.Store(
+                logger.Logger(level="DEBUG"), controller, directory, history_days
+            )
+            generator = report.Generator(controller, store, dpi=100)
+
+            try:
+                yield generator
+            finally:
+                generator.close()
+                await store.close()
+    finally:
+        await simulator_instance.stop()
 
 
 @pytest.fixture
@@ -39,34 +57,31 @@ def emailer(config):
 
 class TestReportGenerator:
     @pytest.mark.asyncio
-    async def test_generate(
-        self,
-        generator: report.Generator,
-        controller: pyopensprinkler.Controller,
-        config: Dict,
-    ):
-        await generator.generate(
-            config["report"]["generator"]["history_days"], "/tmp/t1.pdf"
-        )
+    async def test_generate(self, unused_tcp_port, tmp_path):
+        async with _get_generator(unused_tcp_port, str(tmp_path), 60) as generator:
+            report_contents, weekly_description = await generator.generate(60)
+
+        assert bytes(report_contents[:5]) == b"%PDF-"
+        assert weekly_description
 
     @pytest.mark.asyncio
     async def test_generate_and_email(
         self,
-        generator: report.Generator,
-        controller: pyopensprinkler.Controller,
+        unused_tcp_port,
+        tmp_path,
         emailer: report.Emailer,
         config: Dict,
     ):
-        temporary_pdf_path = "/tmp/t1.pdf"
+        async with _get_generator(unused_tcp_port, str(tmp_path), 60) as generator:
+            report_contents, weekly_description = await generator.generate(60)
 
-        weekly_description = await generator.generate(
-            config["report"]["generator"]["history_days"], temporary_pdf_path
-        )
-
-        await emailer.send_report(temporary_pdf_path, config["report"]["emailer"]["to_email_address"], contents=weekly_description)
+        await emailer.send_report(report_contents, config["report"]["emailer"]["to_email_address"], contents=weekly_description)
 
 
 class TestReportEmailer:
     @pytest.mark.asyncio
-    async def test_send(self, emailer: report.Emailer):
-        await emailer.send_report("/tmp/t1.pdf", "pavius@gmail.com")
+    async def test_send(self, emailer: report.Emailer, config: Dict, tmp_path):
+        report_path = tmp_path / "report.pdf"
+        report_path.write_bytes(b"%PDF-")
+
+        await emailer.send_report(str(report_path), config["report"]["emailer"]["to_email_address"])
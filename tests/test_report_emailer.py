@@ -0,0 +1,68 @@
+import pytest
+import base64
+import io
+import os
+import tracemalloc
+import report
+
+
+class _ShortReader(io.RawIOBase):
+    """Returns at most a few bytes per read, like a pipe or socket would"""
+
+    def __init__(self, contents: bytes):
+        self._contents = io.BytesIO(contents)
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        return self._contents.read(min(size, 1000))
+
+
+@pytest.fixture
+def emailer():
+    return report.Emailer("leak@example.com", "api-key")
+
+
+@pytest.fixture
+def contents():
+    return os.urandom(3 * 1024 * 1024 + 1)
+
+
+class TestEmailer:
+
+    # verify that every kind of report is encoded the same as encoding it at once
+    def test_encode(self, emailer, contents, tmp_path):
+        report_path = tmp_path / "report.pdf"
+        report_path.write_bytes(contents)
+        expected_encoded_report = base64.b64encode(contents).decode()
+
+        for report_source in [
+            str(report_path),
+            contents,
+            bytearray(contents),
+            memoryview(contents),
+            io.BytesIO(contents),
+            _ShortReader(contents),
+        ]:
+            assert emailer._get_encoded_report(report_source) == expected_encoded_report
+
+        assert emailer._get_encoded_report(b"") == ""
+
+    # verify that encoding a report from a file doesn't hold the file's contents in
+    # memory alongside the encoded contents
+    def test_encode_memory(self, emailer, contents, tmp_path):
+        report_path = tmp_path / "report.pdf"
+        report_path.write_bytes(contents)
+
+        tracemalloc.start()
+
+        try:
+            encoded_report = emailer._get_encoded_report(str(report_path))
+            _, peak_bytes = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        # the encoded bytes and the encoded string, each 4/3 of the contents
+        assert peak_bytes < 2.8 * len(contents)
+        assert len(encoded_report) == len(base64.b64encode(contents))
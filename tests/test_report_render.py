@@ -0,0 +1,154 @@
+import pytest
+import asyncio
+import datetime
+import os
+import random
+import resource
+import time
+from typing import List
+import matplotlib.pyplot
+import metrics
+import report
+
+
+class _Station:
+    def __init__(self, index: int):
+        self.index = index
+        self.name = f"Station {index}"
+
+
+class _Controller:
+    def __init__(self, num_stations: int):
+        self.stations = {index: _Station(index) for index in range(num_stations)}
+
+    async def refresh(self) -> None:
+        pass
+
+
+class _LogStore:
+    def __init__(self, rollups: List):
+        self._rollups = rollups
+
+    async def get_daily_rollups(self, days: int) -> List:
+        return self._rollups
+
+
+def _get_rollups(num_days: int, num_stations: int) -> List:
+    rng = random.Random(num_days)
+    today = datetime.date.today()
+
+    rollups = []
+    for day_offset in range(num_days, 0, -1):
+        day = str(today - datetime.timedelta(days=day_offset))
+
+        for station_index in range(num_stations):
+            num_logs = rng.randint(1, 3)
+            flow_sensor_ticks_per_minute = rng.uniform(0.5, 4.0) * num_logs
+            flow_sensor_ticks = flow_sensor_ticks_per_minute * rng.randint(1, 30)
+            rollups.append([day, station_index, flow_sensor_ticks, flow_sensor_ticks_per_minute, num_logs])
+
+    return rollups
+
+
+def _get_rss_bytes() -> int:
+    with open("/proc/self/statm", "r") as statm_file:
+        return int(statm_file.read().split()[1]) * resource.getpagesize()
+
+
+async def _get_max_poll_lag(work) -> float:
+    interval = 0.01
+    max_lag = 0.0
+    task = asyncio.ensure_future(work)
+
+    # simulate the detector's polling loop, measuring how late each wake up is
+    while not task.done():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        max_lag = max(max_lag, time.perf_counter() - start - interval)
+
+    await task
+
+    return max_lag
+
+
+@pytest.fixture
+def controller():
+    return _Controller(16)
+
+
+@pytest.fixture
+def generator(controller):
+    generator = report.Generator(controller, _LogStore(_get_rollups(365, len(controller.stations))), reports_per_worker=2)
+    yield generator
+    generator.close()
+
+
+class TestReportRender:
+
+    # verify that rendering a report in the worker process doesn't hold up the event
+    # loop any more than it's held up when idle (bench_report compares with rendering
+    # in a thread)
+    @pytest.mark.asyncio
+    async def test_poll_jitter(self, generator):
+
+        # start the worker up front so that its startup isn't measured
+        await generator.generate(30)
+
+        idle_lag = await _get_max_poll_lag(asyncio.sleep(1))
+        worker_lag = await _get_max_poll_lag(generator.generate(30))
+
+        print(f"\nmax poll lag: idle {idle_lag:.3f}s, worker {worker_lag:.3f}s")
+
+        assert worker_lag < idle_lag + 0.1
+
+    # verify that the report is rendered in memory and can be written out as is
+    @pytest.mark.asyncio
+    async def test_generate_in_memory(self, generator, tmp_path):
+        report_contents, weekly_description = await generator.generate(30)
+
+        assert isinstance(report_contents, memoryview)
+        assert bytes(report_contents[:5]) == b"%PDF-"
+        assert weekly_description.startswith("Summary for this week")
+
+        with open(tmp_path / "report.pdf", "wb") as report_file:
+            report_file.write(report_contents)
+
+        assert (tmp_path / "report.pdf").stat().st_size == len(report_contents)
+
+        # each stage, including those in the worker, is timed
+        metrics_text = metrics.registry.get_text()
+        for stage in ["refresh", "rollups", "aggregate", "pdf", "worker"]:
+            assert f'leak_report_stage_seconds_count{{stage="{stage}"}}' in metrics_text
+
+    # verify that the worker is replaced after the configured number of reports
+    @pytest.mark.asyncio
+    async def test_worker_recycle(self, generator):
+        worker_executors = []
+
+        for report_idx in range(3):
+            await generator.generate(30)
+            worker_executors.append(generator._worker_executor)
+
+        assert worker_executors[0] is worker_executors[1]
+        assert worker_executors[1] is not worker_executors[2]
+
+
+class TestRenderer:
+
+    # verify that rendering many reports in the same process neither leaves figures
+    # registered with pyplot nor grows memory
+    @pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="requires procfs")
+    def test_long_run_memory(self, tmp_path):
+        renderer = report.Renderer(dpi=72)
+        station_names = {index: f"Station {index}" for index in range(8)}
+        rollups_columns = report._get_rollups_columns(_get_rollups(60, len(station_names)))
+
+        rss_bytes = []
+        for report_idx in range(100):
+            renderer.render(str(tmp_path / "report.pdf"), station_names, rollups_columns)
+            rss_bytes.append(_get_rss_bytes())
+
+        print(f"\nrss after 10 reports {rss_bytes[9] / 2**20:.1f}MB, after 100 {rss_bytes[-1] / 2**20:.1f}MB")
+
+        assert matplotlib.pyplot.get_fignums() == []
+        assert rss_bytes[-1] - rss_bytes[9] < 20 * 2**20
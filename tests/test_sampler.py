@@ -0,0 +1,92 @@
+import pytest
+import asyncio
+import logger
+import poll_scheduler
+import sampler
+
+
+class _Controller:
+    def __init__(self):
+        self._state = None
+        self.settings = {"sbits": [0, 0], "flcrt": 0, "flwrt": 30}
+        self.requests = []
+
+    async def refresh(self) -> None:
+        self.requests.append("/ja")
+        self._state = {"settings": dict(self.settings), "status": {"sn": [0] * 16}}
+
+    async def request(self, path: str) -> dict:
+        self.requests.append(path)
+        return dict(self.settings)
+
+
+def _get_sampler(controller: _Controller, refresh_counter=None, **detector_config) -> sampler.Sampler:
+    return sampler.Sampler(
+        logger.Logger(level="DEBUG"),
+        controller,
+        {"min_sample_interval_seconds": 0, **detector_config},
+        refresh_counter=refresh_counter,
+    )
+
+
+class TestSampler:
+
+    # verify that flow is sampled with small requests in between full refreshes
+    @pytest.mark.asyncio
+    async def test_sample(self):
+        controller = _Controller()
+        sampler_instance = _get_sampler(controller)
+
+        await sampler_instance.sample()
+        controller.settings["flcrt"] = 12
+        await sampler_instance.sample()
+
+        assert controller.requests == ["/ja", "/jc"]
+        assert controller._state["settings"]["flcrt"] == 12
+
+    # verify that a full refresh is done once stations start/stop and periodically
+    @pytest.mark.asyncio
+    async def test_refresh(self):
+        controller = _Controller()
+        sampler_instance = _get_sampler(controller)
+
+        await sampler_instance.sample()
+        controller.settings["sbits"] = [1, 0]
+        await sampler_instance.sample()
+        await sampler_instance.sample()
+
+        assert controller.requests == ["/ja", "/jc", "/ja", "/jc"]
+
+        sampler_instance = _get_sampler(controller, full_refresh_interval_seconds=0)
+        controller.requests = []
+        for _ in range(3):
+            await sampler_instance.sample()
+
+        assert controller.requests == ["/ja"] * 3
+
+    # verify that requests are spaced out by the minimal sample interval
+    @pytest.mark.asyncio
+    async def test_min_sample_interval(self):
+        controller = _Controller()
+        sampler_instance = _get_sampler(controller, min_sample_interval_seconds=0.1)
+
+        start_time = asyncio.get_running_loop().time()
+        for _ in range(4):
+            await sampler_instance.sample()
+
+        assert asyncio.get_running_loop().time() - start_time >= 0.3
+
+    # verify that only full refreshes are counted as refreshes
+    @pytest.mark.asyncio
+    async def test_refresh_counter(self):
+        controller = _Controller()
+        refresh_counter = poll_scheduler.RefreshCounter(logger.Logger(level="DEBUG"))
+        sampler_instance = _get_sampler(controller, refresh_counter)
+
+        for _ in range(3):
+            await sampler_instance.sample()
+        controller.settings["sbits"] = [1, 0]
+        await sampler_instance.sample()
+
+        assert controller.requests == ["/ja", "/jc", "/jc", "/jc", "/ja"]
+        assert refresh_counter.refreshes_per_hour == 2
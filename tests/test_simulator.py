@@ -0,0 +1,122 @@
+import pytest
+import contextlib
+import time
+
+import aiohttp
+import pyopensprinkler
+
+import logger
+import simulator
+
+
+@contextlib.asynccontextmanager
+async def _get_controller(port: int, stations, **simulator_kwargs):
+    """Yields a controller pointed at a simulator of the given stations, and the
+    simulator"""
+    simulator_instance = simulator.Simulator(
+        logger.Logger(level="DEBUG"), stations, **simulator_kwargs
+    )
+    await simulator_instance.start("127.0.0.1", port)
+
+    try:
+        async with aiohttp.ClientSession() as http_session:
+            yield pyopensprinkler.Controller(
+                f"http://127.0.0.1:{port}", "opendoor", {"session": http_session}
+            ), simulator_instance
+    finally:
+        await simulator_instance.stop()
+
+
+def _get_stations(num_stations: int):
+    return [
+        simulator.Station(f"Station {index}", index + 1.0, noise=0, inrush_seconds=60)
+        for index in range(num_stations)
+    ]
+
+
+class TestSimulator:
+
+    # verify that running stations, their status and the flow read back through the
+    # controller
+    @pytest.mark.asyncio
+    async def test_run_station(self, unused_tcp_port):
+        async with _get_controller(
+            unused_tcp_port, _get_stations(10), master_station_index=9
+        ) as (controller, simulator_instance):
+            await controller.refresh()
+            assert controller.flow_rate == 0
+            assert [station.name for station in controller.stations.values()][:2] == [
+                "Station 0",
+                "Station 1",
+            ]
+            assert controller.stations[9].is_master
+
+            simulator_instance.run_station(1, 600)
+            simulator_instance.run_station(8, 600, program_id=2)
+            await controller.refresh()
+
+            running_stations = [
+                station for station in controller.stations.values() if station.is_running
+            ]
+            assert [station.index for station in running_stations] == [1, 8]
+            assert running_stations[1].running_program_id == 2
+            assert 598 <= running_stations[1].seconds_remaining <= 600
+
+            # inrush doubles the flow, 10 liters per tick
+            assert controller.flow_rate == pytest.approx(2 * 10 * (2.0 + 9.0))
+
+            simulator_instance.stop_station(1)
+            await controller.refresh()
+            assert not controller.stations[1].is_running
+
+            logs = await controller.request("/jl", {"hist": 0})
+            assert [log[:2] for log in logs] == [[99, 1]]
+
+    # verify that logs are served by days back and by time range, and that a leak
+    # shows in the flow logged from its start
+    @pytest.mark.asyncio
+    async def test_logs(self, unused_tcp_port):
+        stations = _get_stations(3)
+        now = time.time()
+        stations[2].leak_start_time = now - 5 * 24 * 60 * 60
+        stations[2].leak_ratio = 2.0
+
+        async with _get_controller(unused_tcp_port, stations) as (controller, simulator_instance):
+            simulator_instance.synthesize_logs(30, runs_per_day=2, now=now)
+
+            logs = await controller.request("/jl", {"hist": 30})
+            assert len(logs) == 30 * 2 * 3
+            assert [log[3] for log in logs] == sorted(log[3] for log in logs)
+
+            logs = await controller.request(
+                "/jl", {"start": int(now - 10 * 24 * 60 * 60), "end": int(now)}
+            )
+            assert {log[1] for log in logs} == {0, 1, 2}
+            assert {
+                log[4] for log in logs if log[1] == 2 and log[3] >= stations[2].leak_start_time
+            } == {6.0}
+            assert {
+                log[4] for log in logs if log[1] == 2 and log[3] < stations[2].leak_start_time
+            } == {3.0}
+
+    # verify that requests are counted, delayed by the configured latency and rejected
+    # with a bad password
+    @pytest.mark.asyncio
+    async def test_requests(self, unused_tcp_port):
+        async with _get_controller(
+            unused_tcp_port, _get_stations(1), latency_seconds=0.05
+        ) as (controller, simulator_instance):
+            start_time = time.perf_counter()
+            await controller.request("/jc")
+            assert time.perf_counter() - start_time >= 0.05
+
+            other_controller = pyopensprinkler.Controller(
+                f"http://127.0.0.1:{unused_tcp_port}", "other"
+            )
+            try:
+                with pytest.raises(pyopensprinkler.OpenSprinklerAuthError):
+                    await other_controller.request("/jc")
+            finally:
+                await other_controller.session_close()
+
+            assert simulator_instance.requests == {"/jc": 2}
@@ -0,0 +1,24 @@
+import pytest
+import snapshot
+
+
+class TestSnapshot:
+
+    # verify that a written snapshot is read back, and replaces the previous one
+    def test_write_read(self, tmp_path):
+        path = str(tmp_path / "state.json")
+
+        snapshot.write(path, {"monitors": [{"station_index": 1}]})
+        snapshot.write(path, {"monitors": []})
+
+        assert snapshot.read(path) == {"monitors": []}
+        assert [path.name for path in tmp_path.iterdir()] == ["state.json"]
+
+    # verify that missing, corrupt or incompatible snapshots are ignored
+    @pytest.mark.parametrize("contents", [None, '{"version":1,"sta', '{"version":0,"state":{}}'])
+    def test_unusable(self, tmp_path, contents):
+        path = tmp_path / "state.json"
+        if contents is not None:
+            path.write_text(contents)
+
+        assert snapshot.read(str(path)) is None
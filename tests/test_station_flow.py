@@ -1,9 +1,13 @@
 import pytest
 from typing import List
 import station_flow
+import averages
+import detection
 import logger
 import sys
 import asyncio
+import random
+import statistics
 
 
 class _Station:
@@ -49,6 +53,20 @@ class TestStationFlowMonitor:
             events
         )
 
+    # verify that samples between measurements during inrush are only kept for the inrush
+    # peak, which is forgotten once inrush ends
+    @pytest.mark.asyncio
+    async def test_inrush_peak(self, monitor, events):
+        await monitor.add_measurement(7.0)
+        await monitor.check_measurement(9.5)
+        await monitor.check_measurement(8.0)
+
+        assert monitor.inrush_peak == 9.5
+        assert monitor._num_measurements == 1
+
+        await self._add_measurements_and_verify_alert(monitor, [7.0] * 4 + [2.0], [], events)
+        assert monitor.inrush_peak is None
+
     # verify that larger than expected values that happened in the beginning of
     # the run and continue to exceed the allowed inrush raise a "max" error
     @pytest.mark.asyncio
@@ -81,6 +99,145 @@ class TestStationFlowMonitor:
             events
         )
 
+    # verify that the mean exceeded event carries the measurements in the window
+    @pytest.mark.asyncio
+    async def test_exceed_mean_measurements(self, monitor, events):
+        window_measurements = [3.0 + idx / 10 for idx in range(10)]
+
+        await self._add_measurements_and_verify_alert(
+            monitor,
+            [8.0] * 5 + window_measurements,
+            [station_flow.MeanDifferenceExceededEvent],
+            events
+        )
+
+        assert events[0].measurements == window_measurements
+        assert events[0].measured_mean == statistics.mean(events[0].measurements)
+
+    # verify that updated thresholds apply to a running monitor, keeping the latest
+    # measurements when the window shrinks
+    @pytest.mark.asyncio
+    async def test_update_thresholds(self, monitor, events):
+        for measurement in [8.0] * 5 + [2.0] * 10:
+            await monitor.add_measurement(measurement)
+
+        monitor.update_thresholds(
+            inrush_measurements=6,
+            allowed_max=6.0,
+            allowed_average_diff=0.75,
+            expected_average_history=3,
+        )
+        assert monitor._measurements.values() == [2.0] * 3
+
+        await self._add_measurements_and_verify_alert(
+            monitor,
+            [3.0] * 2,
+            [station_flow.MeanDifferenceExceededEvent],
+            events
+        )
+
+        assert events[0].measurements == [2.0, 3.0, 3.0]
+
+    # verify that a restored monitor resumes the run - past inrush, with its window and
+    # without raising an alert that was already raised
+    @pytest.mark.asyncio
+    async def test_restore_state(self, monitor, events):
+        for measurement in [8.0] * 5 + [2.0] * 3:
+            await monitor.add_measurement(measurement)
+
+        restored_monitor = station_flow.Monitor(
+            monitor._logger, monitor.station, 6, 6.0, 0.75, 0.0, 10, monitor._on_event
+        )
+        restored_monitor.restore_state(monitor.get_state())
+
+        assert not restored_monitor.in_inrush
+        assert restored_monitor._measurements.values() == [2.0] * 3
+        assert restored_monitor._expected_average_value == 1.8
+
+        await self._add_measurements_and_verify_alert(
+            restored_monitor, [7.0, 7.0], [station_flow.MaxMeasurementExceededEvent], events
+        )
+
+        # the alert was raised before the restart, so it isn't raised again
+        rerestored_monitor = station_flow.Monitor(
+            monitor._logger, monitor.station, 6, 6.0, 0.75, 0.0, 10, monitor._on_event
+        )
+        rerestored_monitor.restore_state(restored_monitor.get_state())
+
+        await rerestored_monitor.add_measurement(7.0)
+        assert len(events) == 1
+
+    # verify that attached detectors check measurements past inrush, raising a single
+    # alert per run that doesn't hold back the monitor's own checks
+    @pytest.mark.asyncio
+    async def test_detectors(self, monitor, events):
+        histogram = averages.Histogram()
+        histogram.add(2.0)
+        monitor._detectors = [
+            detection.CusumDetector(monitor.station, detection.Baseline(1.8, 0.01, histogram))
+        ]
+
+        # detectors wait for the window to fill, then each measurement adds 4 sigmas
+        await self._add_measurements_and_verify_alert(
+            monitor,
+            [8.0] * 5 + [2.5] * 12,
+            [detection.AnomalyEvent],
+            events
+        )
+
+        assert monitor.get_state()["detectors"] == [
+            {"name": "cusum", "state": {"sum": pytest.approx(3 * 4.0)}}
+        ]
+
+        await self._add_measurements_and_verify_alert(
+            monitor,
+            [7.0] * 2,
+            [detection.AnomalyEvent, station_flow.MaxMeasurementExceededEvent],
+            events
+        )
+
+    # verify that detectors are restored by name, and that detectors which weren't
+    # running before the restart start over
+    def test_restore_detectors(self, monitor):
+        baseline = detection.Baseline(1.8, 0.01, averages.Histogram())
+        cusum_detector = detection.CusumDetector(monitor.station, baseline)
+        cusum_detector.restore_state({"sum": 3.0})
+        ewma_detector = detection.EwmaDetector(monitor.station, baseline)
+        ewma_detector.restore_state({"ewma": 2.5})
+        monitor._detectors = [cusum_detector, ewma_detector]
+
+        restored_monitor = station_flow.Monitor(
+            monitor._logger,
+            monitor.station,
+            6,
+            6.0,
+            0.75,
+            0.0,
+            10,
+            monitor._on_event,
+            [
+                detection.ZScoreDetector(monitor.station, baseline),
+                detection.EwmaDetector(monitor.station, baseline),
+            ],
+        )
+        restored_monitor.restore_state(monitor.get_state())
+
+        assert [detector.get_state() for detector in restored_monitor._detectors] == [
+            {},
+            {"ewma": 2.5},
+        ]
+
+    # verify that the run's noise comes from successive measurements, so that a leak
+    # shifting the flow mid-run barely changes it
+    @pytest.mark.asyncio
+    async def test_noise_variance(self, monitor):
+        measurements = [1.9, 2.1] * 50 + [3.9, 4.1] * 50
+        for measurement in [8.0] * 5 + measurements:
+            await monitor.add_measurement(measurement)
+
+        assert statistics.variance(measurements) > 1.0
+        assert monitor.noise_variance < 0.03
+
     async def _add_measurements_and_verify_alert(
         self,
         monitor: station_flow.Monitor,
@@ -96,3 +253,25 @@ class TestStationFlowMonitor:
         assert len(expected_events) == len(received_events)
         for received_event_idx, received_event in enumerate(received_events):
             assert isinstance(received_event, expected_events[received_event_idx])
+
+
+class TestMeasurementWindow:
+
+    # verify that the running mean and variance match a full recalculation over the
+    # last measurements, also after the window wraps around many times
+    @pytest.mark.parametrize("capacity", [1, 2, 7, 100])
+    def test_statistics(self, capacity):
+        window = station_flow.MeasurementWindow(capacity)
+        rng = random.Random(capacity)
+        measurements = [rng.uniform(0, 10) for _ in range(1000)]
+
+        for measurement_idx, measurement in enumerate(measurements):
+            window.add(measurement)
+
+            expected_values = measurements[max(0, measurement_idx + 1 - capacity):measurement_idx + 1]
+            assert window.values() == expected_values
+            assert window.full == (len(expected_values) == capacity)
+            assert window.mean == pytest.approx(statistics.mean(expected_values))
+
+            if len(expected_values) > 1:
+                assert window.variance == pytest.approx(statistics.variance(expected_values))
@@ -0,0 +1,97 @@
+import pytest
+import logger
+import thresholds
+
+
+class _Station:
+    def __init__(self, index: int, name: str):
+        self.index = index
+        self.name = name
+
+
+class _Controller:
+    def __init__(self, stations):
+        self.stations = {station.index: station for station in stations}
+
+
+@pytest.fixture
+def stations_config():
+    return {
+        "default": {
+            "flow_rate_average_history_meansurements": 10,
+            "allowed_flow_rate_diff_from_average": 1,
+            "num_inrush_measurements": 5,
+            "allowed_flow_rate_max": 8,
+        },
+        "front_lawn": {"allowed_flow_rate_max": 12.5},
+        "back_lawn": None,
+    }
+
+
+def _get_table(stations_config) -> thresholds.Table:
+    return thresholds.Table(logger.Logger(level="DEBUG"), stations_config)
+
+
+class TestTable:
+
+    # verify that stations override the default field by field, and that stations
+    # without a stanza (or with an empty one) get the default
+    def test_get_thresholds(self, stations_config):
+        table = _get_table(stations_config)
+
+        assert table.get_thresholds(_Station(0, "Front Lawn")) == thresholds.Thresholds(
+            inrush_measurements=5,
+            allowed_max=12.5,
+            allowed_average_diff=1.0,
+            expected_average_history=10,
+        )
+        assert table.get_thresholds(_Station(1, "Back Lawn")) == table.get_thresholds(
+            _Station(2, "Shrubs")
+        )
+        assert table.get_thresholds(_Station(2, "Shrubs")).allowed_max == 8.0
+
+    # verify that a renamed station picks up the thresholds of its new name
+    def test_renamed_station(self, stations_config):
+        table = _get_table(stations_config)
+        station = _Station(0, "Shrubs")
+
+        assert table.get_thresholds(station).allowed_max == 8.0
+
+        station.name = "Front Lawn"
+        assert table.get_thresholds(station).allowed_max == 12.5
+
+    # verify that configuration errors are raised when the table is compiled
+    @pytest.mark.parametrize(
+        "station_key,station_config",
+        [
+            ("default", {"allowed_flow_rate_max": 8}),
+            ("front_lawn", {"allowed_flow_rate_maximum": 8}),
+            ("front_lawn", {"allowed_flow_rate_max": "8"}),
+            ("front_lawn", {"allowed_flow_rate_max": True}),
+            ("front_lawn", {"num_inrush_measurements": 2.5}),
+            ("front_lawn", {"num_inrush_measurements": -1}),
+            ("front_lawn", {"flow_rate_average_history_meansurements": 0}),
+            ("front_lawn", [8]),
+        ],
+    )
+    def test_invalid(self, stations_config, station_key, station_config):
+        stations_config[station_key] = station_config
+
+        with pytest.raises(ValueError):
+            _get_table(stations_config)
+
+    def test_missing_default(self, stations_config):
+        del stations_config["default"]
+
+        with pytest.raises(ValueError):
+            _get_table(stations_config)
+
+    # verify that stanzas not matching any station are found
+    def test_warn_unknown_stations(self, stations_config):
+        warnings = []
+        table = _get_table(stations_config)
+        table._logger.warn_with = lambda message, **kw_args: warnings.append(kw_args)
+
+        table.warn_unknown_stations(_Controller([_Station(0, "Front Lawn")]))
+
+        assert warnings == [{"station_key": "back_lawn"}]
@@ -0,0 +1,149 @@
+from typing import Dict, Optional
+
+import logger
+import pyopensprinkler
+
+
+class Thresholds:
+    """The thresholds a station's flow is monitored against"""
+
+    __slots__ = (
+        "inrush_measurements",
+        "allowed_max",
+        "allowed_average_diff",
+        "expected_average_history",
+    )
+
+    def __init__(
+        self,
+        inrush_measurements: int,
+        allowed_max: float,
+        allowed_average_diff: float,
+        expected_average_history: int,
+    ):
+        self.inrush_measurements = inrush_measurements
+        self.allowed_max = allowed_max
+        self.allowed_average_diff = allowed_average_diff
+        self.expected_average_history = expected_average_history
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, Thresholds) and all(
+            getattr(self, name) == getattr(other, name) for name in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)}" for name in self.__slots__)
+        return f"Thresholds({fields})"
+
+
+class _Entry:
+    __slots__ = ("station_name", "station_key", "thresholds")
+
+    def __init__(self, station_name: str, station_key: str, thresholds: Thresholds):
+        self.station_name = station_name
+        self.station_key = station_key
+        self.thresholds = thresholds
+
+
+def get_station_key(station_name: str) -> str:
+    return station_name.lower().replace(" ", "_")
+
+
+class Table:
+    """Station thresholds compiled from the detector's "stations" config. The config is
+    validated up front, so that mistakes are found at startup (or reload) rather than
+    when a station starts running. Stations are then resolved by index"""
+
+    # config field name -> (thresholds field name, type, minimum value)
+    _fields = {
+        "num_inrush_measurements": ("inrush_measurements", int, 0),
+        "allowed_flow_rate_max": ("allowed_max", float, None),
+        "allowed_flow_rate_diff_from_average": ("allowed_average_diff", float, None),
+        "flow_rate_average_history_meansurements": ("expected_average_history", int, 1),
+    }
+
+    def __init__(self, logger_instance: logger.Logger, stations_config: Dict):
+        self._logger = logger_instance
+
+        if not isinstance((stations_config or {}).get("default"), dict):
+            raise ValueError("detector.stations.default must be a mapping")
+
+        # the default must be complete, stations override whatever fields they set
+        default_config = stations_config["default"]
+        self._default_thresholds = self._compile("default", default_config, {})
+        self._thresholds_by_key = {
+            station_key: self._compile(station_key, station_config or {}, default_config)
+            for station_key, station_config in stations_config.items()
+            if station_key != "default"
+        }
+
+        # station index -> entry, filled as stations are looked up
+        self._entries = {}
+
+    def get_thresholds(self, station: pyopensprinkler.Station) -> Thresholds:
+        return self._get_entry(station).thresholds
+
+    def warn_unknown_stations(self, controller: pyopensprinkler.Controller) -> None:
+        """Logs stanzas that don't match any of the controller's stations, which are
+        likely misspelled"""
+        station_keys = {
+            get_station_key(station.name) for station in controller.stations.values()
+        }
+
+        for station_key in self._thresholds_by_key:
+            if station_key not in station_keys:
+                self._logger.warn_with(
+                    "Station thresholds don't match any station", station_key=station_key
+                )
+
+    def _get_entry(self, station: pyopensprinkler.Station) -> _Entry:
+        entry = self._entries.get(station.index)
+
+        # stations may be renamed on the controller
+        if entry is None or entry.station_name != station.name:
+            station_key = get_station_key(station.name)
+            entry = self._entries[station.index] = _Entry(
+                station.name,
+                station_key,
+                self._thresholds_by_key.get(station_key, self._default_thresholds),
+            )
+
+        return entry
+
+    def _compile(self, station_key: str, station_config: Dict, default_config: Dict) -> Thresholds:
+        if not isinstance(station_config, dict):
+            raise ValueError(f"detector.stations.{station_key} must be a mapping")
+
+        unknown_field_names = set(station_config) - set(self._fields)
+        if unknown_field_names:
+            raise ValueError(
+                f"detector.stations.{station_key} has unknown fields: {sorted(unknown_field_names)}"
+            )
+
+        values = {}
+
+        for field_name, (thresholds_field_name, field_type, minimum) in self._fields.items():
+            value = station_config.get(field_name)
+            if value is None:
+                value = default_config.get(field_name)
+
+            if value is None:
+                raise ValueError(f"detector.stations.{station_key}.{field_name} is required")
+
+            values[thresholds_field_name] = self._get_value(
+                f"detector.stations.{station_key}.{field_name}", value, field_type, minimum
+            )
+
+        return Thresholds(**values)
+
+    def _get_value(self, path: str, value: object, field_type: type, minimum: Optional[float]):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(f"{path} must be a number, got {value!r}")
+
+        if field_type is int and value != int(value):
+            raise ValueError(f"{path} must be a whole number, got {value!r}")
+
+        if minimum is not None and value < minimum:
+            raise ValueError(f"{path} must be at least {minimum}, got {value!r}")
+
+        return field_type(value)